@@ -142,11 +142,12 @@ Future<String> sendTransaction(String recipient, double amount) async {
         print("Response from $node: ${response.statusCode}");
         print("the data is ${json.encode(transactionData)}");
         
-        if (response.statusCode == 201) {
+        // Nodes answer 202 once the transaction is queued for validation
+        if (response.statusCode == 201 || response.statusCode == 202) {
           // Return immediately on success, which will exit the function
           return 'Transaction sent successfully to $node!';
         }
-        // If status code wasn't 201, continue to next node
+        // If the transaction wasn't queued, continue to next node
       } catch (e) {
         print('Error sending transaction to $node: $e');
         // Continue to next node if there's an error
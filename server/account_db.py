@@ -1,7 +1,10 @@
 import json
+import logging
 import os
 from ellipticcurve.privateKey import PrivateKey
 
+logger = logging.getLogger(__name__)
+
 class AccountReader:
     def __init__(self, filename="server/accounts.json"):
         self.filename = filename
@@ -14,10 +17,10 @@ class AccountReader:
                 with open(self.filename, 'r') as f:
                     return json.load(f)
             except IOError as e:
-                print(f"Error loading account data: {e}")
+                logger.error("Error loading account data: %s", e)
             except json.JSONDecodeError:
-                print("Error decoding account data file")
+                logger.error("Error decoding account data file")
         else:
-            print(f"No accounts file found at {self.filename}")
+            logger.warning("No accounts file found at %s", self.filename)
         return []
 
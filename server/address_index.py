@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+
+class AddressIndex:
+    def __init__(self, transaction_id, path=None):
+        """
+        Where every confirmed transaction is in the chain, by address and by
+        transaction id, so a wallet's history does not need a scan of the chain.
+
+        The index is kept in a file next to the block log, one JSON line per
+        block with its hash. On start up the lines that still match the chain
+        are read back and only the blocks after them are indexed. The file can
+        always be rebuilt from the chain, so it is not fsynced.
+
+        :param transaction_id: <callable> Returns the id of a block entry, see Blockchain.transaction_id
+        :param path: (Optional) <str> The index file, the index is kept in memory only without it
+        """
+        self.transaction_id = transaction_id
+        self.path = path
+        # address -> [(height, position)] in chain order
+        self.addresses = {}
+        # transaction id -> (height, position)
+        self.transactions = {}
+        self.hashes = []
+        # Per height, what the block added, so a reorg can take it back
+        self._blocks = []
+        self._offsets = []
+        self._file = None
+
+    def load(self):
+        """
+        Reads the index file, up to the first line that cannot be read
+        """
+        if self.path is None:
+            return
+        end = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # Torn by a crash while it was written
+                        break
+                    try:
+                        record = json.loads(line)
+                        entries = [(position, transaction_id, addresses)
+                                   for position, transaction_id, addresses in record['transactions']]
+                        block_hash = record['hash']
+                    except (ValueError, KeyError, TypeError) as e:
+                        logger.warning("Address index %s is cut short at height %d: %s", self.path, len(self.hashes), e)
+                        break
+                    self._offsets.append(end)
+                    self._add(entries, block_hash)
+                    end += len(line)
+        self._file = open(self.path, 'ab')
+        self._file.truncate(end)
+        self._file.seek(0, os.SEEK_END)
+        logger.info("Address index loaded with %d blocks", len(self.hashes))
+
+    def sync(self, chain, hashes):
+        """
+        Brings the index in line with a chain, keeping the blocks it shares with it
+
+        :param chain: <list> The blocks
+        :param hashes: <list> Their hashes, see BlockIndex
+        """
+        common = 0
+        limit = min(len(self.hashes), len(hashes))
+        while common < limit and self.hashes[common] == hashes[common]:
+            common += 1
+        self.truncate(common)
+        for height in range(common, len(chain)):
+            self.append(chain[height], hashes[height], height)
+
+    def _entries(self, block):
+        entries = []
+        for position, entry in enumerate(block['transactions']):
+            if not entry:
+                continue
+            transaction = entry['transaction']
+            addresses = [transaction['sender']]
+            if transaction['recipient'] != transaction['sender']:
+                addresses.append(transaction['recipient'])
+            # Every coinbase transaction comes from '0', it is not an address
+            addresses = [address for address in addresses if address != '0']
+            entries.append((position, self.transaction_id(entry), addresses))
+        return entries
+
+    def _add(self, entries, block_hash):
+        height = len(self.hashes)
+        for position, transaction_id, addresses in entries:
+            self.transactions[transaction_id] = (height, position)
+            for address in addresses:
+                locations = self.addresses.get(address)
+                if locations is None:
+                    locations = self.addresses[address] = []
+                locations.append((height, position))
+        self.hashes.append(block_hash)
+        self._blocks.append(entries)
+
+    def append(self, block, block_hash, height):
+        """
+        Indexes a block appended to the chain, dropping any indexed block at or above its height first
+
+        :param block: <dict> The block
+        :param block_hash: <str> Its hash
+        :param height: <int> Its height
+        """
+        if height < len(self.hashes):
+            self.truncate(height)
+        entries = self._entries(block)
+        if self._file is not None:
+            self._offsets.append(self._file.tell())
+            record = {'hash': block_hash, 'transactions': entries}
+            self._file.write(json.dumps(record, separators=(',', ':')).encode() + b'\n')
+            self._file.flush()
+        self._add(entries, block_hash)
+
+    def truncate(self, height):
+        """
+        Drops every block from height onwards
+
+        :param height: <int> Number of blocks to keep
+        """
+        if height >= len(self.hashes):
+            return
+        for block_height in range(len(self.hashes) - 1, height - 1, -1):
+            for position, transaction_id, addresses in self._blocks[block_height]:
+                if self.transactions.get(transaction_id) == (block_height, position):
+                    del self.transactions[transaction_id]
+                for address in addresses:
+                    locations = self.addresses.get(address)
+                    # Locations are in chain order, the dropped ones are at the end
+                    while locations and locations[-1][0] >= height:
+                        locations.pop()
+                    if locations == []:
+                        del self.addresses[address]
+        del self._blocks[height:]
+        # A new list, like BlockIndex.truncate
+        self.hashes = self.hashes[:height]
+        if self._file is not None:
+            self._file.truncate(self._offsets[height])
+            self._file.seek(0, os.SEEK_END)
+            del self._offsets[height:]
+
+    def location(self, transaction_id):
+        """
+        :return: <tuple> (height, position) of a confirmed transaction, or None
+        """
+        return self.transactions.get(transaction_id)
+
+    def count(self, address, height=None):
+        """
+        :param address: <str> The address
+        :param height: (Optional) <int> Only count the blocks below this height, e.g. ChainState.height
+        :return: <int> Number of confirmed transactions sent or received by the address
+        """
+        locations = self.addresses.get(address, ())
+        return len(locations) if height is None else bisect_left(locations, (height, -1))
+
+    def history(self, address, offset=0, limit=50, height=None):
+        """
+        A page of the confirmed transactions of an address, newest first
+
+        :param address: <str> The address
+        :param offset: (Optional) <int> Number of newer transactions to skip
+        :param limit: (Optional) <int> Page size
+        :param height: (Optional) <int> Only the blocks below this height, e.g. ChainState.height
+        :return: <tuple> (total number of transactions, [(height, position)])
+        """
+        locations = self.addresses.get(address, ())
+        total = len(locations) if height is None else bisect_left(locations, (height, -1))
+        end = max(0, total - offset)
+        return total, locations[max(0, end - limit):end][::-1]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -5,39 +5,28 @@ from uuid import uuid4
 from typing import List, Optional
 import uvicorn
 import requests
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+import json
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
 from blockchain import Blockchain
-from database import BlockchainDb
+from ingest import QueueFull
+import codec
 import atexit
 import argparse
-
-app = FastAPI()
-
-# Add CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+import logging
+from node_logging import setup_logging
 
 # Initialize the parser
 parser = argparse.ArgumentParser(description="Run the Blockchain FastAPI App")
 parser.add_argument('--url', type=str, required=True, help='Cloudflare Tunnel URL')
 parser.add_argument('-p', '--port', type=int, default=5000, help='port to listen on')
+parser.add_argument('--log-level', type=str, default=None, help='logging level, INFO by default or LOG_LEVEL')
+parser.add_argument('--log-json', action='store_true', default=None, help='write logs as JSON lines, or set LOG_FORMAT=json')
 
-# Parse the arguments
-args = parser.parse_args()
-
-# Get the Cloudflare Tunnel URL from command line argument
-tunnel_url = args.url
-if not tunnel_url:
-    raise ValueError("--url argument is required")
-
-blockchain = Blockchain()
+logger = logging.getLogger(__name__)
 
 # Pydantic models
 class TransactionModel(BaseModel):
@@ -45,6 +34,9 @@ class TransactionModel(BaseModel):
     digital_signature: str
     public_key: str
 
+class TransactionBatchModel(BaseModel):
+    transactions: List[TransactionModel]
+
 class NodesModel(BaseModel):
     nodes: List
 
@@ -56,173 +48,445 @@ class UpdateNodesModel(BaseModel):
     updated_nodes: dict
     node: str
 
-def register_node():
-    print(f"Registering node with url {tunnel_url}...")
-    blockchain.register(tunnel_url)
-
-@app.get('/hello')
-def hello():
-    return {
-        'nodes': list(blockchain.nodes),
-        'length': len(list(blockchain.nodes))
-    }
-
-@app.get('/chain')
-def chain():
-    print("the length of the blockchain is " + str(len(blockchain.chain)))
-    return {
-        'chain': blockchain.chain,
-        'length': len(blockchain.chain)
-    }
-
-@app.post('/transactions/new')
-def new_transaction(transaction: TransactionModel):
-    # Create a new Transaction
-    index, error = blockchain.new_transaction(transaction.transaction, transaction.public_key, transaction.digital_signature)
-    if index is not None:
-        return {'message': f'Transaction will be added to Block {index}'}, 201
-    else:
-        raise HTTPException(status_code=400, detail=error)
-
-@app.post('/nodes/register')
-def register_nodes(nodes: NodesModel):
-    for node in nodes.nodes:
-        print("this is parent node", tunnel_url)
-        blockchain.register_node(node, tunnel_url)
-
-    return {
-        'message': 'New nodes have been added',
-        'total_nodes': list(blockchain.nodes),
-    }, 201
-
-@app.post('/nodes/update_nodes')
-def update_nodes(nodes: NodesModel):
-    for node in nodes.nodes:
-        print("this is parent node", tunnel_url)
-        if node not in blockchain.nodes:
-            blockchain.nodes.add(node)
-
-    return {
-        'message': 'New nodes have been added',
-        'total_nodes': list(blockchain.nodes),
-    }, 201
-
-@app.post('/nodes/update_ttl')
-def update_ttl(update_data: UpdateNodesModel):
-    blockchain.updateTTL(update_data.updated_nodes, update_data.node)
-    return {
-        'message': 'The TTL of nodes have been updated',
-        'total_nodes': list(blockchain.nodes),
-    }, 201
-
-@app.get('/nodes/resolve')
-def consensus():
-    replaced = blockchain.resolve_conflicts()
-
-    if replaced:
+class InventoryModel(BaseModel):
+    node: Optional[str] = None
+    blocks: List[str] = []
+    transactions: List[str] = []
+
+class GetDataModel(BaseModel):
+    blocks: List[str] = []
+    transactions: List[str] = []
+
+def gossip_body(model=None):
+    """
+    Request body of the /nodes/* endpoints, sent by peers either with the
+    binary codec or as JSON by peers from before it
+
+    :param model: (Optional) The pydantic model to parse the body into
+    """
+    async def parse(request: Request):
+        body = await request.body()
+        content_type = request.headers.get('content-type', '').split(';')[0].strip()
+        try:
+            if content_type == codec.CONTENT_TYPE:
+                data = codec.decode(body)
+            elif content_type in ('', 'application/json'):
+                data = json.loads(body)
+            else:
+                raise HTTPException(status_code=415, detail=f"Unsupported content type {content_type}")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Malformed body: {e}")
+        if not isinstance(data, dict):
+            raise HTTPException(status_code=422, detail="Body must be an object")
+        if model is None:
+            return data
+        try:
+            return model(**data)
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=e.errors())
+    return parse
+
+def chain_range(length, from_, to, limit):
+    # from is inclusive and to exclusive, limit caps the number of blocks
+    start = min(from_ or 0, length)
+    end = length if to is None else min(to, length)
+    if limit is not None:
+        end = min(end, start + limit)
+    return start, max(start, end)
+
+def chain_etag(state):
+    # The tip hash identifies the whole chain, so any range of it
+    return f'W/"{state.tip_hash}"'
+
+def etag_matches(request: Request, etag: str):
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+
+def create_app(blockchain, tunnel_url):
+    """
+    The API of a node. Every node in a process gets its own app, e.g. the
+    nodes of the cluster simulator.
+
+    :param blockchain: <Blockchain> The node
+    :param tunnel_url: <str> The public URL of the node, sent to the nodes it registers with
+    :return: <FastAPI> The app
+    """
+    app = FastAPI()
+
+    # Add CORS middleware
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    # Compress large responses such as chain ranges
+    app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+    request_latency = blockchain.metrics.histogram(
+        'http_request_duration_seconds', 'Request latency per endpoint', ['method', 'endpoint', 'status'])
+
+    @app.middleware('http')
+    async def record_request_latency(request: Request, call_next):
+        start = time.perf_counter()
+        response = await call_next(request)
+        # The route template rather than the raw path, so /blocks/{height} is one series
+        route = request.scope.get('route')
+        endpoint = route.path if route is not None else 'unmatched'
+        request_latency.observe(time.perf_counter() - start, method=request.method, endpoint=endpoint, status=response.status_code)
+        return response
+
+    @app.get('/hello')
+    def hello():
+        nodes = blockchain.snapshot.nodes
         return {
-            'message': 'Our chain was replaced',
-            'new_chain': blockchain.chain
-        }, 200
-    else:
+            'nodes': list(nodes),
+            'length': len(nodes)
+        }
+
+    @app.get('/metrics')
+    def metrics():
+        # Prometheus text exposition format
+        return Response(blockchain.metrics.render(), media_type='text/plain; version=0.0.4')
+
+    @app.get('/chain')
+    def chain(request: Request, response: Response,
+              from_: Optional[int] = Query(None, alias='from', ge=0),
+              to: Optional[int] = Query(None, ge=0),
+              limit: Optional[int] = Query(None, ge=1)):
+        # Without from, to and limit the whole chain is returned
+        state = blockchain.snapshot
+        etag = chain_etag(state)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={'ETag': etag})
+        chain = state.chain
+        start, end = chain_range(len(chain), from_, to, limit)
+        response.headers['ETag'] = etag
+        logger.debug("The length of the blockchain is %d", len(chain))
         return {
-            'message': 'Our chain is authoritative',
-            'chain': blockchain.chain
-        }, 200
+            'chain': chain[start:end],
+            'length': len(chain),
+            'from': start,
+            'to': end
+        }
+
+    @app.get('/chain/validation')
+    def chain_validation():
+        return blockchain.chain_validator.progress()
+
+    @app.post('/chain/validation', status_code=202)
+    def start_chain_validation():
+        # Full re-validation in the background, poll GET /chain/validation for progress
+        started = blockchain.chain_validator.start()
+        return {'started': started, **blockchain.chain_validator.progress()}
+
+    @app.get('/chain/stream')
+    def chain_stream(request: Request,
+                     from_: Optional[int] = Query(None, alias='from', ge=0),
+                     to: Optional[int] = Query(None, ge=0),
+                     limit: Optional[int] = Query(None, ge=1)):
+        # One block per line, so large ranges are never built as one document.
+        # The stream reads one snapshot, blocks added meanwhile are not mixed in
+        state = blockchain.snapshot
+        etag = chain_etag(state)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={'ETag': etag})
+        chain = state.chain
+        start, end = chain_range(len(chain), from_, to, limit)
+
+        def blocks():
+            for height in range(start, end):
+                yield json.dumps(chain[height]) + '\n'
+
+        return StreamingResponse(blocks(), media_type='application/x-ndjson', headers={'ETag': etag})
+
+    @app.get('/blocks/hash/{block_hash}')
+    def block_by_hash(block_hash: str):
+        state = blockchain.snapshot
+        height = state.height_of(block_hash)
+        if height is None:
+            raise HTTPException(status_code=404, detail="Block not found")
+        return {'height': height, 'hash': block_hash, 'block': state.chain[height]}
+
+    @app.get('/blocks/{height}')
+    def block_by_height(height: int):
+        state = blockchain.snapshot
+        if not 0 <= height < state.height:
+            raise HTTPException(status_code=404, detail="Block not found")
+        return {'height': height, 'hash': state.hashes[height], 'block': state.chain[height]}
+
+    @app.get('/headers')
+    def headers(from_: int = Query(0, alias='from', ge=0), limit: int = Query(500, ge=1, le=2000)):
+        # Headers only, so light clients can follow the chain without the transactions
+        state = blockchain.snapshot
+        chain = state.chain
+        end = min(len(chain), from_ + limit)
+        return {
+            'headers': [
+                {
+                    'height': height,
+                    'hash': state.hashes[height],
+                    'header': blockchain.header(chain[height])
+                }
+                for height in range(from_, end)
+            ],
+            'length': len(chain)
+        }
+
+    @app.get('/transactions/{transaction_id}/proof')
+    def transaction_proof(transaction_id: str):
+        proof = blockchain.transaction_proof(transaction_id)
+        if proof is None:
+            raise HTTPException(status_code=404, detail="Transaction not found in a block with a Merkle root")
+        return proof
+
+    @app.get('/balance/{address}')
+    def balance(address: str):
+        return {
+            'address': address,
+            'balance': blockchain.ledger.balance(address),
+            'confirmed': blockchain.ledger.confirmed_balance(address),
+            'pending': blockchain.ledger.pending_balance(address)
+        }
+
+    def confirmed_transaction(state, height, position):
+        block = state.chain[height]
+        entry = block['transactions'][position]
+        return {
+            'transaction_id': blockchain.transaction_id(entry),
+            'status': 'confirmed',
+            'height': height,
+            'position': position,
+            'block_hash': state.hashes[height],
+            'timestamp': block['timestamp'],
+            'confirmations': state.height - height,
+            'transaction': entry
+        }
+
+    @app.get('/addresses/{address}')
+    def address_summary(address: str):
+        # The index is bounded by the snapshot height, blocks the writer is still adding are not counted yet
+        state = blockchain.snapshot
+        return {
+            'address': address,
+            'balance': blockchain.ledger.balance(address),
+            'confirmed': blockchain.ledger.confirmed_balance(address),
+            'pending': blockchain.ledger.pending_balance(address),
+            'transactions': blockchain.address_index.count(address, state.height),
+            'height': state.height
+        }
+
+    @app.get('/addresses/{address}/transactions')
+    def address_transactions(address: str, offset: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=500)):
+        # Newest first, offset counts from the newest transaction
+        state = blockchain.snapshot
+        total, locations = blockchain.address_index.history(address, offset, limit, state.height)
+        return {
+            'address': address,
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'transactions': [confirmed_transaction(state, height, position) for height, position in locations]
+        }
+
+    @app.get('/transactions/{transaction_id}')
+    def transaction(transaction_id: str):
+        state = blockchain.snapshot
+        location = blockchain.address_index.location(transaction_id)
+        if location is not None and location[0] < state.height:
+            found = confirmed_transaction(state, *location)
+            # A reorg can move the transaction after the snapshot was taken
+            if found['transaction_id'] == transaction_id:
+                return found
+        entry = blockchain.mempool.get(transaction_id)
+        if entry is not None:
+            return {'transaction_id': transaction_id, 'status': 'accepted', 'transaction': entry}
+        raise HTTPException(status_code=404, detail="Transaction not found")
+
+    @app.get('/transactions/{transaction_id}/status')
+    def transaction_status(transaction_id: str):
+        status = blockchain.ingest.status(transaction_id)
+        if status is None:
+            raise HTTPException(status_code=404, detail="Transaction not found")
+        return status
+
+    @app.post('/transactions/new', status_code=202)
+    def new_transaction(transaction: TransactionModel):
+        # Only structural checks here, the signature and the balance are
+        # checked in the background, see TransactionIngest
+        entry = {
+            "transaction": transaction.transaction,
+            "public_address": transaction.public_key,
+            "digital_signature": transaction.digital_signature
+        }
+        try:
+            transaction_id, error = blockchain.ingest.submit(entry)
+        except QueueFull as e:
+            raise HTTPException(status_code=429, detail=str(e), headers={'Retry-After': '1'})
+        if error:
+            raise HTTPException(status_code=400, detail=error)
+        return {
+            'message': 'Transaction queued for validation',
+            'transaction_id': transaction_id,
+            'status_url': f'/transactions/{transaction_id}/status'
+        }
+
+    @app.post('/transactions/batch')
+    def new_transactions(batch: TransactionBatchModel):
+        # Validated on this thread, so every transaction gets its outcome
+        ingest = blockchain.ingest
+        if len(batch.transactions) > ingest.max_request:
+            raise HTTPException(status_code=413, detail=f"At most {ingest.max_request} transactions per batch")
+        entries = [{
+            "transaction": transaction.transaction,
+            "public_address": transaction.public_key,
+            "digital_signature": transaction.digital_signature
+        } for transaction in batch.transactions]
+        results = ingest.submit_batch(entries)
+        return {
+            'accepted': sum(1 for result in results if result['status'] == 'accepted'),
+            'rejected': sum(1 for result in results if result['status'] == 'rejected'),
+            'results': results
+        }
 
-@app.post('/nodes/update_block')
-def update_block(block: dict):
-    print("this is block", block)
-    if blockchain.hash(block) in blockchain.hash_list:
-        return f"Already added Block in the network {block}", 200
-    else:
-        for transaction in block['transactions']:
-            if transaction in blockchain.current_transactions:
-                blockchain.current_transactions.remove(transaction)
+    @app.post('/nodes/register')
+    def register_nodes(nodes: NodesModel = Depends(gossip_body(NodesModel))):
+        for node in nodes.nodes:
+            logger.debug("Adding node %s from parent node %s", node, tunnel_url)
+            blockchain.register_node(node, tunnel_url)
 
-        blockchain.chain.append(block)
-        blockchain.hash_list.add(blockchain.hash(block))
+        return {
+            'message': 'New nodes have been added',
+            'total_nodes': list(blockchain.snapshot.nodes),
+        }, 201
 
-        # send data to the known nodes in the network
-        for node in blockchain.nodes:
-            node = blockchain.addUrl(node)
+    @app.post('/nodes/update_nodes')
+    def update_nodes(nodes: NodesModel = Depends(gossip_body(NodesModel))):
+        logger.debug("Adding nodes %s from parent node %s", nodes.nodes, tunnel_url)
+        blockchain.add_nodes(nodes.nodes)
 
-            requests.post(f'http://{node}/nodes/update_block', json=block, timeout=5)
-            requests.post(f'http://{node}/nodes/update_nodes', json={
-                "nodes": list(blockchain.nodes)
-            })
+        return {
+            'message': 'New nodes have been added',
+            'total_nodes': list(blockchain.snapshot.nodes),
+        }, 201
 
-    return f"Added Block to the network {block}", 200
+    @app.post('/nodes/update_ttl')
+    def update_ttl(update_data: UpdateNodesModel = Depends(gossip_body(UpdateNodesModel))):
+        blockchain.updateTTL(update_data.updated_nodes, update_data.node)
+        return {
+            'message': 'The TTL of nodes have been updated',
+            'total_nodes': list(blockchain.snapshot.nodes),
+        }, 201
+
+    @app.get('/nodes/resolve')
+    def consensus():
+        replaced = blockchain.resolve_conflicts()
+
+        if replaced:
+            return {
+                'message': 'Our chain was replaced',
+                'new_chain': list(blockchain.snapshot.chain)
+            }, 200
+        else:
+            return {
+                'message': 'Our chain is authoritative',
+                'chain': list(blockchain.snapshot.chain)
+            }, 200
+
+    @app.post('/nodes/inv')
+    def inventory(inventory: InventoryModel = Depends(gossip_body(InventoryModel))):
+        # The payloads we have not seen are fetched from the announcing node in the background
+        wanted = blockchain.gossip.on_inventory(inventory.node, inventory.blocks, inventory.transactions)
+        return {'wanted': wanted}
+
+    @app.post('/nodes/getdata')
+    def get_data(request: GetDataModel = Depends(gossip_body(GetDataModel))):
+        return blockchain.gossip.get_data(request.blocks, request.transactions)
+
+    @app.post('/nodes/update_block')
+    def update_block(block: dict = Depends(gossip_body())):
+        # Nodes from before /nodes/inv post whole blocks
+        logger.debug("Received block %s", block.get('index'))
+        block_hash = blockchain.hash(block)
+        if not blockchain.gossip.accept_block(block, block_hash):
+            return f"Block not added, it is known, does not extend our tip or is invalid {block}", 200
+
+        return f"Added Block to the network {block}", 200
+
+    @app.post('/nodes/update_transaction')
+    def update_transaction(transaction: dict = Depends(gossip_body())):
+        # Nodes from before /nodes/inv post whole transactions. They count
+        # anything but 200 as a failed delivery, so the answer stays 200
+        if not blockchain.gossip.accept_transaction(transaction):
+            return {"message": "Transaction not queued, it is malformed or the node is busy", "transaction": transaction}, 200
 
-@app.post('/nodes/update_transaction')
-def update_transaction(transaction: dict):
-    if transaction.get('id') in [t.get('id') for t in blockchain.current_transactions]:
-        return {"message": f"Transaction already in the network", "transaction": transaction}, 200
+        return {
+            "message": "Queued transaction for validation",
+            "transaction": transaction,
+            "failed_nodes": []
+        }, 200
 
-    blockchain.current_transactions.append(transaction)
-    blockchain.miner()
+    @app.post('/nodes/update_chain')
+    def update_chain(data: UpdateChainModel = Depends(gossip_body(UpdateChainModel))):
+        # A registering node pushes its whole chain. It is kept like a synced
+        # chain, only if its blocks are valid and have more work than ours
+        if blockchain.chain_sync.offer(data.chain):
+            return "Our chain was replaced by the pushed chain", 200
+        return "Our chain is authoritative", 200
+
+    @app.post('/delete_node')
+    def delete_chain(node_data: dict):
+        blockchain.remove_node(node_data.get("node"))
+        return "removed Node from the network", 200
+
+    def shutdown_session():
+        with blockchain.write():
+            blockchain.database.save_blockchain(blockchain)
+        blockchain.ingest.shutdown()
+        blockchain.chain_validator.stop()
+        blockchain.pow_engine.shutdown()
+        blockchain.signature_verifier.shutdown()
+        blockchain.broadcaster.shutdown()
+        blockchain.gossip.shutdown()
+        if tunnel_url:
+            transport = blockchain.transport
+            for node in blockchain.snapshot.nodes:
+                try:
+                    transport.post(transport.url(node, '/delete_node'), json={"node": tunnel_url}, timeout=5)
+                except requests.exceptions.RequestException as e:
+                    logger.warning("Error notifying node %s: %s", node, e)
+        blockchain.transport.close()
+        logger.info("FastAPI server is shutting down...")
+
+    @app.on_event("shutdown")
+    async def shutdown_event():
+        shutdown_session()
+
+    return app
 
-    # Send data to the known nodes in the network
-    failed_nodes = []
-    for node in blockchain.nodes:
-        node = blockchain.addUrl(node)
+if __name__ == '__main__':
+    # Parse the arguments
+    args = parser.parse_args()
 
-        try:
-            response = requests.post(f'http://{node}/nodes/update_transaction', json=transaction, timeout=5)
-            if response.status_code != 200:
-                failed_nodes.append({"node": node, "reason": f"Non-200 status code: {response.status_code}"})
-        except requests.exceptions.RequestException as e:
-            failed_nodes.append({"node": node, "reason": str(e)})
-
-    if failed_nodes:
-        print(f"Failed to send transaction to some nodes: {failed_nodes}")
-
-    return {
-        "message": "Added transaction to the network",
-        "transaction": transaction,
-        "failed_nodes": failed_nodes
-    }, 200
-
-@app.post('/nodes/update_chain')
-def update_chain(data: UpdateChainModel):
-    chain_list = data.chain
-    hash_list = data.hash_list
-    blockchain.hash_list = set(hash_list)
-    
-    for chain in chain_list:
-        if chain not in blockchain.chain:
-            blockchain.chain.append(chain)
+    setup_logging(level=args.log_level, json_format=args.log_json)
 
-    return f"Added Chain to the network {chain_list} and nodes are {blockchain.nodes}", 200
+    # Get the Cloudflare Tunnel URL from command line argument
+    tunnel_url = args.url
+    if not tunnel_url:
+        raise ValueError("--url argument is required")
 
-@app.post('/delete_node')
-def delete_chain(node_data: dict):
-    blockchain.nodes.remove(node_data.get("node"))
-    return "removed Node from the network", 200
+    blockchain = Blockchain()
+    app = create_app(blockchain, tunnel_url)
 
-def shutdown_session():
-    database = BlockchainDb()
-    
-    database.save_blockchain(blockchain)
-    if tunnel_url:
-        for node in blockchain.nodes:
-            try:
-                if "simplicity" in node:
-                    node = node + ".onrender.com"
-                else:
-                    node = node + ".trycloudflare.com"
-                
-                requests.post(f'http://{node}/delete_node', json={"node": tunnel_url}, timeout=5)
-            except requests.exceptions.RequestException as e:
-                print(f"Error notifying node {node}: {e}")
-    print("FastAPI server is shutting down...")
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    shutdown_session()
+    def register_node():
+        logger.info("Registering node with url %s", tunnel_url)
+        blockchain.register(tunnel_url)
 
-if __name__ == '__main__':
     threading.Thread(target=register_node, daemon=True).start()
-    print(f"Cloudflare Tunnel URL: {tunnel_url}")
-    print(f"Starting FastAPI Server on port {args.port}...")
-    uvicorn.run(app, port=args.port)
\ No newline at end of file
+    logger.info("Cloudflare Tunnel URL: %s", tunnel_url)
+    logger.info("Starting FastAPI Server on port %d...", args.port)
+    uvicorn.run(app, port=args.port)
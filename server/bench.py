@@ -0,0 +1,415 @@
+"""
+Microbenchmarks for the Blockchain hot paths.
+
+Runs offline: requests is stubbed out, the mining scheduler is not started
+and every file is written to a temporary directory. The results are printed
+as JSON, so runs on two commits can be compared:
+
+    python server/bench.py --output before.json
+    python server/bench.py --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import requests
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SERVER_DIR)
+
+
+class OfflineResponse:
+    status_code = 503
+
+    def json(self):
+        return {}
+
+    def raise_for_status(self):
+        raise requests.exceptions.HTTPError("offline benchmark run", response=self)
+
+
+def offline_request(*args, **kwargs):
+    return OfflineResponse()
+
+
+def stub_requests():
+    requests.post = offline_request
+    requests.get = offline_request
+    requests.Session.request = lambda session, *args, **kwargs: offline_request(*args, **kwargs)
+
+
+def measure(name, func, repeat, items=1, setup=None, **params):
+    """
+    Times func repeat times and summarizes the timings
+
+    :param name: <str> Benchmark name
+    :param func: <callable> The code to time, called with the value returned by setup
+    :param repeat: <int> Number of timed runs
+    :param items: (Optional) <int> Units of work done by one call, e.g. blocks hashed
+    :param setup: (Optional) <callable> Called before every run, outside the timing
+    :return: <dict> The result
+    """
+    timings = []
+    for run in range(repeat):
+        state = setup(run) if setup else None
+        start = time.perf_counter()
+        func(state)
+        timings.append(time.perf_counter() - start)
+    median = statistics.median(timings)
+    return {
+        'name': name,
+        'params': params,
+        'repeat': repeat,
+        'items': items,
+        'min': min(timings),
+        'median': median,
+        'mean': statistics.mean(timings),
+        'stdev': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        'items_per_sec': items / median if median else None
+    }
+
+
+def chain_shape(filename):
+    """
+    Reads the shape of a real chain: transactions per block, the addresses in
+    use and a sample signature
+
+    :param filename: <str> A blockchain.json file
+    :return: <dict>
+    """
+    with open(filename) as f:
+        chain = json.load(f)['chain']
+    counts = [len(block['transactions']) for block in chain]
+    addresses = set()
+    signatures = []
+    for block in chain:
+        for entry in block['transactions']:
+            transaction = entry['transaction']
+            addresses.update([transaction['sender'], transaction['recipient']])
+            if transaction['sender'] != '0' and entry.get('digital_signature'):
+                signatures.append(entry['digital_signature'])
+    addresses.discard('0')
+    return {
+        'transactions_per_block': counts,
+        'addresses': sorted(addresses),
+        'signature': signatures[0] if signatures else ''
+    }
+
+
+def synthetic_chain(blockchain, length, shape, seed=0):
+    """
+    Builds a chain of the given length with the transaction counts and
+    addresses of the real chain. The blocks link up but carry random proofs.
+
+    :return: <tuple> (chain, hashes)
+    """
+    rng = random.Random(seed)
+    addresses = shape['addresses']
+    chain = []
+    hashes = []
+    timestamp = 1729000000.0
+    previous_hash = '1'
+    for height in range(length):
+        timestamp += rng.uniform(30, 90)
+        miner = rng.choice(addresses)
+        transactions = [{
+            'transaction': {'sender': '0', 'recipient': miner, 'amount': 50.0, 'timestamp': timestamp},
+            'public_address': miner,
+            'digital_signature': shape['signature']
+        }]
+        for _ in range(max(0, rng.choice(shape['transactions_per_block']) - 1)):
+            sender, recipient = rng.sample(addresses, 2)
+            transactions.append({
+                'transaction': {
+                    'sender': sender,
+                    'recipient': recipient,
+                    'amount': rng.randint(1, 5),
+                    'timestamp': timestamp - rng.uniform(0, 60)
+                },
+                'public_address': sender,
+                'digital_signature': shape['signature']
+            })
+        block = {
+            'index': height + 1,
+            'timestamp': timestamp,
+            'transactions': transactions,
+            'merkle_root': blockchain.compute_merkle_root(transactions),
+            'proof': rng.randint(0, 10 ** 6),
+            'previous_hash': previous_hash
+        }
+        previous_hash = blockchain.hash(block)
+        chain.append(block)
+        hashes.append(previous_hash)
+    return chain, hashes
+
+
+def bench_pow(blockchain, args):
+    from blockchain import Blockchain
+    from difficulty import target_from_zeros
+    from pow_engine import search_nonces
+
+    results = []
+    nonces = 20000
+    for zeros in args.targets:
+        target = target_from_zeros(zeros)
+        results.append(measure(
+            'valid_proof', lambda _: [Blockchain.valid_proof(100, proof, target) for proof in range(nonces)],
+            args.repeat, items=nonces, target=zeros))
+    # The same nonces through the single core kernel, against a target no
+    # digest is below so every nonce is tried
+    results.append(measure(
+        'search_nonces', lambda _: search_nonces(100, 0, 0, nonces),
+        args.repeat, items=nonces))
+
+    # Warm up the worker processes so pool start up is not timed
+    blockchain.proof_of_work(0, target_from_zeros(1))
+    for zeros in args.targets:
+        target = target_from_zeros(zeros)
+        # The same last proofs on every run, so commits are compared on the same work
+        results.append(measure(
+            'proof_of_work', lambda last_proof: blockchain.proof_of_work(last_proof, target),
+            args.repeat, setup=lambda run: 1000 + run, target=zeros))
+    return results
+
+
+def bench_chain(blockchain, args, shape):
+    from blockchain import Blockchain
+
+    results = []
+    for size in args.sizes:
+        chain, _ = synthetic_chain(blockchain, size, shape)
+        legacy_chain = [{key: value for key, value in block.items() if key != 'merkle_root'} for block in chain]
+        results.append(measure(
+            'hash', lambda _: [Blockchain.hash(block) for block in chain],
+            args.repeat, items=size, blocks=size, format='merkle'))
+        results.append(measure(
+            'hash', lambda _: [Blockchain.hash(block) for block in legacy_chain],
+            args.repeat, items=size, blocks=size, format='legacy'))
+
+        results.append(measure(
+            'ledger_rebuild', lambda _: blockchain.ledger.rebuild(chain),
+            args.repeat, items=size, blocks=size))
+        rng = random.Random(size)
+        transactions = [
+            {'sender': rng.choice(shape['addresses']), 'recipient': rng.choice(shape['addresses']), 'amount': rng.randint(1, 100)}
+            for _ in range(1000)
+        ]
+        results.append(measure(
+            'check_balance', lambda _: [blockchain.check_balance(transaction) for transaction in transactions],
+            args.repeat, items=len(transactions), blocks=size))
+    blockchain.ledger.rebuild(blockchain.chain, blockchain.current_transactions)
+    return results
+
+
+def bench_signatures(blockchain, args):
+    from ellipticcurve.ecdsa import Ecdsa
+    from ellipticcurve.privateKey import PrivateKey
+    from signature_verifier import SignatureVerifier
+
+    rng = random.Random(0)
+    keys = [PrivateKey() for _ in range(10)]
+    signed = []
+    for i in range(args.signatures):
+        private_key = keys[i % len(keys)]
+        transaction = {
+            'sender': private_key.publicKey().toCompressed(),
+            'recipient': keys[(i + 1) % len(keys)].publicKey().toCompressed(),
+            'amount': rng.randint(1, 100),
+            'timestamp': 1729000000.0 + i
+        }
+        signature = Ecdsa.sign(json.dumps(transaction, sort_keys=True), private_key).toBase64()
+        signed.append({'transaction': transaction, 'public_address': transaction['sender'], 'digital_signature': signature})
+
+    def verify_all(_):
+        for entry in signed:
+            assert blockchain.verify_digital_signature(entry['transaction'], entry['public_address'], entry['digital_signature'])
+
+    def fresh_verifier(run):
+        # Empty key and result caches
+        blockchain.signature_verifier.shutdown()
+        blockchain.signature_verifier = SignatureVerifier()
+
+    results = [
+        measure('verify_digital_signature', verify_all, args.repeat, items=len(signed), setup=fresh_verifier, cache='cold'),
+        measure('verify_digital_signature', verify_all, args.repeat, items=len(signed), cache='warm'),
+        measure('verify_transaction_signatures', lambda _: blockchain.verify_transaction_signatures(signed),
+                args.repeat, items=len(signed), setup=fresh_verifier, cache='cold')
+    ]
+    return results
+
+
+def bench_database(blockchain, args, shape, workdir):
+    from block_index import BlockIndex
+    from database import BlockchainDb
+
+    results = []
+    for size in args.db_sizes:
+        chain, hashes = synthetic_chain(blockchain, size, shape)
+        source = SimpleNamespace(chain=chain, block_index=BlockIndex(), current_transactions=[], nodes=set(), ttl={})
+        source.block_index.rebuild(hashes)
+        databases = []
+
+        def new_database(run):
+            database = BlockchainDb(directory=tempfile.mkdtemp(dir=workdir), legacy_filename=os.path.join(workdir, 'missing.json'))
+            databases.append(database)
+            return database
+
+        def load(run):
+            # Each load reopens the log written by a save run
+            database = databases[run]
+            database.block_log.close()
+            return BlockchainDb(directory=database.block_log.directory, legacy_filename=database.legacy_filename)
+
+        def load_into(database):
+            target = SimpleNamespace(chain=[], block_index=BlockIndex(), current_transactions=[], nodes=set(), ttl={})
+            database.load_blockchain(target)
+            assert len(target.chain) == size
+            database.block_log.close()
+
+        results.append(measure('save_blockchain', lambda database: database.save_blockchain(source),
+                               args.repeat, items=size, setup=new_database, blocks=size))
+        results.append(measure('load_blockchain', load_into, args.repeat, items=size, setup=load, blocks=size))
+    return results
+
+
+def bench_codec(blockchain, args, shape):
+    import codec
+
+    chain, _ = synthetic_chain(blockchain, args.sizes[0], shape)
+    size = len(chain)
+    encoded = [codec.encode(block) for block in chain]
+    encoded_json = [json.dumps(block, separators=(',', ':')).encode() for block in chain]
+    results = [
+        measure('encode', lambda _: [codec.encode(block) for block in chain], args.repeat, items=size,
+                blocks=size, format='binary', bytes=sum(map(len, encoded))),
+        measure('encode', lambda _: [json.dumps(block, separators=(',', ':')).encode() for block in chain],
+                args.repeat, items=size, blocks=size, format='json', bytes=sum(map(len, encoded_json))),
+        measure('decode', lambda _: [codec.decode(payload) for payload in encoded], args.repeat, items=size,
+                blocks=size, format='binary'),
+        measure('decode', lambda _: [json.loads(payload) for payload in encoded_json], args.repeat, items=size,
+                blocks=size, format='json')
+    ]
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=SERVER_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    return result['name'], json.dumps(result['params'], sort_keys=True)
+
+
+def print_summary(results, baseline=None, file=sys.stderr):
+    previous = {result_key(result): result for result in (baseline or {}).get('results', [])}
+    for result in results:
+        params = ' '.join(f'{key}={value}' for key, value in result['params'].items())
+        line = f"{result['name']:<30} {params:<28} median {result['median'] * 1000:10.3f} ms"
+        if result['items'] > 1:
+            line += f"  {result['items_per_sec']:12.1f} items/s"
+        old = previous.get(result_key(result))
+        if old:
+            line += f"  x{result['median'] / old['median']:.2f} vs baseline"
+        print(line, file=file)
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Blockchain hot paths")
+    parser.add_argument('--sizes', type=int_list, default=[1000, 10000, 100000], help='synthetic chain lengths for hash and balance benchmarks')
+    parser.add_argument('--db-sizes', type=int_list, default=[1000, 10000], help='chain lengths for the save and load round trips')
+    parser.add_argument('--targets', type=int_list, default=[2, 3, 4], help='proof of work targets, as leading hex zeros')
+    parser.add_argument('--signatures', type=int, default=200, help='number of signed transactions to verify')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('--only', type=lambda value: value.split(','), default=None, help='comma separated groups: pow,chain,signatures,database,codec')
+    parser.add_argument('--quick', action='store_true', help='small sizes, for a fast check')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.sizes = [1000]
+        args.db_sizes = [1000]
+        args.targets = [2, 3]
+        args.signatures = 50
+        args.repeat = 3
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    groups = args.only or ['pow', 'chain', 'signatures', 'database', 'codec']
+    shape = chain_shape(os.path.join(SERVER_DIR, 'blockchain.json'))
+
+    stub_requests()
+    from blockchain import Blockchain
+
+    # Blockchain() reads and writes server/... relative to the working directory
+    workdir = tempfile.mkdtemp(prefix='blockchain-bench-')
+    os.makedirs(os.path.join(workdir, 'server'))
+    for filename in ['accounts.json', 'blockchain.json']:
+        shutil.copy(os.path.join(SERVER_DIR, filename), os.path.join(workdir, 'server', filename))
+    cwd = os.getcwd()
+    os.chdir(workdir)
+
+    results = []
+    try:
+        blockchain = Blockchain(scheduled_mining=False)
+        if 'pow' in groups:
+            results += bench_pow(blockchain, args)
+        if 'chain' in groups:
+            results += bench_chain(blockchain, args, shape)
+        if 'signatures' in groups:
+            results += bench_signatures(blockchain, args)
+        if 'database' in groups:
+            results += bench_database(blockchain, args, shape, workdir)
+        if 'codec' in groups:
+            results += bench_codec(blockchain, args, shape)
+        blockchain.pow_engine.shutdown()
+        blockchain.signature_verifier.shutdown()
+        blockchain.broadcaster.shutdown()
+        blockchain.ingest.shutdown()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'timestamp': time.time(),
+        'args': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': results
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_summary(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+class BlockIndex:
+    def __init__(self, hashes=()):
+        """
+        Hash of every block of the chain, computed once when the block is
+        appended, looked up by height or by hash.
+
+        :param hashes: (Optional) <list> Hex encoded block hashes in chain order
+        """
+        self.hashes = []
+        self.heights = {}
+        self.rebuild(hashes)
+
+    def rebuild(self, hashes):
+        self.hashes = list(hashes)
+        self.heights = {block_hash: height for height, block_hash in enumerate(self.hashes)}
+
+    def append(self, block_hash):
+        self.heights[block_hash] = len(self.hashes)
+        self.hashes.append(block_hash)
+
+    def truncate(self, height):
+        """
+        Drops the hashes of every block from height onwards
+
+        :param height: <int> Number of blocks to keep
+        """
+        for block_hash in self.hashes[height:]:
+            if self.heights.get(block_hash, -1) >= height:
+                del self.heights[block_hash]
+        # A new list, snapshots still hold views of the old one
+        self.hashes = self.hashes[:height]
+
+    def hash_at(self, height):
+        """
+        :return: <str> The hash of the block at height
+        """
+        return self.hashes[height]
+
+    def height_of(self, block_hash):
+        """
+        :return: <int> The height of the block with this hash, or None
+        """
+        return self.heights.get(block_hash)
+
+    @property
+    def tip_hash(self):
+        return self.hashes[-1] if self.hashes else None
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.heights
+
+    def __iter__(self):
+        return iter(self.hashes)
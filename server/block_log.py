@@ -0,0 +1,184 @@
+import os
+import struct
+import threading
+import zlib
+
+
+class BlockLog:
+    # Every record in a segment is prefixed by its length and CRC32
+    RECORD_HEADER = struct.Struct('>II')
+    # Index entry per block: segment number, offset in the segment, record length, block hash
+    INDEX_ENTRY = struct.Struct('>IQI32s')
+
+    def __init__(self, directory='server/blocklog', segment_size=64 * 1024 * 1024):
+        """
+        Append-only, segmented log of blocks with a fixed-width offset index.
+
+        Appends are fsynced, so a crash loses at most the block being written.
+        A torn record or index entry left by a crash is dropped when the log is opened.
+
+        :param directory: <str> Directory holding the segments and the index
+        :param segment_size: (Optional) <int> Size in bytes after which a new segment is started
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.index_path = os.path.join(directory, 'index')
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        self._entries = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            usable = len(data) - len(data) % self.INDEX_ENTRY.size
+            self._entries = [entry for entry in self.INDEX_ENTRY.iter_unpack(data[:usable])]
+        self._recover()
+
+        self._index_file = open(self.index_path, 'ab')
+        self._segment_file = None
+        self._segment = None
+        self._open_segment(self._entries[-1][0] if self._entries else 0)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f'segment-{segment:06d}.log')
+
+    def _record_valid(self, entry):
+        segment, offset, length, _ = entry
+        path = self._segment_path(segment)
+        if not os.path.exists(path) or os.path.getsize(path) < offset + length:
+            return False
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            record = f.read(length)
+        size, crc = self.RECORD_HEADER.unpack_from(record)
+        payload = record[self.RECORD_HEADER.size:]
+        return size == len(payload) and zlib.crc32(payload) == crc
+
+    def _recover(self):
+        # Drop index entries whose record did not make it to disk
+        while self._entries and not self._record_valid(self._entries[-1]):
+            self._entries.pop()
+        self._truncate_files(len(self._entries))
+
+    def _truncate_files(self, height):
+        """
+        Cuts the index and the segments so they hold exactly the first height blocks
+        """
+        with open(self.index_path, 'ab') as f:
+            f.truncate(height * self.INDEX_ENTRY.size)
+            os.fsync(f.fileno())
+
+        if height:
+            segment, offset, length, _ = self._entries[height - 1]
+            end = offset + length
+        else:
+            segment, end = 0, 0
+
+        for name in os.listdir(self.directory):
+            if name.startswith('segment-') and int(name[8:14]) > segment:
+                os.remove(os.path.join(self.directory, name))
+        path = self._segment_path(segment)
+        if os.path.exists(path) and os.path.getsize(path) > end:
+            with open(path, 'ab') as f:
+                f.truncate(end)
+                os.fsync(f.fileno())
+
+    def _open_segment(self, segment):
+        if self._segment_file is not None:
+            self._segment_file.close()
+        self._segment = segment
+        self._segment_file = open(self._segment_path(segment), 'ab')
+
+    def __len__(self):
+        return len(self._entries)
+
+    def append(self, payload, block_hash, sync=True):
+        """
+        Appends one block to the log
+
+        :param payload: <bytes> The encoded block
+        :param block_hash: <str> Hex encoded hash of the block
+        :param sync: (Optional) <bool> fsync the segment and the index before returning
+        """
+        record = self.RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            offset = self._segment_file.tell()
+            if offset and offset + len(record) > self.segment_size:
+                self._open_segment(self._segment + 1)
+                offset = 0
+            self._segment_file.write(record)
+            self._segment_file.flush()
+            if sync:
+                os.fsync(self._segment_file.fileno())
+
+            entry = (self._segment, offset, len(record), bytes.fromhex(block_hash))
+            self._index_file.write(self.INDEX_ENTRY.pack(*entry))
+            self._index_file.flush()
+            if sync:
+                os.fsync(self._index_file.fileno())
+            self._entries.append(entry)
+
+    def flush(self):
+        """
+        fsyncs appends made with sync=False
+        """
+        with self._lock:
+            os.fsync(self._segment_file.fileno())
+            os.fsync(self._index_file.fileno())
+
+    def truncate(self, height):
+        """
+        Drops every block from height onwards, used when the chain is replaced
+
+        :param height: <int> Number of blocks to keep
+        """
+        with self._lock:
+            if height >= len(self._entries):
+                return
+            self._index_file.close()
+            self._segment_file.close()
+            self._segment_file = None
+            self._truncate_files(height)
+            del self._entries[height:]
+            self._index_file = open(self.index_path, 'ab')
+            self._open_segment(self._entries[-1][0] if self._entries else 0)
+
+    def hash_at(self, height):
+        """
+        :return: <str> Hex encoded hash of the block at height
+        """
+        return self._entries[height][3].hex()
+
+    def read(self, height):
+        """
+        :return: <bytes> The encoded block at height
+        """
+        segment, offset, length, _ = self._entries[height]
+        with open(self._segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            return f.read(length)[self.RECORD_HEADER.size:]
+
+    def __iter__(self):
+        """
+        Yields the encoded blocks in chain order, reading each segment sequentially
+        """
+        entries = list(self._entries)
+        f = None
+        segment = None
+        try:
+            for entry_segment, offset, length, _ in entries:
+                if entry_segment != segment:
+                    if f is not None:
+                        f.close()
+                    segment = entry_segment
+                    f = open(self._segment_path(segment), 'rb')
+                f.seek(offset)
+                yield f.read(length)[self.RECORD_HEADER.size:]
+        finally:
+            if f is not None:
+                f.close()
+
+    def close(self):
+        with self._lock:
+            self._index_file.close()
+            self._segment_file.close()
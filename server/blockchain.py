@@ -2,6 +2,7 @@ import base64
 import logging
 from time import time
 import threading
+from contextlib import contextmanager
 from ellipticcurve.ecdsa import Ecdsa
 from ellipticcurve import PublicKey , Signature
 from flask import request
@@ -9,6 +10,7 @@ from ellipticcurve.ecdsa import Ecdsa
 from ellipticcurve.privateKey import PrivateKey , PublicKey 
 import hashlib
 import json
+import os
 import time as t 
 from typing import Dict
 from urllib.parse import urlparse
@@ -21,53 +23,211 @@ import requests
 from account_db import AccountReader
 from nodeManager import NodeManager
 from database import BlockchainDb
+from pow_engine import ProofOfWorkEngine, search_nonces
+from ledger import BalanceLedger
+from signature_verifier import SignatureVerifier
+from broadcaster import BlockBroadcaster
+from block_index import BlockIndex
+from merkle import merkle_proof, merkle_root
+from chain_sync import ChainSync
+from mempool import Mempool
+from metrics import MetricsRegistry
+from chain_state import ChainState, writer
+from chain_validator import ChainValidator
+from peer_table import PeerTable
+from gossip import Gossip
+from ingest import TransactionIngest
+from address_index import AddressIndex
+from transport import HttpTransport, public_host
+from difficulty import (LEGACY_TARGET, RETARGET_INTERVAL, TARGET_BLOCK_INTERVAL, block_target, meets_target,
+                        median_time_past, retarget, work)
+
+logger = logging.getLogger(__name__)
 
 
 class Blockchain(object):
-    def __init__(self):
+    # Bootstrap nodes, never dropped from the node list
+    PRIMARY_NODES = [
+        "simplicity-server1",
+        "simplicity-server"
+    ]
+
+    def __init__(self, transport=None, database=None, primary_nodes=None, workers=None, scheduled_mining=True,
+                 target_block_interval=TARGET_BLOCK_INTERVAL, retarget_interval=RETARGET_INTERVAL):
         """
         Initialize the Blockchain
 
-        :param proof: <int> The proof given by the Proof of Work algorithm
-        :param previous_hash: (Optional) <str> Hash of previous Block
-        :return: <dict> New Block
+        :param transport: (Optional) How we talk to peers, an HttpTransport by default, see transport
+        :param database: (Optional) <BlockchainDb> Where the chain is kept, server/blocklog by default
+        :param primary_nodes: (Optional) <list> Bootstrap nodes, PRIMARY_NODES by default
+        :param workers: (Optional) <int> Worker processes for proof of work and signature batches, one per core by default
+        :param scheduled_mining: (Optional) <bool> Mine every minute, see start_scheduled_mining
+        :param target_block_interval: (Optional) <float> Seconds between blocks the difficulty is retargeted to.
+            A consensus rule, only change it for a network of its own, e.g. the simulator
+        :param retarget_interval: (Optional) <int> Blocks between two retargets, a consensus rule as well
         """
+        # Every change goes through write, readers use the published snapshot
+        self._write_lock = threading.RLock()
+        self._state = None
+        self._state_version = 0
         self.chain = []
-        self.current_transactions = []
-        self.hash_list = set()
-        self.nodes = set()
-        self.ttl : dict= {}
+        self.mempool = Mempool(self.transaction_id, max_count=10000, max_bytes=5000000)
+        self.block_index = BlockIndex()
+        # The known nodes and their TTLs, self.nodes and self.ttl are its views
+        self.peers = PeerTable(primary=self.PRIMARY_NODES if primary_nodes is None else primary_nodes,
+                               on_remove=self.forget_peer)
+        self.transport = transport or HttpTransport()
         self.public_address= ""
         self.private_address = ""
         self.ip_address = ""
-        self.target = 4  # Easy target value
+        # Difficulty is retargeted every retarget_interval blocks so blocks
+        # come target_block_interval seconds apart, see next_target
+        self.target_block_interval = target_block_interval
+        self.retarget_interval = retarget_interval
         self.max_block_size = 1000000  
         self.max_mempool  = 2
-        self.new_block( proof=100 , prev_hash =1  )
+        self.ledger = BalanceLedger()
+        self.signature_verifier = SignatureVerifier(workers=workers)
+        self.broadcaster = BlockBroadcaster(transport=self.transport)
         self.error = ""
-        database = BlockchainDb()
-        db_chain = database.load_blockchain(self )
-        
         self.mining_thread = None
         self.should_mine = False
+        self.pow_engine = ProofOfWorkEngine(self.valid_proof, workers=workers, kernel=search_nonces)
+        self.chain_sync = ChainSync(self)
+        self.gossip = Gossip(self)
+        self.chain_validator = ChainValidator(self)
+        self.metrics = MetricsRegistry()
+        self.register_metrics()
+        # Transactions from clients and peers are validated in the background
+        self.ingest = TransactionIngest(self)
+        self.database = database or BlockchainDb()
+        self.address_index = AddressIndex(self.transaction_id, self.database.address_index_path)
+        self.address_index.load()
+        db_chain = self.database.load_blockchain(self )
+        if not self.chain:
+            self.new_block( proof=100 , prev_hash =1  )
+        
         
         accountDb = AccountReader()
         accountDb.load_accounts()
         accounts_data = accountDb.account_data
-        print("accounts_data" , accounts_data)
+        logger.debug("Loaded %d accounts", len(accounts_data))
         for account in accounts_data:
             if account['publicKey']:
-                print("account['publicKey']" , account['publicKey'])
+                logger.debug("Using account %s", account['publicKey'])
                 self.public_address = account['publicKey']
             if account['privateKey']:
                 self.private_address = account['privateKey']
                 
+        # Blocks up to the checkpoint were validated before, only the blocks
+        # after it are validated and applied to the balances. Checkpoints are
+        # saved by the ChainValidator once it rehashed the whole chain
+        checkpoint = self.database.load_checkpoint() if db_chain else None
+        trusted = checkpoint['height'] + 1 if checkpoint else 0
         if db_chain:
-            self.chain = self.validate_loaded_chain()
-                
-        self.start_scheduled_mining()
+            valid_chain = self.validate_loaded_chain(trusted)
+            if len(valid_chain) < len(self.chain):
+                self.replace_chain(valid_chain, self.block_index.hashes[:len(valid_chain)])
+        if checkpoint and trusted <= len(self.chain):
+            self.ledger.rebuild(self.chain[trusted:], self.current_transactions, base=checkpoint['balances'])
+        else:
+            self.ledger.rebuild(self.chain, self.current_transactions)
+        # Only the blocks missing from the saved index are indexed
+        self.address_index.sync(self.chain, self.block_index.hashes)
+        self._publish()
+        # Rehash the chain in the background if the checkpoint is missing or far behind
+        if checkpoint:
+            self.chain_validator.checkpoint = (checkpoint['height'], checkpoint['tip_hash'])
+        self.chain_validator.catch_up()
+
+        if scheduled_mining:
+            self.start_scheduled_mining()
     def Blockchain(self , public_address):
         self.public_address = public_address
+
+    @property
+    def nodes(self):
+        """
+        <set> The known node ids, see PeerTable. Read it from the snapshot outside the writer
+        """
+        return self.peers.nodes
+
+    @nodes.setter
+    def nodes(self, nodes):
+        self.peers.load(nodes=nodes)
+
+    @property
+    def ttl(self):
+        """
+        <dict> Node id -> expiry time, see PeerTable
+        """
+        return self.peers.ttl
+
+    @ttl.setter
+    def ttl(self, ttl):
+        self.peers.load(ttl=ttl)
+
+    @contextmanager
+    def write(self):
+        """
+        The single writer path. Changes to the chain, the mempool, the nodes or
+        the TTL table run inside it one at a time, and a new snapshot is
+        published when they are done, so readers never need a lock.
+        """
+        with self._write_lock:
+            try:
+                yield
+            finally:
+                self._publish()
+
+    def _publish(self):
+        self._state_version += 1
+        nodes, ttl = self.peers.snapshot()
+        self._state = ChainState(
+            self._state_version, self.chain, self.block_index.hashes, self.block_index.heights,
+            nodes, ttl, self.mempool
+        )
+
+    @property
+    def snapshot(self):
+        """
+        <ChainState> The latest published state, safe to read from any thread
+        """
+        return self._state
+
+    def register_metrics(self):
+        """
+        Creates the metrics served on /metrics
+        """
+        metrics = self.metrics
+        self.mining_duration = metrics.histogram(
+            'blockchain_mining_duration_seconds', 'Time spent mining a block, proof of work included',
+            ['outcome'], buckets=(1, 5, 10, 30, 60, 120, 300, 600))
+        self.pow_attempts = metrics.histogram(
+            'blockchain_pow_attempts', 'Nonces tried until the proof of work was found',
+            buckets=(1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8))
+        self.broadcast_latency = metrics.histogram(
+            'blockchain_broadcast_latency_seconds',
+            'Time until a peer took an announcement or gave up on it, by kind: block or transaction',
+            ['kind', 'peer'], buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+        self.broadcast_failures = metrics.counter(
+            'blockchain_broadcast_failures_total',
+            'Announcements a peer could not be sent, by kind: block or transaction', ['kind', 'peer'])
+        self.signature_verification = metrics.histogram(
+            'blockchain_signature_verification_seconds', 'Time spent verifying transaction signatures',
+            ['mode'], buckets=(1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1, 5))
+        self.ingested_transactions = metrics.counter(
+            'blockchain_ingested_transactions_total', 'Submitted transactions by validation outcome', ['outcome'])
+        metrics.gauge('blockchain_ingest_queue', 'Transactions waiting for validation', function=lambda: len(self.ingest))
+        metrics.gauge('blockchain_mempool_transactions', 'Transactions waiting in the mempool', function=lambda: len(self.mempool))
+        metrics.gauge('blockchain_mempool_bytes', 'Size of the mempool transactions as JSON', function=lambda: self.mempool.size_bytes)
+        metrics.gauge('blockchain_chain_height', 'Number of blocks in our chain', function=lambda: len(self.chain))
+        metrics.gauge('blockchain_peers', 'Number of known nodes', function=lambda: len(self.nodes))
+        metrics.gauge('blockchain_ttl_entries', 'Number of entries in the TTL table', function=lambda: len(self.ttl))
+        metrics.gauge('blockchain_quarantined_peers', 'Known nodes skipped after failing in a row',
+                      function=lambda: self.peers.quarantined())
+        metrics.gauge('blockchain_validated_blocks', 'Blocks checked by the current or last background validation',
+                      function=lambda: self.chain_validator.validated)
     
     def create_coinbase_transaction(self, miner_address: str, reward: int = 50):
         """
@@ -109,27 +269,79 @@ class Blockchain(object):
     def generate_transaction_id(self , coinbase_tx):
         transaction_data = json.dumps(coinbase_tx, sort_keys=True)
         return hashlib.sha256(transaction_data.encode()).hexdigest()
+
+    def transaction_id(self, entry):
+        """
+        Returns the id of a block or mempool entry: the transaction_id stored in
+        the transaction (coinbase transactions have one), otherwise the id
+        generate_transaction_id gives the transaction
+
+        :param entry: <dict> Entry with a 'transaction' key
+        :return: <str>
+        """
+        transaction = entry['transaction']
+        return transaction.get('transaction_id') or self.generate_transaction_id(transaction)
+
+    def valid_transaction_id(self, transaction):
+        """
+        A transaction_id stored in a transaction must be the id of the rest of
+        it, so it cannot be kept while the transaction is changed. Coinbase
+        transactions get their id before the miner's public_address is added,
+        see create_coinbase_transaction
+
+        :param transaction: <dict> The transaction
+        :return: <bool> True if the transaction carries no id or the right one
+        """
+        stored = transaction.get('transaction_id')
+        if stored is None:
+            return True
+        fields = {key: value for key, value in transaction.items() if key not in ('transaction_id', 'public_address')}
+        return stored == self.generate_transaction_id(fields)
+
+    def merkle_leaf(self, entry):
+        """
+        :param entry: <dict> A block entry
+        :return: <str> Its Merkle leaf, the hash of the whole entry: the transaction with its signature and public key
+        """
+        return self.generate_transaction_id(entry)
+
+    def compute_merkle_root(self, transactions):
+        """
+        :param transactions: <list> The entries of a block
+        :return: <str> The Merkle root over their leaves, see merkle_leaf
+        """
+        return merkle_root([self.merkle_leaf(entry) for entry in transactions])
     
-    def validate_loaded_chain(self):
-        """Validate the loaded chain for integrity."""
-        for i in range(1, len(self.chain)):
+    def validate_loaded_chain(self, start=0):
+        """
+        Validate the loaded chain for integrity, using the hashes stored in the block index.
+
+        :param start: (Optional) <int> Number of blocks already validated, e.g. up to a checkpoint
+        """
+        for i in range(max(1, start), len(self.chain)):
             current_block = self.chain[i]
             previous_block = self.chain[i-1]
-            if current_block['previous_hash'] != self.hash(previous_block):
+            if current_block['previous_hash'] != self.block_index.hash_at(i-1):
+                return self.chain[:i-1]
+            if not self.valid_target(current_block, previous_block, self.next_target(self.chain.__getitem__, i)):
+                return self.chain[:i-1]
+            if not self.valid_timestamp(current_block, self.chain.__getitem__, i):
                 return self.chain[:i-1]
-            if not self.valid_proof(previous_block['proof'], current_block['proof'] , self.target):
+            if not self.valid_proof(previous_block['proof'], current_block['proof'] , block_target(current_block)):
                 return self.chain[:i-1]
             
         return self.chain    
-    def create_mining_reward(self, miners_address, block_height):
+    def create_mining_reward(self, miners_address, block_height, transactions=None):
         # Calculate the reward based on block height
         base_reward = 50  # Starting reward
         halving_interval = 210000  # Number of blocks between reward halvings
         halvings = block_height // halving_interval
         current_reward = base_reward / (2 ** halvings)
 
-        # Add a transaction fee reward
-        transaction_fees = sum(tx['transaction']['amount'] for tx in self.current_transactions if tx['transaction']['sender'] != "0")
+        # Add the fees of the transactions, their senders pay them, see BalanceLedger.spend
+        if transactions is None:
+            transactions = self.current_transactions
+        transaction_fees = sum(Mempool.fee(tx) for tx in transactions if tx['transaction']['sender'] != "0")
         total_reward = current_reward + transaction_fees
 
         # Create the coinbase transaction
@@ -152,8 +364,8 @@ class Blockchain(object):
         ip_address = self.cleanUrl(ip_address)
         self.ip_address = ip_address
         
-        # Get a random node
-        random_node = node_manager.get_random_node()
+        # The bootstrap node that answers first
+        random_node = node_manager.get_fastest_node(self.probe_node)
         nodes = node_manager.load_nodes()
         self.remove_expired_nodes()
         #clean the ip address
@@ -167,31 +379,37 @@ class Blockchain(object):
             data = {
                 "nodes": [ip_address]
             }
-            print(f"Registering node: {self.ip_address} to {random_node}...")
-
-            ## add .onrender.com or .trycloudflare.com
-            
-            random_node = self.addUrl(random_node)
-            
             # Register the node
-            print(f"Registering node: {self.ip_address} to {random_node}...")
+            logger.info("Registering node %s with %s", self.ip_address, random_node)
             
-            response = requests.post(f'http://{random_node}/nodes/register', json=data)
-            print()
+            response = self.transport.post(self.transport.url(random_node, '/nodes/register'), json=data)
             # Update TTL if needed
             if self.ttl:
-                requests.post(f'http://{random_node}/nodes/update_ttl', json={
+                self.transport.post(self.transport.url(random_node, '/nodes/update_ttl'), json={
                     "updated_nodes": self.ttl,
                     "node": ip_address
                 })
     
+    def probe_node(self, node, timeout=5):
+        """
+        Asks a node for /hello and records how long it took in the peer table
+
+        :param node: <str> The node
+        :param timeout: (Optional) <int> Timeout in seconds
+        :return: <float> The latency in seconds, raises RequestException if the node did not answer
+        """
+        started = time()
+        try:
+            self.transport.get(self.transport.url(node, '/hello'), timeout=timeout).raise_for_status()
+        except requests.exceptions.RequestException:
+            self.peers.record_failure(node)
+            raise
+        latency = time() - started
+        self.peers.record_success(node, latency)
+        return latency
+
     def addUrl(self, url : str ):
-        if "simplicity" in url :
-            if not url.endswith(".onrender.com"):
-                url = url + ".onrender.com"
-        else:
-            url = url + ".trycloudflare.com"
-        return url
+        return public_host(url)
     
     
     def cleanUrl(self , url : str ):
@@ -220,46 +438,45 @@ class Blockchain(object):
 
         In the context of the original code snippet, `netloc` is used to extract the node's network location (i.e., its hostname or IP address) from the URL.
         """
-        self.remove_expired_nodes()
-
-        # parsed_url = urlparse(address) testing
-        if neighbor_url not in self.nodes:
-            self.nodes.add(neighbor_url)
+        with self.write():
+            self.remove_expired_nodes()
+            self.peers.add(neighbor_url)
+        state = self.snapshot
         
         # clean the url
         current_url = self.cleanUrl(current_address)
         
-        # add .onrender.com or .trycloudflare.com
-        neighbor_url = self.addUrl(neighbor_url)
-        
-        requests.post(f'http://{neighbor_url}/nodes/update_chain' , json=[self.chain , current_url , list(self.hash_list) , list(self.nodes)])
-        requests.post(f'http://{neighbor_url}/nodes/update_nodes' , json={
-            "nodes": list(self.nodes)
+        transport = self.transport
+        transport.post(transport.url(neighbor_url, '/nodes/update_chain') , json={
+            "chain": list(state.chain),
+            "hash_list": list(state.hashes)
         })
-        if self.ttl:
-            requests.post(f'http://{neighbor_url}/nodes/update_ttl' , json={
-                    "updated_nodes": self.ttl,
+        transport.post(transport.url(neighbor_url, '/nodes/update_nodes') , json={
+            "nodes": list(state.nodes)
+        })
+        if state.ttl:
+            transport.post(transport.url(neighbor_url, '/nodes/update_ttl') , json={
+                    "updated_nodes": dict(state.ttl),
                     "node" : current_url
                 })
         
+    def add_nodes(self, nodes):
+        """
+        :param nodes: <list> Nodes to add to the known nodes
+        """
+        with self.write():
+            for node in nodes:
+                self.peers.add(node)
+
+    def remove_node(self, node):
+        with self.write():
+            self.peers.discard(node)
+
+    @writer
     def remove_expired_nodes(self):
-        primary_node = [
-            "simplicity-server1",
-            "simplicity-server"
-        ]
-        if self.ttl:
-            # Iterate over a copy of the set to avoid modifying it while iterating
-            for node in list(self.nodes):
-                if node in primary_node:
-                    continue
-                
-                if node not in self.ttl:
-                    self.nodes.remove(node)
-                    continue
-                if self.ttl[node] < time():
-                    self.nodes.remove(node)
-                    #also remove from ttl
-                    self.ttl.pop(node)
+        # Only the nodes whose TTL has passed are looked at, see PeerTable.expire
+        for node in self.peers.expire():
+            logger.debug("Node %s expired", node)
 
         
     def verify_block(self , block: Dict, previous_block: Dict, target: int, max_block_size: int , isCoinbase) -> bool:
@@ -268,184 +485,193 @@ class Blockchain(object):
 
         :param block: The block to verify
         :param previous_block: The previous block in the chain
-        :param target: The current mining difficulty target
+        :param target: The target the block must carry, see next_target
         :param max_block_size: The maximum allowed block size in bytes
         :return: True if the block is valid, False otherwise
         """
         # Check block structure
         required_keys = ['index', 'timestamp', 'transactions', 'proof', 'previous_hash']
         if not all(key in block for key in required_keys):
-            print("Invalid block structure")
+            logger.warning("Invalid block structure")
+            return False
+
+        if not self.valid_target(block, previous_block, target):
+            logger.warning("Block target does not match the retargeted difficulty")
             return False
 
         # Verify block header hash
-        if self.valid_proof(previous_block['proof'], block['proof'], target) is False:
-            print("Block hash does not meet the target difficulty")
+        if self.valid_proof(previous_block['proof'], block['proof'], block_target(block)) is False:
+            logger.warning("Block hash does not meet the target difficulty")
             return False
 
         # Check timestamp
         current_time = int(time())
         if block['timestamp'] > current_time + 7200:  # 2 hours in the future
-            print("Block timestamp is too far in the future")
+            logger.warning("Block timestamp is too far in the future")
+            return False
+        if not self.valid_timestamp(block, self.chain.__getitem__, len(self.chain)):
+            logger.warning("Block timestamp is not after the median time of the blocks before it")
             return False
 
         # Check block size
         block_size = len(str(block).encode())
         if block_size > max_block_size:
-            print(f"Block size ({block_size} bytes) exceeds maximum allowed size ({max_block_size} bytes)")
+            logger.warning("Block size (%d bytes) exceeds maximum allowed size (%d bytes)", block_size, max_block_size)
             return False
 
         # Verify previous block hash
-        if block['previous_hash'] != self.hash(previous_block):
-            print("Previous block hash is incorrect")
+        if block['previous_hash'] != self.block_hash(previous_block):
+            logger.warning("Previous block hash is incorrect")
+            return False
+
+        # Verify the Merkle root, blocks from before Merkle roots do not carry one
+        if 'merkle_root' in block and not self.valid_merkle_root(block):
+            logger.warning("Merkle root does not match the block transactions")
             return False
 
         # Check that the first transaction is a coinbase transaction
         if not block['transactions'] or  block['transactions'][0]['transaction']['sender'] != "0":
-            print("First transaction is not a coinbase transaction")
+            logger.warning("First transaction is not a coinbase transaction")
+            return False
+
+        # Every sender must be able to pay at its point of the block, blocks
+        # from peers were not checked by our mempool. previous_block is our tip
+        if not self.ledger.funds(block):
+            logger.warning("A transaction in the block spends more than its sender has")
             return False
 
         # Verify all transactions in the block
+        # The signatures are checked in one batch and mostly come from the cache
         if not isCoinbase:
-            for tx in block['transactions'][1:]:  # Skip the coinbase transaction
-                if not self.valid_transaction(tx):
-                    print(f"Invalid transaction found: {tx}")
-                    return False
+            if not self.verify_transaction_signatures(block['transactions'][1:]):  # Skip the coinbase transaction
+                logger.warning("Invalid transaction signature found in block")
+                return False
 
         return True
 
-    def new_block(self, proof, prev_hash, isCoinbase=False, coinbase_transaction=None, miner_address=None):
+    def valid_next_block(self, block, block_hash):
+        """
+        Checks a block a peer sent us before it is appended: it must hash to
+        block_hash, extend our tip and pass verify_block. Call it on the writer,
+        so the tip does not move between the check and the append.
+
+        :param block: <dict> The block
+        :param block_hash: <str> The hash the block was announced or looked up by
+        :return: <bool>
         """
-        Creates a new block in the blockchain with retry logic for failed node communications.
+        try:
+            if self.hash(block) != block_hash or block.get('previous_hash') != self.block_index.tip_hash:
+                return False
+            return self.verify_block(block, self.last_block, self.target, self.max_block_size, False)
+        except (KeyError, TypeError, ValueError, AttributeError, IndexError) as e:
+            logger.warning("Malformed block %s: %s", block_hash, e)
+            return False
+
+    @writer
+    def new_block(self, proof, prev_hash, isCoinbase=False, coinbase_transaction=None, miner_address=None, transactions=None):
+        """
+        Creates a new block in the blockchain and broadcasts it to the known nodes in the background.
 
         :param proof: <int> The proof provided by the Proof of Work algorithm.
         :param prev_hash: (Optional) <str> Hash of the previous block in the chain.
         :param isCoinbase: (Optional) <bool> Flag to indicate if this block contains a coinbase transaction.
         :param coinbase_transaction: (Optional) <dict> Coinbase transaction details.
         :param miner_address: (Optional) <str> The address of the miner who found the proof of work.
+        :param transactions: (Optional) <list> Mempool transactions to include, defaults to the whole mempool.
         :return: <dict> The newly created block.
         """
-        print(f"Creating new block with proof: {proof} and previous hash: {prev_hash}")
+        logger.debug("Creating new block with proof %s and previous hash %s", proof, prev_hash)
         
-        transactions = [coinbase_transaction] + self.current_transactions
+        if transactions is None:
+            transactions = self.current_transactions
+        transactions = ([coinbase_transaction] if coinbase_transaction else []) + transactions
+        target = self.target
         block = {
             "index": len(self.chain) + 1,
             "timestamp": time(),
-            "transactions": transactions or [],
+            "transactions": transactions,
+            "merkle_root": self.compute_merkle_root(transactions),
             "proof": proof,
-            "previous_hash": prev_hash or self.chain[len(self.chain) - 1]["hash"]
+            "previous_hash": prev_hash or self.block_index.tip_hash,
+            "target": target
         }
 
-        print(f"Block before verification: {block}")
+        logger.debug("Block before verification: %s", block)
         
-        if self.chain and not self.verify_block(block, self.chain[-1], self.target, self.max_block_size, isCoinbase):
-            print("Invalid block")
+        if self.chain and not self.verify_block(block, self.chain[-1], target, self.max_block_size, isCoinbase):
+            logger.warning("Invalid block at height %d", len(self.chain))
             return False
 
-        self.chain.append(block)
-        print(f"Block added to chain: {block}")
-        
-        hashed_block = self.hash(block)
-        self.hash_list.add(hashed_block)
-        print(f"Hashed block: {hashed_block}")
+        hashed_block = self.append_block(block)
+        logger.info("Block %s added at height %d with %d transactions", hashed_block, len(self.chain) - 1, len(transactions))
         
         self.remove_expired_nodes()
-        print(f"Broadcasting to nodes: {list(self.nodes)}")
+        logger.debug("Broadcasting to nodes: %s", self.nodes)
 
-        # Update nodes based on TTL
-        for node, ttl in list(self.ttl.items()):
-            if ttl > time():
-                self.nodes.add(node)
-        
-        # Track nodes to remove
-        nodes_to_remove = set()
-
-        # Process each node with retry logic
-        for node in list(self.nodes):
-            node = self.addUrl(node)
-            success = False
-            retries = 2  # Number of attempts to make
-            
-            # Try to send block update
-            for attempt in range(retries):
-                try:
-                    print(f"Attempt {attempt + 1} - Sending block to node: {node}")
-                    response = requests.post(
-                        f'http://{node}/nodes/update_block',
-                        json=block,
-                        timeout=5  # Add timeout to prevent hanging
-                    )
-                    
-                    if response.status_code == 200:
-                        success = True
-                        print(f"Successfully updated node {node} on attempt {attempt + 1}")
-                        break
-                    else:
-                        print(f"Failed attempt {attempt + 1} for node {node}. Status code: {response.status_code}")
-                        
-                except requests.exceptions.RequestException as e:
-                    print(f"Request failed on attempt {attempt + 1} for node {node}: {str(e)}")
-                    
-                if attempt < retries - 1:
-                    print(f"Retrying node {node} in 2 seconds...")
-                    t.sleep(2)  # Wait before retry
-            
-            # If all attempts failed, mark node for removal
-            if not success:
-                print(f"All attempts failed for node {node}. Marking for removal.")
-                nodes_to_remove.add(node)
-                continue
-            
-            # Try to update TTL if needed
-            if self.ttl and success:
-                ttl_success = False
-                for attempt in range(retries):
-                    try:
-                        print(f"Attempt {attempt + 1} - Updating TTL for node: {node}")
-                        ttl_response = requests.post(
-                            f'http://{node}/nodes/update_ttl',
-                            json={
-                                "updated_nodes": self.ttl,
-                                "node": self.ip_address
-                            },
-                            timeout=5
-                        )
-                        
-                        if ttl_response.status_code == 200:
-                            ttl_success = True
-                            print(f"Successfully updated TTL for node {node} on attempt {attempt + 1}")
-                            break
-                        else:
-                            print(f"Failed TTL update attempt {attempt + 1} for node {node}")
-                            
-                    except requests.exceptions.RequestException as e:
-                        print(f"TTL update failed on attempt {attempt + 1} for node {node}: {str(e)}")
-                    
-                    if attempt < retries - 1:
-                        print(f"Retrying TTL update for node {node} in 2 seconds...")
-                        t.sleep(2)
-                
-                # If TTL update failed after all retries, mark node for removal
-                if not ttl_success:
-                    print(f"All TTL update attempts failed for node {node}. Marking for removal.")
-                    nodes_to_remove.add(node)
-
-        # Remove failed nodes from both nodes set and TTL dictionary
-        for node in nodes_to_remove:
-            print(f"Removing failed node: {node}")
-            self.nodes.discard(node)
-            if node in self.ttl:
-                del self.ttl[node]
-        
-        self.current_transactions = []
-        print("Transactions reset after block creation.")
+        # Announce the block, then send our TTLs, to fanout healthy nodes at
+        # once. Failures are recorded once all deliveries are done, mining
+        # does not wait for it
+        self.gossip.announce_block(hashed_block, block, ttl=dict(self.ttl))
+
+        # The block is in the block log already, the state is saved again on the next change
+        try:
+            self.database.save_state(self)
+        except OSError as e:
+            logger.error("Could not save the node state: %s", e)
         
         return block
             
 
+    def broadcast_complete(self, result, kind='block'):
+        """
+        Records the latency and failures of a broadcast per peer, in the
+        metrics and the peer table, then drops the peers that keep failing
+
+        :param result: <BroadcastResult> The outcome of the broadcast
+        :param kind: (Optional) <str> What was announced, block or transaction
+        """
+        for node, latency in result.latencies.items():
+            self.broadcast_latency.observe(latency, kind=kind, peer=node)
+        for node in result.succeeded:
+            self.peers.record_success(node, result.latencies[node])
+        for node in result.failed:
+            self.broadcast_failures.inc(kind=kind, peer=node)
+            self.peers.record_failure(node)
+        self.remove_failed_nodes(result)
+
+    def forget_peer(self, node):
+        """
+        Drops the metric series of a node that left the node list, so they do not pile up as peers come and go
+
+        :param node: <str> The node id
+        """
+        for kind in ('block', 'transaction'):
+            self.broadcast_latency.remove(kind=kind, peer=node)
+            self.broadcast_failures.remove(kind=kind, peer=node)
+
+    @writer
+    def remove_failed_nodes(self, result):
+        """
+        Removes the nodes that failed too many times in a row from both nodes
+        and the TTL table. Nodes that failed fewer times are quarantined by
+        the peer table and skipped until their quarantine ends.
+
+        :param result: <BroadcastResult> The outcome of the broadcast
+        """
+        for node in result.succeeded:
+            logger.debug("Successfully updated node %s", node)
+        for node, reason in result.failed.items():
+            if not self.peers.failing(node):
+                logger.info("Node %s failed (%s)", node, reason)
+                continue
+            logger.warning("Removing failed node %s (%s)", node, reason)
+            self.peers.discard(node)
+
+    @writer
     def updateTTL(self, updated_nodes: dict, neighbor_node: str):
         """
-        Remove nodes from ttl that have timed out and update TTLs for nodes.
+        Update the TTLs of nodes, each node keeps the latest TTL it was given,
+        then remove the nodes that have timed out.
         
         :param updated_nodes: A dictionary of nodes and their corresponding TTLs
         :type updated_nodes: dict
@@ -453,104 +679,54 @@ class Blockchain(object):
         :type neighbor_node: str
         """
         try:
-            # Helper function to clean and normalize node strings
-            def clean_node(node):
-                if isinstance(node, str):
-                    parsed = urlparse(node)
-                    netloc = parsed.netloc or parsed.path
-                    # Remove .trycloudflare.com suffix if present
-                    netloc = netloc.replace('.trycloudflare.com', '')
-                    # Remove port if present
-                    netloc = netloc.split(':')[0]
-                    # Remove local URLs
-                    if netloc in ['localhost', '127.0.0.1'] or netloc.startswith('192.168.') or netloc.startswith('10.'):
-                        return None
-                    return netloc
-                return None  # Return None for non-string objects
-            #add node and coressponding ttl if not exsists already
-            print(f"Current TTL count: {len(self.ttl)}")
-            if self.ttl == "":
-                self.ttl = {}
+            peers = self.peers
+            logger.debug("Current TTL count: %d", len(self.ttl))
+            # Local addresses are only reachable by the node that sent them
             for node, ttl in updated_nodes.items():
-                node_cleaned = clean_node(node)
-                if node_cleaned not in self.ttl:
-                    self.ttl[node_cleaned] = ttl
-                if node_cleaned not in self.nodes:
-                    self.nodes.add(node_cleaned)
+                node_id = peers.normalize(node)
+                if node_id and peers.routable(node_id):
+                    peers.set_ttl(node_id, ttl)
 
-            print(f"Updated TTL count: {len(self.ttl)}")
-            
-            # Clean the neighbor_node
-            neighbor_node_cleaned = clean_node(neighbor_node)
-            current_time = 0
-            if neighbor_node_cleaned:
-                print(f"Updating TTL for neighbor node: {neighbor_node_cleaned}")
-                current_time = time()
-
-                # Update TTL for the neighbor node
-                self.ttl[neighbor_node_cleaned] = current_time + 600
-
-            # Remove nodes with expired TTLs and clean existing keys
-            new_ttl = {}
-            for node, ttl in self.ttl.items():
-                cleaned_node = clean_node(node)
-                if cleaned_node and ttl >= current_time:
-                    new_ttl[cleaned_node] = ttl
-            self.ttl = new_ttl
-
-            # Update TTLs for nodes in updated_nodes
-            for node, ttl in updated_nodes.items():
-                node_cleaned = clean_node(node)
-                if node_cleaned:
-                    self.ttl[node_cleaned] = max(self.ttl.get(node_cleaned, 0), ttl)
+            neighbor_id = peers.normalize(neighbor_node)
+            if neighbor_id and peers.routable(neighbor_id):
+                logger.debug("Updating TTL for neighbor node %s", neighbor_id)
+                peers.touch(neighbor_id)
 
-            print(f"TTL update completed. Current TTL count: {len(self.ttl)}")
+            peers.expire()
+            logger.debug("TTL update completed. Current TTL count: %d", len(self.ttl))
 
-        except Exception as e:
-            print(f"Error in updateTTL: {str(e)}")
+        except Exception:
+            logger.exception("Error in updateTTL")
 
 
-    def new_transaction(self, transaction ,  public_address , digital_signature):
-        try:
-            print("senders key" , transaction["sender"])
-            sender = PublicKey.fromCompressed(transaction["sender"])
-        except:
-            self.error = "Transaction will not be added to Block due to invalid sender address"
-            return None, self.error
-        try:
-            recipient = PublicKey.fromCompressed(transaction["recipient"])
-        except:
-            self.error = "Transaction will not be added to Block due to invalid recipient address"
-            return None, self.error
-        
-        if self.valid_transaction(transaction  , public_address , digital_signature) :
-            self.current_transactions.append({
-                "transaction": transaction,
-                "public_address": public_address,
-                "digital_signature": digital_signature
-            })
-            self.miner()
-            # send transactions to the known nodes in the network
-            self.remove_expired_nodes()
-            
-            
-            for node in self.nodes:
-                node = self.addUrl(node)
-                requests.post(f'http://{node}/nodes/update_transaction', json={
-                "transaction": transaction,
-                "public_address": public_address,
-                "digital_signature": digital_signature
-            })
-            
-                if self.ttl:
-                    requests.post(f'http://{node}/nodes/update_ttl' , json={
-                        "updated_nodes": self.ttl,
-                        "node" : self.ip_address
-                    })
-            return self.last_block['index'] + 1, "Successful Transaction"
-        else:
-            return None, self.error
-            
+    @writer
+    def add_pending_transaction(self, entry):
+        """
+        Adds a transaction to the mempool and its deltas to the pending balances
+
+        :param entry: <dict> Transaction with its public address and digital signature
+        :return: <bool> False if the transaction was already pending or did not fit in the mempool
+        """
+        added, evicted = self.mempool.add(entry)
+        if added:
+            self.ledger.add_pending(entry)
+        for evicted_entry in evicted:
+            self.ledger.remove_pending(evicted_entry)
+        return added
+
+    @property
+    def current_transactions(self):
+        """
+        The pending transactions in arrival order, see Mempool
+        """
+        return list(self.mempool)
+
+    @current_transactions.setter
+    @writer
+    def current_transactions(self, entries):
+        self.mempool.clear()
+        for entry in entries:
+            self.mempool.add(entry)
 
     def start_scheduled_mining(self):
         schedule.every(1).minutes.do(self.scheduled_mine)
@@ -570,55 +746,288 @@ class Blockchain(object):
         if not self.should_mine:
             return
         miners_address = self.public_address
+        # Taken before the tip is read, a cancel_mining from here on stops the search
+        token = self.pow_engine.token()
         last_block = self.last_block
         last_proof = last_block['proof']
-        proof = self.proof_of_work(last_proof)
+        proof = self.proof_of_work(last_proof, self.target, token)
+        if proof is None or self.last_block is not last_block:
+            logger.info("Chain tip moved while mining, dropping the stale proof")
+            return
         block_height = len(self.chain)
 
-        total_reward, coinbase_tx = self.create_mining_reward(miners_address, block_height)
-        previous_hash = self.hash(last_block)
+        # Highest fee first, leaving room in the block for the header and coinbase.
+        # Pending credits are spendable, so a transaction goes in only after
+        # the transactions that fund it
+        transactions = self.mempool.select(max_bytes=int(self.max_block_size * 0.9), balance=self.ledger.confirmed_balance)
+        total_reward, coinbase_tx = self.create_mining_reward(miners_address, block_height, transactions)
+        previous_hash = self.block_hash(last_block)
         self.public_address
-        self.new_block(proof, previous_hash, True, coinbase_tx   , self.public_address)
+        return self.new_block(proof, previous_hash, True, coinbase_tx   , self.public_address, transactions)
         
     def mine_with_timer(self):
         start_time = time()
-        self.mine()
+        block = self.mine()
         end_time = time()
-        print(f"Mining took {end_time - start_time} seconds")
+        self.mining_duration.observe(end_time - start_time, outcome='mined' if block else 'dropped')
+        logger.info("Mining took %.2f seconds", end_time - start_time)
         self.should_mine = False
 
 
     def miner(self):
-        if len(self.current_transactions) >= self.max_mempool or len(self.current_transactions) >= self.max_block_size:
+        if len(self.mempool) >= self.max_mempool or len(self.mempool) >= self.max_block_size:
             self.should_mine = True
             if not self.mining_thread or not self.mining_thread.is_alive():
                 self.mining_thread = threading.Thread(target=self.mine_with_timer)
                 self.mining_thread.start()
         
-    def valid_transaction(self, transaction , public_address , digital_signature):
-        # Verify the transaction signature
-        if not self.verify_digital_signature(transaction , public_address , digital_signature): 
-            self.error = "Transaction will not be added to Block due to invalid signature"
-            return False
-
-        # Check if the sender has enough coins
-        sender_balance = self.check_balance(transaction)
-        if sender_balance:
-            return True
-        else:
-            self.error = "Transaction will not be added to Block due to insufficient funds"
-            return False
     @staticmethod
     def hash(block):
         
         # Creates a SHA-256 hash of a Block
+        # Blocks with a Merkle root are identified by their header alone, the
+        # root commits to the transactions. Older blocks hash the whole block
         
         # :param block: Block
         # :return: <str>
         
+        if 'merkle_root' in block:
+            block = Blockchain.header(block)
         block_string = json.dumps(block, sort_keys=True).encode()
         return hashlib.sha256(block_string).hexdigest()
 
+    @staticmethod
+    def header(block):
+        """
+        Returns the block without its transactions
+
+        :param block: <dict> Block
+        :return: <dict> Header
+        """
+        return {key: value for key, value in block.items() if key != 'transactions'}
+
+    def valid_merkle_root(self, block):
+        """
+        :param block: <dict> A block with a Merkle root
+        :return: <bool> True if the root matches the transactions, their stored ids match them and no
+                 transaction is in the block twice. The tree pairs an odd node with itself, so a block
+                 with its last transactions repeated would otherwise have the same root
+        """
+        try:
+            transaction_ids = [self.transaction_id(entry) for entry in block['transactions']]
+            if len(set(transaction_ids)) != len(transaction_ids):
+                return False
+            if not all(self.valid_transaction_id(entry['transaction']) for entry in block['transactions']):
+                return False
+            return block['merkle_root'] == self.compute_merkle_root(block['transactions'])
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return False
+
+    def find_transaction(self, transaction_id, state=None):
+        """
+        Looks up a confirmed transaction in the address index
+
+        :param transaction_id: <str> The transaction id
+        :param state: (Optional) <ChainState> The snapshot to look in, the current one by default
+        :return: <tuple> (height, position) of the transaction in the snapshot, or None
+        """
+        state = state or self.snapshot
+        location = self.address_index.location(transaction_id)
+        if location is None or location[0] >= state.height:
+            return None
+        height, position = location
+        transactions = state.chain[height]['transactions']
+        # A reorg can move the transaction after the snapshot was taken
+        if position >= len(transactions) or self.transaction_id(transactions[position]) != transaction_id:
+            return None
+        return location
+
+    def transaction_proof(self, transaction_id):
+        """
+        Builds the Merkle inclusion proof of a confirmed transaction, from one
+        snapshot so the block and its hash match
+
+        :param transaction_id: <str> The transaction id
+        :return: <dict> The block header and hash, and the proof, or None if the
+                 transaction is unknown or its block has no Merkle root
+        """
+        state = self.snapshot
+        location = self.find_transaction(transaction_id, state)
+        if location is None:
+            return None
+        height, position = location
+        block = state.chain[height]
+        if 'merkle_root' not in block:
+            return None
+        leaves = [self.merkle_leaf(entry) for entry in block['transactions']]
+        return {
+            'transaction_id': transaction_id,
+            'height': height,
+            'position': position,
+            'block_hash': state.hashes[height],
+            'header': self.header(block),
+            'transaction': block['transactions'][position],
+            'leaf': leaves[position],
+            'proof': merkle_proof(leaves, position)
+        }
+
+    @property
+    def hash_list(self):
+        """
+        The hashes of the blocks in our chain, see BlockIndex
+        """
+        return self.block_index
+
+    def block_hash(self, block):
+        """
+        Returns the hash of a block, taken from the block index when the block
+        is the tip of our chain instead of serializing it again
+
+        :param block: <dict> Block
+        :return: <str>
+        """
+        if self.chain and self.chain[-1] is block and len(self.block_index) == len(self.chain):
+            return self.block_index.tip_hash
+        return self.hash(block)
+
+    @writer
+    def append_block(self, block, block_hash=None):
+        """
+        Appends a block to our chain, indexes its hash, applies it to the
+        balances and writes it to the block log
+
+        :param block: <dict> A block extending our chain
+        :param block_hash: (Optional) <str> The hash of the block, if the caller already has it
+        :return: <str> The hash of the block
+        """
+        block_hash = block_hash or self.hash(block)
+        if block_hash in self.block_index:
+            # Another thread appended it first
+            return block_hash
+        self.chain.append(block)
+        self.block_index.append(block_hash)
+        self.address_index.append(block, block_hash, len(self.chain) - 1)
+        self.ledger.apply_block(block)
+        for entry in self.mempool.remove_confirmed(block):
+            self.ledger.remove_pending(entry)
+        self.database.sync_chain(self)
+        self.chain_validator.catch_up()
+        return block_hash
+
+    @writer
+    def replace_chain(self, chain, hashes=None):
+        """
+        Replaces our chain, e.g. with a longer valid chain from a neighbour
+
+        :param chain: <list> The new chain
+        :param hashes: (Optional) <list> The hashes of its blocks, if the caller already has them
+        """
+        self.chain = chain
+        self.block_index.rebuild(hashes if hashes is not None else [self.hash(block) for block in chain])
+        self.address_index.sync(self.chain, self.block_index.hashes)
+        self.ledger.rebuild(self.chain, self.current_transactions)
+        self.database.sync_chain(self)
+        self.cancel_mining()
+
+    @writer
+    def reorganize(self, height, blocks, hashes):
+        """
+        Replaces our blocks from height onwards, so the work done is
+        proportional to the number of blocks that change
+
+        :param height: <int> Height of the first replaced block
+        :param blocks: <list> The blocks replacing them
+        :param hashes: <list> The hashes of those blocks
+        :return: <bool> False if our chain changed since the blocks were checked,
+                 so they no longer attach at height or no longer add work
+        """
+        if height > len(self.chain):
+            return False
+        if height > 0 and blocks and blocks[0]['previous_hash'] != self.block_index.hash_at(height - 1):
+            return False
+        if self.chain_work(blocks) <= self.chain_work(self.chain[height:]):
+            return False
+        for block in reversed(self.chain[height:]):
+            self.ledger.revert_block(block)
+        self.chain = self.chain[:height] + list(blocks)
+        self.block_index.truncate(height)
+        self.address_index.truncate(height)
+        for block, block_hash in zip(blocks, hashes):
+            self.block_index.append(block_hash)
+            self.address_index.append(block, block_hash, len(self.block_index) - 1)
+            self.ledger.apply_block(block)
+            for entry in self.mempool.remove_confirmed(block):
+                self.ledger.remove_pending(entry)
+        self.database.sync_chain(self)
+        self.cancel_mining()
+        self.chain_validator.catch_up()
+        return True
+
+    def block_work(self, header):
+        """
+        Expected number of hashes needed to find the proof of a block
+        """
+        return work(block_target(header))
+
+    @property
+    def target(self):
+        """
+        <int> The target of the next block on our chain
+        """
+        chain = self.chain
+        return self.next_target(chain.__getitem__, len(chain))
+
+    def next_target(self, block_at, height):
+        """
+        The target the block at a height must carry: the target of the block
+        before it, retargeted every retarget_interval blocks by how long the
+        last interval took against target_block_interval per block.
+
+        :param block_at: <callable> Returns our or the candidate block at a lower height
+        :param height: <int> Height of the block
+        :return: <int>
+        """
+        if height == 0:
+            return LEGACY_TARGET
+        previous = block_at(height - 1)
+        target = block_target(previous)
+        interval = self.retarget_interval
+        if height % interval or height <= interval:
+            return target
+        first = block_at(height - 1 - interval)
+        return retarget(target, previous['timestamp'] - first['timestamp'], interval * self.target_block_interval)
+
+    @staticmethod
+    def valid_timestamp(block, block_at, height):
+        """
+        :param block: <dict> Block or block header
+        :param block_at: <callable> Returns our or the candidate block at a lower height
+        :param height: <int> Height of the block
+        :return: <bool> True if the block is timestamped after the median time past, see difficulty
+        """
+        median = median_time_past(block_at, height)
+        return median is None or block['timestamp'] > median
+
+    @staticmethod
+    def valid_target(block, previous_block, target):
+        """
+        :param block: <dict> Block or block header
+        :param previous_block: <dict> The block before it, None for the first block
+        :param target: <int> The target the block must carry, see next_target
+        :return: <bool>
+        """
+        if 'target' not in block:
+            # Blocks from before retargeting, until the first block with a target
+            return previous_block is None or 'target' not in previous_block
+        return block['target'] == target
+
+    def chain_work(self, headers):
+        """
+        :param headers: <list> Blocks or block headers
+        :return: <int> The total work behind them
+        """
+        return sum(self.block_work(header) for header in headers)
+
 
 
 
@@ -641,27 +1050,13 @@ class Blockchain(object):
             # Convert transaction to JSON with sorted keys
             transaction_json = json.dumps(transaction, sort_keys=True)
 
-            # Create PublicKey object
-            try:
-                print("Compressed public key: ", compressed_public_key)
-                public_address = PublicKey.fromCompressed(compressed_public_key)
-                print("public key: ", compressed_public_key)
-            except ValueError as e:
-                print("Invalid compressed public key: ", e)
-                raise ValueError(f"Invalid compressed public key: {e}")
-
-            # Create Signature object
-            try:
-                digital_signature = Signature.fromBase64(digital_signature_base64)
-            except (ValueError, base64.binascii.Error) as e:
-                raise ValueError(f"Invalid digital signature: {e}")
-            print(
-                f"Transaction: {transaction_json}\n"
-                f"Public key: {public_address}\n"
-                f"Digital signature: {digital_signature}"
-            )
-            # Verify the signature
-            is_valid = Ecdsa.verify(transaction_json, digital_signature, public_address)
+            logger.debug("Verifying transaction %s with public key %s and signature %s",
+                         transaction_json, compressed_public_key, digital_signature_base64,
+                         extra={'sample': 'signature'})
+            # Verify the signature, the parsed key and the result are cached
+            # and invalid keys or signatures raise ValueError
+            with self.signature_verification.time(mode='single'):
+                is_valid = self.signature_verifier.verify(transaction_json, compressed_public_key, digital_signature_base64)
 
             if not is_valid:
                 raise SignatureVerificationError("Signature verification failed")
@@ -669,15 +1064,32 @@ class Blockchain(object):
             return True
 
         except ValueError as e:
-            logging.error(f"Input validation error: {e}")
+            logger.error("Input validation error: %s", e)
             return False
         except SignatureVerificationError as e:
-            logging.error(f"Signature verification failed: {e}")
+            logger.error("Signature verification failed: %s", e)
             return False
         except Exception as e:
-            logging.error(f"Unexpected error in verify_digital_signature: {e}")
+            logger.exception("Unexpected error in verify_digital_signature")
             return False
 
+    def verify_transaction_signatures(self, transactions):
+        """
+        Verifies the signatures of many transactions in one batch
+
+        :param transactions: <list> Block or mempool entries, coinbase transactions excluded
+        :return: <bool> True if every signature is valid
+        """
+        items = []
+        for tx in transactions:
+            public_key = tx.get('public_address') or tx.get('public_key')
+            if not isinstance(public_key, str) or not isinstance(tx.get('digital_signature'), str):
+                return False
+            items.append((json.dumps(tx['transaction'], sort_keys=True), public_key, tx['digital_signature']))
+        with self.signature_verification.time(mode='batch'):
+            results = self.signature_verifier.verify_batch(items)
+        return all(results)
+
     def sign_transaction(self, transaction):
         message = json.dumps(transaction, sort_keys=True)
         private_key = PrivateKey.fromString(self.private_address)
@@ -695,17 +1107,27 @@ class Blockchain(object):
         return self.chain[-1]
     
     
-    def proof_of_work(self , last_proof):
+    def proof_of_work(self , last_proof, target=None, token=None):
         
-        # Finds a number p' such that hash(pp') contains 4 leading zeroes
+        # Finds a number p' such that hash(pp') is below the target
+        # The nonce space is searched on a process pool, see ProofOfWorkEngine
 
         # :param last_proof: <int>
-        # :return: <int> A number p'
-        proof = 0
-        while self.valid_proof(last_proof , proof , self.target) is False:
-            proof += 1
+        # :param target: (Optional) <int> Defaults to the target of the next block
+        # :param token: (Optional) <int> Cancel token from ProofOfWorkEngine.token, taken before the tip was read
+        # :return: <int> A number p', or None if the search was cancelled
+        proof = self.pow_engine.search(last_proof, self.target if target is None else target, token)
+        if proof is not None:
+            # The search starts at 0, so the lowest valid proof is also the number of attempts
+            self.pow_attempts.observe(proof + 1)
         return proof
 
+    def cancel_mining(self):
+        """
+        Stops the proof of work search because the chain tip has moved
+        """
+        self.pow_engine.cancel()
+
     @staticmethod
     def valid_proof(last_proof, proof, target):
         """
@@ -713,56 +1135,73 @@ class Blockchain(object):
         
         :param last_proof: <int> Previous proof value
         :param proof: <int> Current proof value
-        :param target: <int> The difficulty target (number of leading zeros required in the hash)
+        :param target: <int> The 256-bit target the hash must be below, see difficulty
         :return: <bool> True if valid, False otherwise
         """
         guess = f'{last_proof}{proof}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        
-        # Check if the hash is valid by comparing to the target difficulty
-        if guess_hash[:target] == '0' * target:
-            return True  # The proof is valid (meets difficulty)
-        return False  # The proof does not meet the difficulty
+        return meets_target(hashlib.sha256(guess).digest(), target)
     
 
 
-    def valid_chain(self , chain):
+    def valid_chain(self , chain, hashes=None, start=0):
+        # Every block is hashed once, pass hashes to reuse hashes the caller already computed
+        # start is the height of chain[0], the blocks below it come from our
+        # own chain, which must share chain[0]
+        if hashes is None:
+            hashes = [self.hash(block) for block in chain]
+
+        def block_at(height):
+            return chain[height - start] if height >= start else self.chain[height]
+
+        # The confirmed balances after chain[0], replayed block by block so
+        # every sender can be checked against what it has at that point
+        ledger = BalanceLedger()
+        if start == 0:
+            ledger.apply_block(chain[0])
+        else:
+            with self._write_lock:
+                ledger.confirmed = dict(self.ledger.confirmed)
+                for block in reversed(self.chain[start + 1:]):
+                    ledger.revert_block(block)
+
         last_block = chain[0]
         current_index = 1
+        # Transactions of blocks we do not have yet, their signatures are
+        # verified in one batch once the links and proofs are known to be good
+        new_transactions = []
         while current_index < len(chain):
             block = chain[current_index]
-            print(f'{last_block}')
-            print(f'{block}')
-            print("\n-----------\n")
+            logger.debug("Checking block %s against %s", block.get('index'), last_block.get('index'))
             # Check that the hash of the block is correct
-            if block['previous_hash'] != self.hash(last_block):
+            if block['previous_hash'] != hashes[current_index - 1]:
+                return False
+            # Check that the block carries the retargeted difficulty and the Proof of Work meets it
+            if not self.valid_target(block, last_block, self.next_target(block_at, start + current_index)):
                 return False
-            # Check that the Proof of Work is correct
-            if not self.valid_proof(last_block['proof'] , block['proof'] , self.target):
+            # The retarget reads the timestamps, they cannot go back past the median time
+            if not self.valid_timestamp(block, block_at, start + current_index):
                 return False
+            if not self.valid_proof(last_block['proof'] , block['proof'] , block_target(block)):
+                return False
+            if hashes[current_index] not in self.block_index:
+                # The header hash only covers the transactions through the Merkle root
+                if 'merkle_root' in block and not self.valid_merkle_root(block):
+                    return False
+                new_transactions.extend(block['transactions'][1:])
+            if not ledger.funds(block):
+                return False
+            ledger.apply_block(block)
             last_block = block
             current_index += 1
-        return True
+        return self.verify_transaction_signatures(new_transactions)
 
     def check_balance(self , transaction):
     
         # Check if the sender has enough coins
-        sender_balance = 0 
-        sender_address = transaction['sender']
-        sender_amount = transaction['amount']
-        
-        for block in self.chain:
-            for transaction in block['transactions']:
-                if transaction['transaction']['recipient'] == sender_address:
-                    sender_balance += transaction['transaction']['amount']
-                if transaction['transaction']['sender'] == sender_address:
-                    sender_balance -= transaction['transaction']['amount']
-                    
-        for tx in self.current_transactions:
-            if tx['transaction']['recipient'] == sender_address:
-                sender_balance += tx['amount']
-            if tx['transaction']['sender'] == sender_address:
-                sender_balance -= tx['transaction']['amount']  
+        # The balance comes from the ledger, which is kept up to date as blocks
+        # and mempool transactions are added
+        sender_balance = self.ledger.balance(transaction['sender'])
+        sender_amount = self.ledger.spend(transaction)
         if  sender_balance >= sender_amount:
             return True
         else:
@@ -774,34 +1213,12 @@ class Blockchain(object):
 
         # This is our Consensus Algorithm, it resolves conflicts
         
-        # by replacing our chain with the longest one in the network.
+        # by replacing our chain with the one with the most work in the network.
 
         # :return: <bool> True if our chain was replaced, False if not
-        neighbours = self.nodes
-        new_chain = None
-
-        # We're only looking for chains longer than ours
-        max_length = len(self.chain)
-
-        # Grab and verify the chains from all the nodes in our network
-        for node in neighbours:
-            response = requests.get(f'http://{node}/chain')
-
-            if response.status_code == 200:
-                length = response.json()['length']
-                chain = response.json()['chain']
-
-                # Check if the length is longer and the chain is valid
-                if length > max_length and self.valid_chain(chain):
-                    max_length = length
-                    new_chain = chain
-
-        # Replace our chain if we discovered a new, valid chain longer than ours
-        if new_chain:
-            self.chain = new_chain
-            return True
-
-        return False
+        # Headers are synced first and only the blocks after the fork point
+        # are downloaded, see ChainSync. Healthy nodes only, the fastest first
+        return self.chain_sync.sync(self.peers.select(self.snapshot.nodes))
 
 class SignatureVerificationError(Exception):
     pass
\ No newline at end of file
@@ -0,0 +1,150 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import requests
+
+import codec
+from transport import HttpTransport
+
+
+class BroadcastResult:
+    def __init__(self):
+        """
+        Outcome of one broadcast: the nodes that took the block, the nodes that
+        did not with the reason, and the time each delivery took.
+        """
+        self.succeeded = []
+        self.failed = {}
+        self.latencies = {}
+
+
+class _Broadcast:
+    def __init__(self, nodes, on_complete):
+        self.result = BroadcastResult()
+        self.remaining = len(nodes)
+        self.on_complete = on_complete
+        self.started = time()
+        self._lock = threading.Lock()
+
+    def finish(self, node, error=None):
+        with self._lock:
+            self.result.latencies[node] = time() - self.started
+            if error is None:
+                self.result.succeeded.append(node)
+            else:
+                self.result.failed[node] = error
+            self.remaining -= 1
+            done = self.remaining == 0
+        if done and self.on_complete:
+            self.on_complete(self.result)
+
+
+class BlockBroadcaster:
+    def __init__(self, max_workers=16, timeout=5, deadline=30, retries=3, backoff=1, binary=True, transport=None):
+        """
+        Sends a block to every peer at once over pooled keep-alive connections.
+
+        Each peer gets its own deadline. Failed posts are retried with exponential
+        backoff on a timer, so no thread sleeps while waiting to retry.
+
+        :param max_workers: (Optional) <int> Number of concurrent deliveries and pooled connections per host
+        :param timeout: (Optional) <int> Timeout in seconds of a single request
+        :param deadline: (Optional) <int> Seconds after which a peer that did not take the block counts as failed
+        :param retries: (Optional) <int> Number of attempts per request
+        :param backoff: (Optional) <int> Delay in seconds before the first retry, doubled after each attempt
+        :param binary: (Optional) <bool> Send payloads with the binary codec to peers that accept it
+        :param transport: (Optional) The transport to send with, e.g. Blockchain.transport. Its own HttpTransport by default
+        """
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.binary = binary
+        # Peers that rejected the binary codec, they are sent JSON from then on
+        self.json_peers = set()
+        # Peers that answered 404 to a request with a fallback, e.g. nodes
+        # without /nodes/inv, they are sent the fallback from then on
+        self.fallback_peers = set()
+        # A shared transport is closed by its owner
+        self._owns_transport = transport is None
+        self.transport = transport or HttpTransport(max_connections=max_workers)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='broadcast')
+
+    def broadcast(self, deliveries, on_complete=None):
+        """
+        Starts the deliveries and returns right away
+
+        :param deliveries: <dict> Node -> list of (url, json payload) posted in order, e.g. the block then the TTLs.
+            An entry may also be (url, payload, fallback), fallback being a list of (url, payload) posted in its place
+            to peers that answer 404
+        :param on_complete: (Optional) <callable> Called with the BroadcastResult once every node succeeded or failed
+        """
+        if not deliveries:
+            if on_complete:
+                on_complete(BroadcastResult())
+            return
+        broadcast = _Broadcast(deliveries, on_complete)
+        deadline = broadcast.started + self.deadline
+        for node, requests_to_send in deliveries.items():
+            self.executor.submit(self._attempt, broadcast, node, requests_to_send, 0, deadline)
+
+    def _attempt(self, broadcast, node, requests_to_send, attempt, deadline):
+        url, payload, *fallback = requests_to_send[0]
+        if fallback and node in self.fallback_peers:
+            self._attempt(broadcast, node, fallback[0] + requests_to_send[1:], attempt, deadline)
+            return
+        remaining = deadline - time()
+        error = None
+        try:
+            response = self._post(node, url, payload, max(0.1, min(self.timeout, remaining)))
+            if response.status_code == 404 and fallback:
+                self.fallback_peers.add(node)
+                self._attempt(broadcast, node, fallback[0] + requests_to_send[1:], 0, deadline)
+                return
+            if response.status_code != 200:
+                error = f"Non-200 status code: {response.status_code}"
+        except requests.exceptions.RequestException as e:
+            error = str(e)
+        except Exception as e:
+            error = f"Unexpected error: {e}"
+
+        if error is None:
+            if len(requests_to_send) > 1:
+                self._attempt(broadcast, node, requests_to_send[1:], 0, deadline)
+            else:
+                broadcast.finish(node)
+            return
+
+        delay = self.backoff * (2 ** attempt)
+        if attempt + 1 >= self.retries or time() + delay >= deadline:
+            broadcast.finish(node, f"{url}: {error}")
+            return
+        timer = threading.Timer(
+            delay, self._retry, args=(broadcast, node, requests_to_send, attempt + 1, deadline)
+        )
+        timer.daemon = True
+        timer.start()
+
+    def _post(self, node, url, payload, timeout):
+        if self.binary and node not in self.json_peers:
+            response = self.transport.post(
+                url, data=codec.encode(payload), headers={'Content-Type': codec.CONTENT_TYPE}, timeout=timeout
+            )
+            if response.status_code not in (415, 422):
+                return response
+            # Peers from before the binary codec only parse JSON bodies
+            self.json_peers.add(node)
+        return self.transport.post(url, json=payload, timeout=timeout)
+
+    def _retry(self, broadcast, node, requests_to_send, attempt, deadline):
+        try:
+            self.executor.submit(self._attempt, broadcast, node, requests_to_send, attempt, deadline)
+        except RuntimeError as e:
+            # The executor was shut down while the retry was waiting
+            broadcast.finish(node, str(e))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self._owns_transport:
+            self.transport.close()
@@ -0,0 +1,92 @@
+import functools
+from collections.abc import Sequence
+
+
+class ChainView(Sequence):
+    def __init__(self, items, length):
+        """
+        Read-only view of the first length items of an append-only list.
+
+        The writer only ever appends to the list it shares with views, a
+        truncated or replaced chain is a new list, so a view never changes.
+
+        :param items: <list> The shared list
+        :param length: <int> Number of items visible through the view
+        """
+        self._items = items
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self._items[i] for i in range(*position.indices(self._length))]
+        if position < 0:
+            position += self._length
+        if not 0 <= position < self._length:
+            raise IndexError('chain view index out of range')
+        return self._items[position]
+
+    def __iter__(self):
+        items = self._items
+        for position in range(self._length):
+            yield items[position]
+
+
+class ChainState:
+    def __init__(self, version, chain, hashes, heights, nodes, ttl, mempool):
+        """
+        Immutable snapshot of the node state, published by the writer after
+        every change. Readers take the current snapshot once and use it
+        without locks.
+
+        :param version: <int> Increases with every published snapshot
+        :param chain: <list> The writer's block list
+        :param hashes: <list> The writer's block hash list, see BlockIndex
+        :param heights: <dict> The live hash to height map, checked against the view on lookup
+        :param nodes: <frozenset> The known nodes, see PeerTable.snapshot
+        :param ttl: <Mapping> The read-only TTL table, see PeerTable.snapshot
+        :param mempool: <Mempool> The mempool, its view is taken when first read
+        """
+        self.version = version
+        self.height = len(chain)
+        self.chain = ChainView(chain, self.height)
+        self.hashes = ChainView(hashes, min(self.height, len(hashes)))
+        self._heights = heights
+        self.tip = chain[-1] if chain else None
+        self.tip_hash = hashes[self.height - 1] if self.height and len(hashes) >= self.height else None
+        self.nodes = nodes
+        self.ttl = ttl
+        self._mempool = mempool
+        self._mempool_view = None
+
+    def height_of(self, block_hash):
+        """
+        :return: <int> The height of the block with this hash in this snapshot, or None
+        """
+        height = self._heights.get(block_hash)
+        if height is None or height >= len(self.hashes) or self.hashes[height] != block_hash:
+            return None
+        return height
+
+    @property
+    def mempool(self):
+        """
+        <tuple> The pending transactions in arrival order. The mempool changes
+        with every transaction, so its view is only built when it is read.
+        """
+        if self._mempool_view is None:
+            self._mempool_view = self._mempool.snapshot()
+        return self._mempool_view
+
+
+def writer(method):
+    """
+    Runs a Blockchain method on the single writer path, see Blockchain.write
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.write():
+            return method(self, *args, **kwargs)
+    return wrapper
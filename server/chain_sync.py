@@ -0,0 +1,283 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import requests
+
+from difficulty import block_target
+
+logger = logging.getLogger(__name__)
+
+
+class SyncCandidate:
+    def __init__(self, node, fork, headers=None, blocks=None, hashes=None):
+        """
+        A peer chain that may replace ours from fork + 1 onwards
+
+        :param node: <str> The peer
+        :param fork: <int> Height of the last block we share with the peer, -1 if none
+        :param headers: (Optional) <list> The peer headers after the fork, blocks still to download
+        :param blocks: (Optional) <list> The peer blocks after the fork, for peers without /headers
+        :param hashes: (Optional) <list> The hashes of those blocks
+        """
+        self.node = node
+        self.fork = fork
+        self.headers = headers
+        self.blocks = blocks
+        self.hashes = hashes
+        self.work = 0
+
+
+class ChainSync:
+    def __init__(self, blockchain, max_workers=8, timeout=10, batch_size=500):
+        """
+        Headers-first chain sync. Header ranges are fetched from every peer at
+        once to find where each peer forked from our chain, and only the blocks
+        after the fork are downloaded, from the peer with the most work.
+
+        :param blockchain: The Blockchain instance to sync
+        :param max_workers: (Optional) <int> Number of peers queried at once
+        :param timeout: (Optional) <int> Timeout in seconds of a single request
+        :param batch_size: (Optional) <int> Number of headers or blocks fetched per request
+        """
+        self.blockchain = blockchain
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+
+    def _get(self, node, path, params=None):
+        transport = self.blockchain.transport
+        url = transport.url(node, path)
+        peers = self.blockchain.peers
+        started = time()
+        try:
+            response = transport.get(url, params=params, timeout=self.timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            peers.record_failure(node)
+            raise
+        peers.record_success(node, time() - started)
+        response.raise_for_status()
+        return response.json()
+
+    def _fetch_headers(self, node, start):
+        data = self._get(node, '/headers', {'from': start, 'limit': self.batch_size})
+        return data['length'], data['headers']
+
+    def find_fork(self, node):
+        """
+        Finds the last block we share with a peer, looking back from our tip
+        over a window that grows until a common block is found
+
+        :param node: <str> The peer
+        :return: <SyncCandidate> With the peer headers after the fork
+        """
+        index = self.blockchain.block_index
+        our_length = len(index)
+        window = 16
+        while True:
+            start = max(0, our_length - window)
+            length, headers = self._fetch_headers(node, start)
+            fork = -1
+            for entry in reversed(headers):
+                height = entry['height']
+                if height < our_length and index.hash_at(height) == entry['hash']:
+                    fork = height
+                    break
+            if fork >= 0 or start == 0:
+                break
+            window *= 4
+
+        new_headers = [entry for entry in headers if entry['height'] > fork]
+        next_height = headers[-1]['height'] + 1 if headers else length
+        while next_height < length:
+            length, headers = self._fetch_headers(node, next_height)
+            if not headers:
+                break
+            new_headers.extend(headers)
+            next_height = headers[-1]['height'] + 1
+        return SyncCandidate(node, fork, headers=new_headers)
+
+    def valid_headers(self, candidate):
+        """
+        Checks that the peer headers link up from the fork, carry the
+        retargeted difficulty, timestamps after the median time past and
+        valid proofs
+
+        :param candidate: <SyncCandidate> The candidate to check
+        :return: <bool>
+        """
+        blockchain = self.blockchain
+        chain = blockchain.chain
+        fork = candidate.fork
+
+        def block_at(height):
+            return chain[height] if height <= fork else candidate.headers[height - fork - 1]['header']
+
+        previous_hash = previous = None
+        if fork >= 0:
+            previous_hash = blockchain.block_index.hash_at(fork)
+            previous = chain[fork]
+        expected_height = fork + 1
+        for entry in candidate.headers:
+            header = entry['header']
+            if entry['height'] != expected_height:
+                return False
+            if previous_hash is not None and header['previous_hash'] != previous_hash:
+                return False
+            if previous is not None:
+                if not blockchain.valid_target(header, previous, blockchain.next_target(block_at, expected_height)):
+                    return False
+                if not blockchain.valid_timestamp(header, block_at, expected_height):
+                    return False
+                if not blockchain.valid_proof(previous['proof'], header['proof'], block_target(header)):
+                    return False
+            # Older blocks are hashed with their transactions, their hash is checked once downloaded
+            if 'merkle_root' in header and blockchain.hash(header) != entry['hash']:
+                return False
+            previous_hash = entry['hash']
+            previous = header
+            expected_height += 1
+        return True
+
+    def chain_candidate(self, node, chain):
+        """
+        :param node: <str> The peer the chain came from
+        :param chain: <list> The whole chain of the peer
+        :return: <SyncCandidate> With the peer blocks after the last block we share, not validated yet
+        """
+        hashes = [self.blockchain.hash(block) for block in chain]
+        index = self.blockchain.block_index
+        fork = -1
+        for height in range(min(len(chain), len(index)) - 1, -1, -1):
+            if index.hash_at(height) == hashes[height]:
+                fork = height
+                break
+        return SyncCandidate(node, fork, blocks=chain[fork + 1:], hashes=hashes[fork + 1:])
+
+    def _full_chain_candidate(self, node):
+        # Peers without /headers send their whole chain, its blocks after the
+        # fork are validated before they are kept, see valid_blocks
+        return self.chain_candidate(node, self._get(node, '/chain')['chain'])
+
+    def _candidate(self, node):
+        try:
+            try:
+                candidate = self.find_fork(node)
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
+                candidate = self._full_chain_candidate(node)
+                candidate.work = self.blockchain.chain_work(candidate.blocks)
+                return candidate
+            if not candidate.headers or not self.valid_headers(candidate):
+                return None
+            candidate.work = self.blockchain.chain_work(entry['header'] for entry in candidate.headers)
+            return candidate
+        except (requests.exceptions.RequestException, KeyError, TypeError, ValueError) as e:
+            logger.warning("Could not sync headers from node %s: %s", node, e)
+            return None
+
+    def download(self, candidate):
+        """
+        Downloads the blocks after the fork and checks them against the headers
+
+        :param candidate: <SyncCandidate> A candidate found by find_fork
+        :return: <bool> True if every block was downloaded and matches its header
+        """
+        start = candidate.fork + 1
+        end = start + len(candidate.headers)
+        blocks = []
+        while start + len(blocks) < end:
+            first = start + len(blocks)
+            data = self._get(candidate.node, '/chain', {'from': first, 'to': min(end, first + self.batch_size)})
+            if not data['chain']:
+                return False
+            blocks.extend(data['chain'])
+        blocks = blocks[:len(candidate.headers)]
+        hashes = [self.blockchain.hash(block) for block in blocks]
+        if hashes != [entry['hash'] for entry in candidate.headers]:
+            return False
+        candidate.blocks = blocks
+        candidate.hashes = hashes
+        return True
+
+    def valid_blocks(self, candidate):
+        blockchain = self.blockchain
+        if candidate.fork >= 0:
+            anchor = [blockchain.chain[candidate.fork]]
+            anchor_hashes = [blockchain.block_index.hash_at(candidate.fork)]
+            return blockchain.valid_chain(anchor + candidate.blocks, anchor_hashes + candidate.hashes, start=candidate.fork)
+        return blockchain.valid_chain(candidate.blocks, candidate.hashes)
+
+    def sync(self, nodes):
+        """
+        Replaces our blocks after the fork with the blocks of the peer with the
+        most work, if that is more work than ours
+
+        :param nodes: <list> The peers to sync from
+        :return: <bool> True if our chain was replaced
+        """
+        with self._lock:
+            if not nodes:
+                return False
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(nodes))) as executor:
+                candidates = [candidate for candidate in executor.map(self._candidate, nodes) if candidate]
+            return self._apply(candidates)
+
+    def offer(self, chain, node=None):
+        """
+        Takes a chain a peer pushed to us, e.g. on /nodes/update_chain, the
+        same way as a synced chain: our blocks after the fork are replaced only
+        if the pushed blocks are valid and have more work
+
+        :param chain: <list> The whole chain of the peer
+        :param node: (Optional) <str> The peer
+        :return: <bool> True if our chain was replaced
+        """
+        with self._lock:
+            try:
+                candidate = self.chain_candidate(node, chain)
+                candidate.work = self.blockchain.chain_work(candidate.blocks)
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                logger.warning("Malformed chain from node %s: %s", node, e)
+                return False
+            return self._apply([candidate])
+
+    def _apply(self, candidates):
+        """
+        Replaces our blocks after the fork with the valid candidate that adds
+        the most work. Call it with the sync lock held
+
+        :param candidates: <list> SyncCandidates, their blocks are downloaded if needed
+        :return: <bool> True if our chain was replaced
+        """
+        blockchain = self.blockchain
+        # Work of each candidate over our own blocks after its fork point
+        for candidate in candidates:
+            candidate.gain = candidate.work - blockchain.chain_work(blockchain.chain[candidate.fork + 1:])
+        candidates = sorted((c for c in candidates if c.gain > 0), key=lambda c: c.gain, reverse=True)
+
+        for candidate in candidates:
+            try:
+                if candidate.blocks is None and not self.download(candidate):
+                    logger.warning("Blocks from node %s do not match its headers", candidate.node)
+                    continue
+            except (requests.exceptions.RequestException, KeyError, TypeError, ValueError) as e:
+                logger.warning("Could not download blocks from node %s: %s", candidate.node, e)
+                continue
+            try:
+                valid = candidate.fork + 1 <= len(blockchain.chain) and self.valid_blocks(candidate)
+            except (KeyError, TypeError, ValueError, AttributeError, IndexError):
+                valid = False
+            if not valid:
+                logger.warning("Blocks from node %s are not valid", candidate.node)
+                continue
+            replaced = len(blockchain.chain) - candidate.fork - 1
+            if not blockchain.reorganize(candidate.fork + 1, candidate.blocks, candidate.hashes):
+                logger.info("Our chain changed while syncing from node %s", candidate.node)
+                continue
+            logger.info("Replaced %d blocks with %d blocks from node %s", replaced, len(candidate.blocks), candidate.node)
+            return True
+        return False
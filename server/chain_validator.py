@@ -0,0 +1,153 @@
+import logging
+import os
+import threading
+from time import time
+
+from difficulty import block_target
+from ledger import BalanceLedger
+
+logger = logging.getLogger(__name__)
+
+
+class ChainValidator:
+    def __init__(self, blockchain, interval=None):
+        """
+        Re-validates the whole chain on a background thread: block hashes
+        against the block index, links, targets, proofs, Merkle roots and
+        balances. A run that gets to the end saves a checkpoint, so the next
+        start up only validates the blocks after it. See catch_up for the runs
+        started without a request.
+
+        :param blockchain: The Blockchain instance to validate
+        :param interval: (Optional) <int> Blocks the checkpoint may fall behind the tip, CHECKPOINT_INTERVAL or 100
+        """
+        self.blockchain = blockchain
+        self.interval = interval or int(os.environ.get('CHECKPOINT_INTERVAL', 100))
+        # (height, tip hash) of the saved checkpoint, None if there is none
+        self.checkpoint = None
+        self.status = 'idle'
+        self.validated = 0
+        self.total = 0
+        self.started = None
+        self.finished = None
+        self.error = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts a run over the current snapshot of the chain
+
+        :return: <bool> False if a run is already in progress
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            state = self.blockchain.snapshot
+            self._stop.clear()
+            self.status = 'running'
+            self.validated = 0
+            self.total = state.height
+            self.started = time()
+            self.finished = None
+            self.error = None
+            self._thread = threading.Thread(target=self._run, args=(state,), name='chain-validator', daemon=True)
+            self._thread.start()
+            return True
+
+    def catch_up(self):
+        """
+        Starts a run when the checkpoint is missing, no longer on our chain or
+        interval blocks or more behind the tip. Called at start up and when a
+        block is appended. A chain found invalid is left to a run started on
+        /chain/validation
+
+        :return: <bool> True if a run was started
+        """
+        state = self.blockchain.snapshot
+        # Nothing is published until the node has started
+        if state is None or self.status == 'invalid':
+            return False
+        height = -1
+        if self.checkpoint is not None:
+            checkpoint_height, tip_hash = self.checkpoint
+            if checkpoint_height < state.height and state.hashes[checkpoint_height] == tip_hash:
+                height = checkpoint_height
+        if height >= 0 and state.height - 1 - height < self.interval:
+            return False
+        return self.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def progress(self):
+        """
+        :return: <dict> Status of the current or last run
+        """
+        return {
+            'status': self.status,
+            'validated': self.validated,
+            'total': self.total,
+            'progress': self.validated / self.total if self.total else 0,
+            'started': self.started,
+            'finished': self.finished,
+            'error': self.error
+        }
+
+    def validate(self, state):
+        """
+        Validates every block of a snapshot
+
+        :param state: <ChainState> The snapshot to validate
+        :return: <tuple> (height of the first invalid block or None, reason, confirmed balances)
+        """
+        blockchain = self.blockchain
+        ledger = BalanceLedger()
+        previous = None
+        for height, block in enumerate(state.chain):
+            if self._stop.is_set():
+                return height, 'cancelled', None
+            if blockchain.hash(block) != state.hashes[height]:
+                return height, 'block hash does not match the block index', None
+            if previous is not None:
+                if block['previous_hash'] != state.hashes[height - 1]:
+                    return height, 'previous hash is incorrect', None
+                if not blockchain.valid_target(block, previous, blockchain.next_target(state.chain.__getitem__, height)):
+                    return height, 'target does not match the retargeted difficulty', None
+                if not blockchain.valid_timestamp(block, state.chain.__getitem__, height):
+                    return height, 'timestamp is not after the median time of the blocks before it', None
+                if not blockchain.valid_proof(previous['proof'], block['proof'], block_target(block)):
+                    return height, 'proof of work is invalid', None
+            if 'merkle_root' in block and not blockchain.valid_merkle_root(block):
+                return height, 'Merkle root does not match the block transactions', None
+            if previous is not None and not ledger.funds(block):
+                return height, 'a transaction spends more than its sender has', None
+            ledger.apply_block(block)
+            previous = block
+            self.validated = height + 1
+        return None, None, ledger.confirmed
+
+    def _run(self, state):
+        try:
+            height, reason, balances = self.validate(state)
+        except Exception as e:
+            logger.exception("Chain validation stopped")
+            height, reason, balances = self.validated, f'error: {e}', None
+
+        self.finished = time()
+        if height is None:
+            if state.height:
+                self.blockchain.database.save_checkpoint(state.height - 1, state.tip_hash, balances)
+                self.checkpoint = (state.height - 1, state.tip_hash)
+            self.status = 'valid'
+            logger.info("Validated %d blocks in %.1f seconds", state.height, self.finished - self.started)
+        elif reason == 'cancelled':
+            self.status = 'cancelled'
+        else:
+            # Do not trust any of the chain on the next start up
+            self.blockchain.database.clear_checkpoint()
+            self.checkpoint = None
+            self.status = 'invalid'
+            self.error = {'height': height, 'reason': reason}
+            logger.error("Block at height %d is invalid: %s", height, reason)
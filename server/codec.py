@@ -0,0 +1,239 @@
+import base64
+import binascii
+import struct
+
+# Blocks, transactions and gossip messages in a compact binary form. Any
+# JSON value round-trips exactly, so hashing the decoded dict gives the same
+# hash as the JSON it came from. Hex strings such as hashes and public keys
+# are stored as raw bytes, base64 strings such as signatures as the decoded
+# bytes, and floats as 8 byte doubles.
+
+CONTENT_TYPE = 'application/x-simplicity-binary'
+
+MAGIC = b'SB'
+VERSION = 1
+
+_NONE = 0
+_FALSE = 1
+_TRUE = 2
+_INT = 3
+_FLOAT = 4
+_STR = 5
+_HEX = 6
+_BASE64 = 7
+_LIST = 8
+_DICT = 9
+
+# Dict keys written as a one byte reference. Append only: the position of a
+# key is part of the format
+KEYS = (
+    'index', 'timestamp', 'transactions', 'proof', 'previous_hash', 'merkle_root',
+    'transaction', 'sender', 'recipient', 'amount', 'fee', 'transaction_id',
+    'public_address', 'public_key', 'digital_signature', 'target',
+    'chain', 'hash_list', 'nodes', 'node', 'updated_nodes'
+)
+_KEY_REFS = {key: position + 1 for position, key in enumerate(KEYS)}
+
+_DOUBLE = struct.Struct('>d')
+
+
+class CodecError(ValueError):
+    pass
+
+
+def _write_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, position):
+    if position < len(data) and data[position] < 0x80:
+        # Single byte, the common case
+        return data[position], position + 1
+    result = 0
+    shift = 0
+    while True:
+        if position >= len(data):
+            raise CodecError('truncated varint')
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+def _is_hex(value):
+    if not value or len(value) % 2:
+        return None
+    try:
+        raw = bytes.fromhex(value)
+    except ValueError:
+        return None
+    # Upper case or spaced hex would not come back the same
+    return raw if raw.hex() == value else None
+
+
+def _is_base64(value):
+    if len(value) < 8 or len(value) % 4:
+        return None
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    return raw if base64.b64encode(raw).decode() == value else None
+
+
+def _write_bytes(out, tag, raw):
+    out.append(tag)
+    _write_varint(out, len(raw))
+    out += raw
+
+
+def _write_str(out, value):
+    raw = _is_hex(value)
+    if raw is not None:
+        _write_bytes(out, _HEX, raw)
+        return
+    raw = _is_base64(value)
+    if raw is not None:
+        _write_bytes(out, _BASE64, raw)
+        return
+    _write_bytes(out, _STR, value.encode())
+
+
+def _write_value(out, value):
+    # bool before int, bool is a subclass of int
+    if value is None:
+        out.append(_NONE)
+    elif value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif isinstance(value, int):
+        out.append(_INT)
+        # Zigzag, so small negative numbers stay small
+        _write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+    elif isinstance(value, float):
+        out.append(_FLOAT)
+        out += _DOUBLE.pack(value)
+    elif isinstance(value, str):
+        _write_str(out, value)
+    elif isinstance(value, dict):
+        out.append(_DICT)
+        _write_varint(out, len(value))
+        for key, item in value.items():
+            if not isinstance(key, str):
+                raise CodecError(f'dict keys must be strings, got {type(key).__name__}')
+            reference = _KEY_REFS.get(key)
+            if reference is None:
+                out.append(0)
+                raw = key.encode()
+                _write_varint(out, len(raw))
+                out += raw
+            else:
+                out.append(reference)
+            _write_value(out, item)
+    elif isinstance(value, (list, tuple)):
+        out.append(_LIST)
+        _write_varint(out, len(value))
+        for item in value:
+            _write_value(out, item)
+    else:
+        raise CodecError(f'cannot encode {type(value).__name__}')
+
+
+def _read_value(data, position):
+    if position >= len(data):
+        raise CodecError('truncated value')
+    tag = data[position]
+    position += 1
+    if tag == _DICT:
+        count, position = _read_varint(data, position)
+        result = {}
+        for _ in range(count):
+            if position >= len(data):
+                raise CodecError('truncated key')
+            reference = data[position]
+            position += 1
+            if reference:
+                if reference > len(KEYS):
+                    raise CodecError(f'unknown key reference {reference}')
+                key = KEYS[reference - 1]
+            else:
+                length, position = _read_varint(data, position)
+                key = data[position:position + length].decode()
+                position += length
+            result[key], position = _read_value(data, position)
+        return result, position
+    if tag == _LIST:
+        count, position = _read_varint(data, position)
+        result = []
+        for _ in range(count):
+            item, position = _read_value(data, position)
+            result.append(item)
+        return result, position
+    if tag in (_STR, _HEX, _BASE64):
+        length, position = _read_varint(data, position)
+        end = position + length
+        if end > len(data):
+            raise CodecError('truncated string')
+        raw = data[position:end]
+        if tag == _HEX:
+            return raw.hex(), end
+        if tag == _BASE64:
+            return base64.b64encode(raw).decode(), end
+        return raw.decode(), end
+    if tag == _INT:
+        value, position = _read_varint(data, position)
+        return (value >> 1) if not value & 1 else -((value + 1) >> 1), position
+    if tag == _FLOAT:
+        if position + 8 > len(data):
+            raise CodecError('truncated float')
+        return _DOUBLE.unpack_from(data, position)[0], position + 8
+    if tag == _NONE:
+        return None, position
+    if tag == _TRUE:
+        return True, position
+    if tag == _FALSE:
+        return False, position
+    raise CodecError(f'unknown tag {tag}')
+
+
+def encode(value):
+    """
+    :param value: A JSON compatible value, e.g. a block or a transaction
+    :return: <bytes> The framed binary form
+    """
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    _write_value(out, value)
+    return bytes(out)
+
+
+def decode(data):
+    """
+    :param data: <bytes> A value framed by encode
+    :return: The value, exactly as it was encoded
+    """
+    data = bytes(data)
+    if data[:2] != MAGIC:
+        raise CodecError('not a binary encoded value')
+    if len(data) < 3 or data[2] != VERSION:
+        raise CodecError(f'unsupported version {data[2] if len(data) > 2 else None}')
+    try:
+        value, position = _read_value(data, 3)
+    except (UnicodeDecodeError, RecursionError) as e:
+        raise CodecError(f'malformed value: {e}')
+    if position != len(data):
+        raise CodecError('trailing bytes after the value')
+    return value
+
+
+def is_encoded(data):
+    """
+    :return: <bool> True if data starts with the binary frame, JSON never does
+    """
+    return data[:2] == MAGIC
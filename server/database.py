@@ -1,67 +1,190 @@
 import json
+import logging
 from collections import OrderedDict
 import os
 
+import codec
+from block_log import BlockLog
+
+logger = logging.getLogger(__name__)
+
 class BlockchainDb:
-    
+
+    def __init__(self, directory='server/blocklog', legacy_filename='server/blockchain.json', block_format=None):
+        """
+        Stores the chain in an append-only block log and the small mutable state
+        (mempool, nodes and TTLs) in a separate JSON file next to it.
+
+        :param directory: <str> Directory of the block log and the state file
+        :param legacy_filename: <str> The old whole-chain JSON file, imported once into an empty log
+        :param block_format: (Optional) <str> 'json' or 'binary' for new records, BLOCK_LOG_FORMAT or json by default.
+                             Records of both formats are read
+        """
+        self.block_format = block_format or os.environ.get('BLOCK_LOG_FORMAT', 'json')
+        if self.block_format not in ('json', 'binary'):
+            raise ValueError(f"Unknown block format {self.block_format}")
+        self.block_log = BlockLog(directory)
+        self.state_path = os.path.join(directory, 'state.json')
+        self.checkpoint_path = os.path.join(directory, 'checkpoint.json')
+        self.address_index_path = os.path.join(directory, 'addresses.jsonl')
+        self.legacy_filename = legacy_filename
+
+    def encode_block(self, block):
+        if self.block_format == 'binary':
+            return codec.encode(block)
+        return json.dumps(block, separators=(',', ':')).encode()
+
     @staticmethod
-    def save_blockchain(blockchain, filename='server/blockchain.json'):
+    def decode_block(payload):
+        # The log may hold records of both formats, e.g. after switching format
+        if codec.is_encoded(payload):
+            return codec.decode(payload)
+        return json.loads(payload)
+
+    def sync_chain(self, blockchain):
+        """
+        Brings the block log in line with blockchain.chain. Appending a block
+        writes only that block, a replaced chain truncates the log back to the
+        last common block first.
+
+        :param blockchain: The Blockchain instance to persist
+        """
+        chain = blockchain.chain
+        log = self.block_log
+        common = min(len(log), len(chain))
+        index = blockchain.block_index
+        while common > 0 and log.hash_at(common - 1) != index.hash_at(common - 1):
+            common -= 1
+        log.truncate(common)
+        for height in range(common, len(chain)):
+            log.append(self.encode_block(chain[height]), index.hash_at(height))
+
+    def save_state(self, blockchain):
         """
-        Save the blockchain to a JSON file in the same directory as the script.
-        
+        Atomically rewrites the state file with the mempool, nodes and TTLs
+
         :param blockchain: The Blockchain instance to save
-        :param filename: The name of the file to save the blockchain to
         """
-        # Get the directory of the current script
-        
-        # Create the full path for the blockchain file
-        file_path =filename
-        
-        # Use OrderedDict to maintain order and remove duplicates
-        unique_chain = list(OrderedDict((json.dumps(block, sort_keys=True), block) for block in blockchain.chain).values())
-        unique_transactions = list(OrderedDict((json.dumps(tx, sort_keys=True), tx) for tx in blockchain.current_transactions).values())
-        
         data = {
-            'chain': unique_chain,
-            'current_transactions': unique_transactions,
-            'nodes': list(set(blockchain.nodes)) , # Convert set to list for JSON serialization
+            # The mempool holds each transaction id once
+            'current_transactions': blockchain.current_transactions,
+            'nodes': list(set(blockchain.nodes)),  # Convert set to list for JSON serialization
             'ttl': blockchain.ttl
         }
-        
-        with open(file_path, 'w') as f:
-            json.dump(data, f, indent=4)
-        print(f"Blockchain saved to {file_path}")
+        self._write_atomic(self.state_path, data)
 
     @staticmethod
-    def load_blockchain(blockchain, filename='server/blockchain.json'):
+    def _write_atomic(path, data):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def save_checkpoint(self, height, tip_hash, balances):
         """
-        Load the blockchain from a JSON file in the same directory as the script.
-        
-        :param blockchain: The Blockchain instance to update
-        :param filename: The name of the file to load the blockchain from
-        :return: True if loaded successfully, False otherwise
+        Records that the chain up to height was validated, with the confirmed
+        balances at that height, so a restart does not validate it again
+
+        :param height: <int> Height of the last validated block
+        :param tip_hash: <str> Hash of that block
+        :param balances: <dict> Confirmed balance per address after that block
+        """
+        self._write_atomic(self.checkpoint_path, {
+            'height': height,
+            'tip_hash': tip_hash,
+            'balances': balances
+        })
+        logger.info("Checkpoint saved at height %d", height)
+
+    def load_checkpoint(self):
         """
-        # Get the directory of the current script
-        # Create the full path for the blockchain file
-        file_path = filename
-        
-        if not os.path.exists(file_path):
-            print(f"File {file_path} not found. Starting with a new blockchain.")
+        :return: <dict> The checkpoint, or None if there is none or it no longer
+                 matches the block log, e.g. after a reorg below it
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return None
+        try:
+            with open(self.checkpoint_path, 'r') as f:
+                checkpoint = json.load(f)
+            height = checkpoint['height']
+            if 0 <= height < len(self.block_log) and self.block_log.hash_at(height) == checkpoint['tip_hash']:
+                return checkpoint
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring unreadable checkpoint %s: %s", self.checkpoint_path, e)
+            return None
+        logger.info("Checkpoint at height %d is not in the block log, ignoring it", height)
+        return None
+
+    def clear_checkpoint(self):
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def save_blockchain(self, blockchain):
+        """
+        Persist the blockchain. Blocks are normally already in the log, so
+        this only appends what is missing and rewrites the state file.
+
+        :param blockchain: The Blockchain instance to save
+        """
+        self.sync_chain(blockchain)
+        self.save_state(blockchain)
+        logger.info("Blockchain saved to %s", self.block_log.directory)
+
+    def import_legacy(self, blockchain):
+        """
+        One-shot import of the old blockchain.json into an empty block log
+
+        :param blockchain: The Blockchain instance, used for hashing
+        :return: True if a file was imported, False otherwise
+        """
+        if len(self.block_log) or not os.path.exists(self.legacy_filename):
             return False
-        
-        with open(file_path, 'r') as f:
+
+        with open(self.legacy_filename, 'r') as f:
             data = json.load(f)
-        
-        # Use set to remove any potential duplicates
+
+        # Use OrderedDict to maintain order and remove duplicates
         chain = list(OrderedDict((json.dumps(block, sort_keys=True), block) for block in data['chain']).values())
-        if blockchain.current_transactions != []:
-            blockchain.current_transactions = list(OrderedDict((json.dumps(tx, sort_keys=True), tx) for tx in data['current_transactions']).values())
-        blockchain.nodes = set(data['nodes'])
-        blockchain.ttl = data['ttl']
-        # Rebuild hash_list
-        blockchain.hash_list = set(blockchain.hash(block) for block in blockchain.chain)
-        
-        if chain != []:
-            blockchain.chain = chain
-        print(f"Blockchain loaded from {file_path}")
-        return True
\ No newline at end of file
+        for block in chain:
+            self.block_log.append(self.encode_block(block), blockchain.hash(block), sync=False)
+        self.block_log.flush()
+
+        if not os.path.exists(self.state_path):
+            with open(self.state_path, 'w') as f:
+                json.dump({
+                    'current_transactions': data.get('current_transactions', []),
+                    'nodes': data.get('nodes', []),
+                    'ttl': data.get('ttl', {})
+                }, f)
+        logger.info("Imported %d blocks from %s", len(chain), self.legacy_filename)
+        return True
+
+    def load_blockchain(self, blockchain):
+        """
+        Load the blockchain from the block log, importing blockchain.json first
+        if the log is still empty.
+
+        :param blockchain: The Blockchain instance to update
+        :return: True if loaded successfully, False otherwise
+        """
+        self.import_legacy(blockchain)
+
+        if not len(self.block_log):
+            logger.info("Block log %s is empty. Starting with a new blockchain.", self.block_log.directory)
+            return False
+
+        blockchain.chain = [self.decode_block(payload) for payload in self.block_log]
+
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as f:
+                data = json.load(f)
+            blockchain.current_transactions = data['current_transactions']
+            blockchain.nodes = set(data['nodes'])
+            blockchain.ttl = data['ttl']
+
+        # Rebuild the block index from the hashes stored in the log
+        blockchain.block_index.rebuild(self.block_log.hash_at(height) for height in range(len(self.block_log)))
+        logger.info("Blockchain loaded from %s", self.block_log.directory)
+        return True
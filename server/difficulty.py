@@ -0,0 +1,85 @@
+# Proof of work difficulty as a 256-bit target: a proof is valid when the
+# SHA-256 digest of the guess, read as a big-endian integer, is below the
+# target of its block. The target moves in steps of any size, unlike a count
+# of leading hex zeros which can only change the difficulty 16 times over.
+
+MAX_TARGET = (1 << 256) - 1
+
+# Blocks from before retargeting carry no target, they were checked for 4
+# leading hex zeros, i.e. a digest below 16 ** 60
+LEGACY_TARGET = 1 << 240
+
+# A single retarget never moves the difficulty more than 4 times up or down
+MAX_ADJUSTMENT = 4
+
+# Consensus rules: the difficulty is retargeted every RETARGET_INTERVAL
+# blocks so blocks come TARGET_BLOCK_INTERVAL seconds apart. Every node must
+# use the same values, or they compute different targets and reject each
+# other's blocks
+TARGET_BLOCK_INTERVAL = 60
+RETARGET_INTERVAL = 20
+
+# A block must be timestamped after the median timestamp of the
+# MEDIAN_TIME_SPAN blocks before it, so a miner cannot backdate the block
+# that later starts a retarget interval to stretch its timespan
+MEDIAN_TIME_SPAN = 11
+
+
+def target_from_zeros(zeros):
+    """
+    :param zeros: <int> Number of leading hex zeros
+    :return: <int> The target a digest must be below to start with that many zeros
+    """
+    return 1 << (256 - 4 * zeros)
+
+
+def block_target(block):
+    """
+    :param block: <dict> Block or block header
+    :return: <int> The target the proof of the block was checked against
+    """
+    return block.get('target', LEGACY_TARGET)
+
+
+def meets_target(digest, target):
+    """
+    :param digest: <bytes> A SHA-256 digest
+    :param target: <int> The target
+    :return: <bool> True if the digest is below the target
+    """
+    return int.from_bytes(digest, 'big') < target
+
+
+def median_time_past(block_at, height):
+    """
+    :param block_at: <callable> Returns the block or block header at a lower height
+    :param height: <int> Height of the block being checked
+    :return: <float> The median timestamp of the MEDIAN_TIME_SPAN blocks before it, None for the first block
+    """
+    if height == 0:
+        return None
+    timestamps = sorted(block_at(lower)['timestamp'] for lower in range(max(0, height - MEDIAN_TIME_SPAN), height))
+    return timestamps[len(timestamps) // 2]
+
+
+def work(target):
+    """
+    :return: <int> Expected number of hashes needed to find a digest below the target
+    """
+    return (1 << 256) // target
+
+
+def retarget(target, timespan, expected_timespan):
+    """
+    Scales a target by how long a retarget interval took against how long it
+    should have taken, so blocks found too fast get a lower (harder) target.
+
+    :param target: <int> The target over the interval
+    :param timespan: <float> Seconds the interval took, from the block timestamps
+    :param expected_timespan: <float> Seconds the interval should have taken
+    :return: <int> The new target
+    """
+    timespan = min(max(timespan, expected_timespan / MAX_ADJUSTMENT), expected_timespan * MAX_ADJUSTMENT)
+    # Milliseconds, so every node gets the same integer result
+    new_target = target * round(timespan * 1000) // round(expected_timespan * 1000)
+    return min(max(new_target, 1), MAX_TARGET)
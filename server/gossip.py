@@ -0,0 +1,304 @@
+import functools
+import logging
+import os
+import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from ingest import QueueFull
+
+logger = logging.getLogger(__name__)
+
+
+class SeenCache:
+    def __init__(self, capacity=10000):
+        """
+        Bounded LRU of the block hashes and transaction ids we saw recently,
+        announced, fetched or received in full
+
+        :param capacity: (Optional) <int> Number of ids kept, the least recently seen are dropped first
+        """
+        self.capacity = capacity
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        """
+        :return: <bool> True if the id was not seen before
+        """
+        with self._lock:
+            if key in self._ids:
+                self._ids.move_to_end(key)
+                return False
+            self._ids[key] = None
+            if len(self._ids) > self.capacity:
+                self._ids.popitem(last=False)
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._ids.pop(key, None)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class Gossip:
+    def __init__(self, blockchain, fanout=None, seen_size=10000, timeout=5, max_workers=8, max_items=500):
+        """
+        Announce and request gossip. New blocks and transactions are announced
+        by id to fanout peers on /nodes/inv, and a peer fetches the payloads it
+        has not seen from the announcer on /nodes/getdata, then announces them
+        on. Each node sends a payload to a handful of peers once, instead of
+        every node posting it to every peer.
+
+        Peers without /nodes/inv answer 404 and are sent the full payload on
+        the old endpoints instead, see BlockBroadcaster.
+
+        :param blockchain: The Blockchain instance
+        :param fanout: (Optional) <int> Peers each announcement goes to, GOSSIP_FANOUT or 8
+        :param seen_size: (Optional) <int> Capacity of the seen ids cache
+        :param timeout: (Optional) <int> Timeout in seconds of a getdata request
+        :param max_workers: (Optional) <int> Number of getdata requests run at once
+        :param max_items: (Optional) <int> Most ids served by one getdata request
+        """
+        self.blockchain = blockchain
+        self.fanout = fanout or int(os.environ.get('GOSSIP_FANOUT', 8))
+        self.seen = SeenCache(seen_size)
+        self.timeout = timeout
+        self.max_items = max_items
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gossip')
+        # Peers a sync is scheduled with, see sync_from
+        self._syncing = set()
+        self._lock = threading.Lock()
+
+    def targets(self, exclude=None):
+        """
+        :param exclude: (Optional) <str> The peer the payload came from
+        :return: <list> Up to fanout healthy peers, picked at random so announcements spread over the network
+        """
+        blockchain = self.blockchain
+        exclude = blockchain.peers.normalize(exclude) if exclude else None
+        nodes = [node for node in blockchain.peers.select(blockchain.snapshot.nodes) if node != exclude]
+        if len(nodes) > self.fanout:
+            nodes = random.sample(nodes, self.fanout)
+        return nodes
+
+    def _announce(self, kind, keys, endpoint, payloads, exclude=None, ttl=None):
+        blockchain = self.blockchain
+        transport = blockchain.transport
+        inventory = {'node': blockchain.ip_address, 'blocks': [], 'transactions': []}
+        inventory[kind].extend(keys)
+        deliveries = {}
+        for node in self.targets(exclude):
+            fallback = [(transport.url(node, f'/nodes/{endpoint}'), payload) for payload in payloads]
+            requests_to_send = [(transport.url(node, '/nodes/inv'), inventory, fallback)]
+            if ttl:
+                requests_to_send.append((transport.url(node, '/nodes/update_ttl'), {
+                    "updated_nodes": ttl,
+                    "node": blockchain.ip_address
+                }))
+            deliveries[node] = requests_to_send
+        # Block propagation and transaction gossip are recorded apart
+        on_complete = functools.partial(blockchain.broadcast_complete, kind='block' if kind == 'blocks' else 'transaction')
+        blockchain.broadcaster.broadcast(deliveries, on_complete)
+
+    def announce_block(self, block_hash, block, exclude=None, ttl=None):
+        """
+        Announces a block to fanout peers, in the background
+
+        :param block_hash: <str> The hash of the block
+        :param block: <dict> The block, posted in full to peers without /nodes/inv
+        :param exclude: (Optional) <str> The peer the block came from
+        :param ttl: (Optional) <dict> Our TTL table, sent to the same peers
+        """
+        self.seen.add(block_hash)
+        self._announce('blocks', [block_hash], 'update_block', [block], exclude, ttl)
+
+    def announce_transaction(self, transaction_id, entry, exclude=None):
+        """
+        Announces a mempool transaction to fanout peers, in the background
+
+        :param transaction_id: <str> The id of the transaction
+        :param entry: <dict> The transaction with its public address and signature
+        :param exclude: (Optional) <str> The peer the transaction came from
+        """
+        self.announce_transactions([(transaction_id, entry)], exclude)
+
+    def announce_transactions(self, entries, exclude=None):
+        """
+        Announces many mempool transactions to fanout peers in one inventory, in the background
+
+        :param entries: <list> (transaction id, entry) pairs
+        :param exclude: (Optional) <str> The peer the transactions came from
+        """
+        for start in range(0, len(entries), self.max_items):
+            chunk = entries[start:start + self.max_items]
+            for transaction_id, _ in chunk:
+                self.seen.add(transaction_id)
+            self._announce('transactions', [transaction_id for transaction_id, _ in chunk], 'update_transaction',
+                           [entry for _, entry in chunk], exclude)
+
+    def accept_block(self, block, block_hash, source=None):
+        """
+        Adds a block a peer sent us and announces it on, if it extends our tip.
+        A block whose parent we do not have means we missed blocks, we sync
+        from the peer in the background, see sync_from. A block on a branch
+        we have is no more work than ours and is dropped.
+
+        :return: <bool> False if we already had the block, it does not extend our tip or it is invalid
+        """
+        blockchain = self.blockchain
+        if block_hash in blockchain.hash_list:
+            self.seen.add(block_hash)
+            return False
+        with blockchain.write():
+            previous_hash = block.get('previous_hash')
+            if previous_hash != blockchain.block_index.tip_hash:
+                logger.info("Block %s from node %s does not extend our tip", block_hash, source)
+                if previous_hash not in blockchain.hash_list:
+                    self.sync_from(source)
+                return False
+            # Invalid blocks are not announced on, the seen cache keeps us from fetching them again
+            if not blockchain.valid_next_block(block, block_hash):
+                logger.warning("Rejected invalid block %s from node %s", block_hash, source)
+                return False
+            # append_block also drops the confirmed transactions from the mempool
+            blockchain.append_block(block, block_hash)
+        blockchain.cancel_mining()
+        self.announce_block(block_hash, block, exclude=source)
+        return True
+
+    def sync_from(self, node):
+        """
+        Schedules a headers-first sync from a peer, in the background. A peer
+        with a sync already scheduled is skipped
+
+        :param node: <str> The peer, None to sync from every healthy peer, see resolve_conflicts
+        """
+        with self._lock:
+            if node in self._syncing:
+                return
+            self._syncing.add(node)
+        try:
+            self.executor.submit(self._sync, node)
+        except RuntimeError:
+            # Shutting down
+            with self._lock:
+                self._syncing.discard(node)
+
+    def _sync(self, node):
+        blockchain = self.blockchain
+        try:
+            if node:
+                blockchain.chain_sync.sync([node])
+            else:
+                blockchain.resolve_conflicts()
+        except Exception:
+            logger.exception("Could not sync from node %s", node)
+        finally:
+            with self._lock:
+                self._syncing.discard(node)
+
+    def accept_transaction(self, entry, source=None):
+        """
+        Queues a transaction a peer sent us for validation. Once it is valid
+        it is added to the mempool and announced on, see TransactionIngest
+
+        :return: <bool> False if the transaction is malformed or the validation queue is full
+        """
+        blockchain = self.blockchain
+        try:
+            transaction_id, error = blockchain.ingest.submit(entry, source=source)
+        except QueueFull as e:
+            logger.info("Dropping a transaction from node %s: %s", source, e)
+            # Let a later announcement fetch it again
+            self.seen.discard(blockchain.transaction_id(entry))
+            return False
+        if error:
+            logger.info("Malformed transaction from node %s: %s", source, error)
+            return False
+        self.seen.add(transaction_id)
+        return True
+
+    def on_inventory(self, node, blocks, transactions):
+        """
+        Handles an announcement: fetches the blocks and transactions we have
+        not seen from the announcing peer, in the background
+
+        :param node: <str> The announcing peer
+        :param blocks: <list> Announced block hashes
+        :param transactions: <list> Announced transaction ids
+        :return: <int> Number of ids requested
+        """
+        blockchain = self.blockchain
+        # Marked seen now, so announcements of the same ids by other peers
+        # while the fetch runs do not fetch them again
+        wanted_blocks = [block_hash for block_hash in blocks[:self.max_items]
+                         if block_hash not in blockchain.hash_list and self.seen.add(block_hash)]
+        wanted_transactions = [transaction_id for transaction_id in transactions[:self.max_items]
+                               if transaction_id not in blockchain.mempool and self.seen.add(transaction_id)]
+        if node and (wanted_blocks or wanted_transactions):
+            self.executor.submit(self._fetch, node, wanted_blocks, wanted_transactions)
+        return len(wanted_blocks) + len(wanted_transactions)
+
+    def _fetch(self, node, block_hashes, transaction_ids):
+        blockchain = self.blockchain
+        try:
+            transport = blockchain.transport
+            response = transport.post(
+                transport.url(node, '/nodes/getdata'),
+                json={'blocks': block_hashes, 'transactions': transaction_ids}, timeout=self.timeout
+            )
+            response.raise_for_status()
+            data = response.json()
+            blocks = {blockchain.hash(block): block for block in data.get('blocks', [])}
+            entries = {blockchain.transaction_id(entry): entry for entry in data.get('transactions', [])}
+        except (requests.exceptions.RequestException, KeyError, TypeError, ValueError, AttributeError) as e:
+            logger.warning("Could not fetch announced data from node %s: %s", node, e)
+            blocks, entries = {}, {}
+
+        # Blocks in announcement order, so a run of new blocks links up
+        for block_hash in block_hashes:
+            block = blocks.get(block_hash)
+            if block is None:
+                # Let another peer's announcement fetch it
+                self.seen.discard(block_hash)
+                continue
+            self.accept_block(block, block_hash, source=node)
+        for transaction_id in transaction_ids:
+            entry = entries.get(transaction_id)
+            if entry is None:
+                self.seen.discard(transaction_id)
+                continue
+            self.accept_transaction(entry, source=node)
+
+    def get_data(self, block_hashes, transaction_ids):
+        """
+        :param block_hashes: <list> Hashes of the blocks a peer asks for
+        :param transaction_ids: <list> Ids of the mempool transactions a peer asks for
+        :return: <dict> The blocks and transactions we have
+        """
+        state = self.blockchain.snapshot
+        mempool = self.blockchain.mempool
+        blocks = []
+        for block_hash in block_hashes[:self.max_items]:
+            height = state.height_of(block_hash)
+            if height is not None:
+                blocks.append(state.chain[height])
+        transactions = []
+        for transaction_id in transaction_ids[:self.max_items]:
+            entry = mempool.get(transaction_id)
+            if entry is not None:
+                transactions.append(entry)
+        return {'blocks': blocks, 'transactions': transactions}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,344 @@
+import json
+import logging
+import math
+import os
+import queue
+import threading
+from collections import OrderedDict
+from time import time
+
+from ledger import BalanceLedger
+
+logger = logging.getLogger(__name__)
+
+# Reasons a queued transaction is rejected
+INVALID_SENDER = "Transaction will not be added to Block due to invalid sender address"
+INVALID_RECIPIENT = "Transaction will not be added to Block due to invalid recipient address"
+INVALID_TRANSACTION_ID = "Transaction will not be added to Block due to a transaction_id that does not match it"
+INVALID_SIGNATURE = "Transaction will not be added to Block due to invalid signature"
+INSUFFICIENT_FUNDS = "Transaction will not be added to Block due to insufficient funds"
+NOT_ADDED = "Transaction will not be added to Block because it is already pending or the mempool is full"
+
+
+class QueueFull(Exception):
+    """
+    The validation queue is full, the client should retry later
+    """
+
+
+def structural_error(entry):
+    """
+    The checks that need no key parsing, signature or balance, done before
+    a transaction is queued
+
+    :param entry: <dict> Transaction with its public address and digital signature
+    :return: <str> Why the entry is malformed, or None
+    """
+    if not isinstance(entry, dict):
+        return "Transaction must be an object"
+    transaction = entry.get('transaction')
+    if not isinstance(transaction, dict):
+        return "Missing transaction"
+    for field in ('sender', 'recipient'):
+        if not isinstance(transaction.get(field), str) or not transaction[field]:
+            return f"Transaction {field} must be a non-empty string"
+    amount = transaction.get('amount')
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)) or not math.isfinite(amount) or amount <= 0:
+        return "Transaction amount must be a positive number"
+    fee = transaction.get('fee', 0)
+    if isinstance(fee, bool) or not isinstance(fee, (int, float)) or not math.isfinite(fee) or fee < 0:
+        return "Transaction fee must be a non-negative number"
+    public_key = entry.get('public_address') or entry.get('public_key')
+    if not isinstance(public_key, str) or not public_key:
+        return "Missing public key"
+    if not isinstance(entry.get('digital_signature'), str) or not entry['digital_signature']:
+        return "Missing digital signature"
+    return None
+
+
+class TransactionIngest:
+    def __init__(self, blockchain, workers=None, max_queue=None, max_batch=256, max_request=1000, status_size=100000):
+        """
+        Accept and queue transaction ingestion. Submitted transactions get
+        structural checks only and are queued; worker threads take them off
+        the queue in batches, verify the signatures of a batch together, check
+        the balances and add them to the mempool in one write, then announce
+        the accepted ones to the network as one inventory.
+
+        With one worker transactions are validated in arrival order, so a
+        transaction spending coins received by the one before it is accepted.
+        More workers validate batches side by side and lose that order.
+
+        :param blockchain: The Blockchain instance
+        :param workers: (Optional) <int> Validation threads, INGEST_WORKERS or 1
+        :param max_queue: (Optional) <int> Transactions waiting for validation before submit raises QueueFull, INGEST_QUEUE or 10000
+        :param max_batch: (Optional) <int> Most queued transactions validated together
+        :param max_request: (Optional) <int> Most transactions in one submit_batch
+        :param status_size: (Optional) <int> Number of transaction statuses kept, the oldest are dropped first
+        """
+        self.blockchain = blockchain
+        self.max_batch = max_batch
+        self.max_request = max_request
+        self.status_size = status_size
+        self.queue = queue.Queue(maxsize=max_queue or int(os.environ.get('INGEST_QUEUE', 10000)))
+        # Transaction id -> {'status', 'reason', 'received'}, statuses of the transactions we queued
+        self._statuses = OrderedDict()
+        self._lock = threading.Lock()
+        self._stopped = False
+        self.threads = []
+        for number in range(workers or int(os.environ.get('INGEST_WORKERS', 1))):
+            thread = threading.Thread(target=self._run, name=f'ingest-{number}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _set_status(self, transaction_id, status, reason=None):
+        with self._lock:
+            record = self._statuses.pop(transaction_id, None) or {'received': time()}
+            record['status'] = status
+            record['reason'] = reason
+            self._statuses[transaction_id] = record
+            if len(self._statuses) > self.status_size:
+                self._statuses.popitem(last=False)
+
+    def submit(self, entry, source=None):
+        """
+        Queues a transaction for validation. A transaction that is already
+        queued, pending in the mempool or confirmed is not queued again.
+
+        :param entry: <dict> Transaction with its public address and digital signature
+        :param source: (Optional) <str> The peer the transaction came from, it is not announced back to it
+        :return: <tuple> (transaction id, error). The error is None once the transaction is queued or known
+        :raises QueueFull: If the validation queue is full
+        """
+        error = structural_error(entry)
+        if error:
+            return None, error
+        blockchain = self.blockchain
+        transaction_id = blockchain.transaction_id(entry)
+        with self._lock:
+            record = self._statuses.get(transaction_id)
+            queued = record is not None and record['status'] == 'pending'
+        if queued or transaction_id in blockchain.mempool or blockchain.address_index.location(transaction_id) is not None:
+            return transaction_id, None
+        if self._stopped:
+            raise QueueFull("The node is shutting down")
+
+        # Pending before it is queued, so a worker never sees its result overwritten
+        self._set_status(transaction_id, 'pending')
+        try:
+            self.queue.put_nowait((transaction_id, entry, source))
+        except queue.Full:
+            with self._lock:
+                self._statuses.pop(transaction_id, None)
+            blockchain.ingested_transactions.inc(outcome='queue_full')
+            raise QueueFull(f"The validation queue holds {self.queue.maxsize} transactions, retry later")
+        return transaction_id, None
+
+    def status(self, transaction_id):
+        """
+        :param transaction_id: <str> The transaction id
+        :return: <dict> The status of the transaction: pending while queued, accepted in the mempool,
+                 rejected with the reason, confirmed in a block, or dropped when an accepted transaction
+                 left the mempool without being confirmed. None for unknown transactions
+        """
+        blockchain = self.blockchain
+        result = {'transaction_id': transaction_id}
+        # The mempool first: append_block indexes a transaction before the
+        # snapshot with its block is published, never after it left the mempool
+        if transaction_id in blockchain.mempool:
+            return dict(result, status='accepted')
+        state = blockchain.snapshot
+        location = blockchain.address_index.location(transaction_id)
+        if location is not None:
+            height, position = location
+            if height < state.height and blockchain.transaction_id(state.chain[height]['transactions'][position]) == transaction_id:
+                return dict(result, status='confirmed', height=height, block_hash=state.hashes[height],
+                            confirmations=state.height - height)
+            # In a block that is still being added
+            return dict(result, status='accepted')
+        with self._lock:
+            record = self._statuses.get(transaction_id)
+            record = dict(record) if record is not None else None
+        if record is None:
+            return None
+        if record['status'] == 'accepted':
+            record['status'] = 'dropped'
+        result.update(status=record['status'], received=record['received'])
+        if record['reason']:
+            result['reason'] = record['reason']
+        return result
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Validate what we took, then stop
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self.validate(batch)
+            except Exception:
+                logger.exception("Unexpected error validating %d transactions", len(batch))
+                for transaction_id, _, _ in batch:
+                    self._reject({}, transaction_id, "Internal error while validating the transaction")
+
+    def _reject(self, results, transaction_id, reason):
+        self._set_status(transaction_id, 'rejected', reason)
+        self.blockchain.ingested_transactions.inc(outcome='rejected')
+        results[transaction_id] = ('rejected', reason)
+
+    def validate(self, batch):
+        """
+        Validates a batch of transactions and adds the valid ones to the mempool
+
+        :param batch: <list> (transaction id, entry, source) tuples in arrival order, without duplicate ids
+        :return: <dict> Transaction id -> (status, reason), status is accepted or rejected
+        """
+        blockchain = self.blockchain
+        verifier = blockchain.signature_verifier
+        results = {}
+        checked = []
+        for transaction_id, entry, source in batch:
+            transaction = entry['transaction']
+            if not blockchain.valid_transaction_id(transaction):
+                self._reject(results, transaction_id, INVALID_TRANSACTION_ID)
+                continue
+            try:
+                verifier.public_key(transaction['sender'])
+            except ValueError:
+                self._reject(results, transaction_id, INVALID_SENDER)
+                continue
+            try:
+                verifier.public_key(transaction['recipient'])
+            except ValueError:
+                self._reject(results, transaction_id, INVALID_RECIPIENT)
+                continue
+            checked.append((transaction_id, entry, source))
+
+        items = [(json.dumps(entry['transaction'], sort_keys=True),
+                  entry.get('public_address') or entry.get('public_key'),
+                  entry['digital_signature']) for _, entry, _ in checked]
+        with blockchain.signature_verification.time(mode='ingest'):
+            verified = verifier.verify_batch(items)
+
+        accepted = []
+        # The balance checks and the inserts are one write, so two
+        # transactions cannot both spend the same coins
+        with blockchain.write():
+            # The balance of each address is read from the ledger once per
+            # batch, then moved by the transactions of the batch it accepts
+            balances = {}
+            for (transaction_id, entry, source), valid in zip(checked, verified):
+                if not valid:
+                    self._reject(results, transaction_id, INVALID_SIGNATURE)
+                    continue
+                transaction = entry['transaction']
+                sender, recipient, amount = transaction['sender'], transaction['recipient'], transaction['amount']
+                spend = BalanceLedger.spend(transaction)
+                if sender not in balances:
+                    balances[sender] = blockchain.ledger.balance(sender)
+                if balances[sender] < spend:
+                    self._reject(results, transaction_id, INSUFFICIENT_FUNDS)
+                    continue
+                pending = len(blockchain.mempool)
+                if not blockchain.add_pending_transaction(entry):
+                    self._reject(results, transaction_id, NOT_ADDED)
+                    continue
+                if len(blockchain.mempool) <= pending:
+                    # Evicting other transactions moved balances the batch already read
+                    balances.clear()
+                else:
+                    balances[sender] -= spend
+                    if recipient in balances:
+                        balances[recipient] += amount
+                self._set_status(transaction_id, 'accepted')
+                blockchain.ingested_transactions.inc(outcome='accepted')
+                results[transaction_id] = ('accepted', None)
+                accepted.append((transaction_id, entry, source))
+        if not accepted:
+            return results
+
+        blockchain.miner()
+        blockchain.remove_expired_nodes()
+        # One inventory per peer the transactions came from, not sent back to it
+        by_source = {}
+        for transaction_id, entry, source in accepted:
+            by_source.setdefault(source, []).append((transaction_id, entry))
+        for source, entries in by_source.items():
+            blockchain.gossip.announce_transactions(entries, exclude=source)
+        return results
+
+    def submit_batch(self, entries):
+        """
+        Validates many transactions at once, on the calling thread instead of
+        the queue, so the caller gets the outcome of each one. Signatures are
+        verified together and the accepted transactions are announced as one
+        inventory, see validate.
+
+        :param entries: <list> Transactions with their public address and digital signature
+        :return: <list> One dict per entry, in order: the transaction id, the status and the reason of a rejection.
+                 Transactions that were already known get their current status
+        """
+        blockchain = self.blockchain
+        results = [None] * len(entries)
+        batch = []
+        positions = {}
+        for position, entry in enumerate(entries):
+            error = structural_error(entry)
+            if error:
+                results[position] = {'transaction_id': None, 'status': 'rejected', 'reason': error}
+                continue
+            transaction_id = blockchain.transaction_id(entry)
+            if transaction_id in positions:
+                # The same transaction twice in the batch gets the outcome of the first
+                positions[transaction_id].append(position)
+                continue
+            known = self.status(transaction_id)
+            if known is not None and known['status'] in ('pending', 'accepted', 'confirmed'):
+                results[position] = known
+                continue
+            positions[transaction_id] = [position]
+            batch.append((transaction_id, entry, None))
+
+        for transaction_id, (status, reason) in self.validate(batch).items():
+            result = {'transaction_id': transaction_id, 'status': status}
+            if reason:
+                result['reason'] = reason
+            for position in positions[transaction_id]:
+                results[position] = result
+        return results
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def shutdown(self):
+        """
+        Stops the workers, the transactions still queued are dropped
+        """
+        self._stopped = True
+        # One stop marker per worker. Never blocks on a full queue: the queue
+        # is emptied again when a submit raced the markers in
+        markers = len(self.threads)
+        while markers:
+            while True:
+                try:
+                    if self.queue.get_nowait() is None:
+                        markers += 1
+                except queue.Empty:
+                    break
+            while markers:
+                try:
+                    self.queue.put_nowait(None)
+                except queue.Full:
+                    break
+                markers -= 1
@@ -0,0 +1,111 @@
+class BalanceLedger:
+    def __init__(self):
+        """
+        Keeps a running balance per address so balance checks do not have to
+        walk the whole chain.
+
+        confirmed holds the balances from the blocks in the chain, pending holds
+        the deltas of the transactions still waiting in the mempool.
+        """
+        self.confirmed = {}
+        self.pending = {}
+
+    @staticmethod
+    def spend(transaction):
+        """
+        :param transaction: <dict> The transaction
+        :return: What its sender pays: the amount, plus the fee the miner gets in the coinbase
+        """
+        return transaction['amount'] + transaction.get('fee', 0)
+
+    @classmethod
+    def _apply(cls, balances, entry, sign=1):
+        if not entry:
+            return
+        transaction = entry['transaction']
+        balances[transaction['recipient']] = balances.get(transaction['recipient'], 0) + transaction['amount'] * sign
+        balances[transaction['sender']] = balances.get(transaction['sender'], 0) - cls.spend(transaction) * sign
+
+    def apply_block(self, block):
+        """
+        Adds the transactions of a block appended to the chain
+
+        :param block: <dict> The appended block
+        """
+        for entry in block['transactions']:
+            self._apply(self.confirmed, entry)
+
+    def revert_block(self, block):
+        """
+        Takes back the transactions of a block removed from the chain
+
+        :param block: <dict> The removed block
+        """
+        for entry in block['transactions']:
+            self._apply(self.confirmed, entry, -1)
+
+    def funds(self, block):
+        """
+        Checks a block extending the confirmed balances can be paid for. The
+        transactions are replayed in block order, the way Mempool.select picks
+        them, so a transaction can spend what the ones before it in the block
+        sent to its sender. Only the first transaction, the coinbase, creates coins
+
+        :param block: <dict> The block after the last block applied
+        :return: <bool> False if a sender pays more than it has at that point of the block
+        """
+        balances = {}
+        for position, entry in enumerate(block['transactions']):
+            if not entry:
+                continue
+            transaction = entry['transaction']
+            for address in (transaction['sender'], transaction['recipient']):
+                if address not in balances:
+                    balances[address] = self.confirmed.get(address, 0)
+            if position > 0 and balances[transaction['sender']] < self.spend(transaction):
+                return False
+            self._apply(balances, entry)
+        return True
+
+    def add_pending(self, entry):
+        """
+        :param entry: <dict> Mempool entry with a 'transaction' key
+        """
+        self._apply(self.pending, entry)
+
+    def remove_pending(self, entry):
+        self._apply(self.pending, entry, -1)
+
+    def clear_pending(self):
+        self.pending = {}
+
+    def rebuild(self, chain, current_transactions=(), base=None):
+        """
+        Recomputes every balance, used when the chain is loaded or replaced
+
+        :param chain: <list> The blocks of the chain
+        :param current_transactions: (Optional) <list> The mempool entries
+        :param base: (Optional) <dict> Confirmed balances before the first block of chain, e.g. from a checkpoint
+        """
+        confirmed = dict(base or {})
+        for block in chain:
+            for entry in block['transactions']:
+                self._apply(confirmed, entry)
+        pending = {}
+        for entry in current_transactions:
+            self._apply(pending, entry)
+        self.confirmed = confirmed
+        self.pending = pending
+
+    def confirmed_balance(self, address):
+        return self.confirmed.get(address, 0)
+
+    def pending_balance(self, address):
+        return self.pending.get(address, 0)
+
+    def balance(self, address):
+        """
+        :param address: <str> The address to look up
+        :return: The confirmed balance plus the pending mempool deltas
+        """
+        return self.confirmed.get(address, 0) + self.pending.get(address, 0)
@@ -0,0 +1,519 @@
+"""
+Load generator for POST /transactions/new, or POST /transactions/batch with
+--batch, to find the throughput ceiling of a node and catch ingest regressions.
+
+Fresh key pairs are funded from the accounts of --accounts that have coins,
+then every transaction is signed up front on a process pool, in the format
+verify_digital_signature expects, so signing does not limit the load. The
+transactions are sent at a fixed --rate, or back to back by --concurrency
+clients, and the report is printed as JSON like bench.py. The node answers
+202 once a transaction is queued, so after the load the status of every
+queued transaction is polled until it was validated, see --settle. Batches
+are validated before the node answers:
+
+    python server/loadgen.py --url http://127.0.0.1:5000 --count 5000 --concurrency 32
+    python server/loadgen.py --count 2000 --rate 200 --invalid 0.1
+    python server/loadgen.py --count 5000 --batch 100 --concurrency 4
+
+Without --url a node is started in this process on --port, with its own
+block log in a temporary directory and no peers. It shares the process and
+its GIL with the load, so use --url against a separate node to size hardware.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SERVER_DIR)
+
+from ellipticcurve.ecdsa import Ecdsa
+from ellipticcurve.privateKey import PrivateKey
+
+from simulator import percentile
+
+# The rejection reasons of TransactionIngest, by the part of them that
+# tells them apart
+REJECTIONS = [
+    ('invalid sender address', 'sender_key'),
+    ('invalid recipient address', 'recipient_key'),
+    ('invalid signature', 'signature'),
+    ('insufficient funds', 'funds'),
+    ('already pending or the mempool is full', 'duplicate_or_mempool_full'),
+]
+
+# Kinds of invalid transactions mixed in with --invalid
+INVALID_KINDS = ['signature', 'funds', 'sender_key']
+
+
+def sign(private_key, transaction):
+    """
+    :param private_key: <str> Hex encoded private key
+    :param transaction: <dict> The transaction
+    :return: <dict> The body of POST /transactions/new
+    """
+    key = PrivateKey.fromString(private_key)
+    signature = Ecdsa.sign(json.dumps(transaction, sort_keys=True), key).toBase64()
+    return {'transaction': transaction, 'public_key': key.publicKey().toCompressed(), 'digital_signature': signature}
+
+
+def sign_all(jobs, workers):
+    """
+    :param jobs: <list> (private key, transaction) pairs
+    :param workers: <int> Worker processes
+    :return: <list> The request bodies, in the order of the jobs
+    """
+    if workers <= 1 or len(jobs) < 100:
+        return [sign(private_key, transaction) for private_key, transaction in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(sign, *zip(*jobs), chunksize=max(1, len(jobs) // (workers * 8))))
+
+
+def new_key():
+    key = PrivateKey()
+    return key.toString(), key.publicKey().toCompressed()
+
+
+def make_invalid(kind, body, unfunded):
+    """
+    Turns a signed body into a transaction the node must reject
+
+    :param kind: <str> One of INVALID_KINDS
+    :param body: <dict> A valid body
+    :param unfunded: <tuple> (private key, public key) of a key with no coins
+    :return: <dict> The invalid body
+    """
+    transaction = dict(body['transaction'])
+    if kind == 'signature':
+        # Signed over a different amount
+        transaction['amount'] = transaction['amount'] + 1
+        return dict(body, transaction=transaction)
+    if kind == 'funds':
+        transaction['sender'] = unfunded[1]
+        return sign(unfunded[0], transaction)
+    transaction['sender'] = 'not-a-public-key'
+    return dict(body, transaction=transaction)
+
+
+def reason_of(detail):
+    for fragment, reason in REJECTIONS:
+        if fragment in detail:
+            return reason
+    return 'other'
+
+
+def rejection_reason(response):
+    if response.status_code == 400:
+        try:
+            detail = str(response.json().get('detail', ''))
+        except ValueError:
+            detail = ''
+        return reason_of(detail)
+    return f'http_{response.status_code}'
+
+
+def queued_id(response):
+    """
+    :return: <str> The transaction id of a 202 answer, None for nodes that validate before answering
+    """
+    if response.status_code != 202:
+        return None
+    try:
+        return response.json().get('transaction_id')
+    except ValueError:
+        return None
+
+
+class Client:
+    def __init__(self, url, connections):
+        """
+        :param url: <str> Base URL of the node, e.g. http://127.0.0.1:5000
+        :param connections: <int> Pooled keep-alive connections
+        """
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def balance(self, address):
+        response = self.session.get(f'{self.url}/balance/{address}', timeout=30)
+        response.raise_for_status()
+        return response.json()['balance']
+
+    def submit(self, body, timeout=30):
+        return self.session.post(f'{self.url}/transactions/new', json=body, timeout=timeout)
+
+    def submit_batch(self, bodies, timeout=30):
+        return self.session.post(f'{self.url}/transactions/batch', json={'transactions': bodies}, timeout=timeout)
+
+    def status(self, transaction_id):
+        """
+        :return: <dict> The status of the transaction, None if the node does not know it or did not answer
+        """
+        try:
+            response = self.session.get(f'{self.url}/transactions/{transaction_id}/status', timeout=30)
+        except requests.exceptions.RequestException:
+            return None
+        return response.json() if response.status_code == 200 else None
+
+
+def settle(client, transaction_ids, concurrency, timeout):
+    """
+    Polls the status of queued transactions until the node validated them
+
+    :param transaction_ids: <list> Ids of the queued transactions
+    :param concurrency: <int> Status requests at once
+    :param timeout: <float> Seconds after which the transactions still pending are given up on
+    :return: <dict> Transaction id -> status, None for transactions the node does not know
+    """
+    statuses = {}
+    waiting = list(transaction_ids)
+    deadline = time.perf_counter() + timeout
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while waiting:
+            for transaction_id, status in zip(waiting, executor.map(client.status, waiting)):
+                statuses[transaction_id] = status
+            waiting = [transaction_id for transaction_id in waiting
+                       if statuses[transaction_id] is not None and statuses[transaction_id]['status'] == 'pending']
+            if waiting and time.perf_counter() < deadline:
+                time.sleep(0.2)
+            else:
+                break
+    return statuses
+
+
+def settled_reason(status):
+    """
+    :param status: <dict> A status from settle
+    :return: <str> The rejection reason, None for accepted transactions
+    """
+    if status is None:
+        return 'unknown'
+    if status['status'] in ('accepted', 'confirmed'):
+        return None
+    if status['status'] == 'rejected':
+        return reason_of(status.get('reason', ''))
+    return status['status']
+
+
+def fund_keys(client, accounts_file, keys, per_key, workers, timeout):
+    """
+    Sends per_key coins to every key, from the accounts with coins, and waits
+    until the node validated the funding so the keys can spend it
+
+    :return: <int> Number of keys funded
+    """
+    with open(accounts_file) as f:
+        accounts = [account for account in json.load(f) if account.get('publicKey') and account.get('privateKey')]
+    budget = {}
+    for account in accounts:
+        balance = client.balance(account['publicKey'])
+        if balance >= per_key:
+            budget[account['privateKey']] = (account['publicKey'], balance)
+    jobs = []
+    for _, public_key in keys:
+        funder = next((private_key for private_key, (_, balance) in budget.items() if balance >= per_key), None)
+        if funder is None:
+            break
+        sender, balance = budget[funder]
+        budget[funder] = (sender, balance - per_key)
+        jobs.append((funder, {'sender': sender, 'recipient': public_key, 'amount': per_key,
+                              'timestamp': time.time() + len(jobs) * 1e-6}))
+    funded = 0
+    queued = {}
+    for body in sign_all(jobs, workers):
+        response = client.submit(body)
+        if 200 <= response.status_code < 300:
+            transaction_id = queued_id(response)
+            if transaction_id is None:
+                funded += 1
+            else:
+                queued[transaction_id] = body
+        else:
+            print(f"Funding {body['transaction']['recipient']} failed: {response.status_code} {response.text[:200]}", file=sys.stderr)
+    for transaction_id, status in settle(client, list(queued), 4, timeout).items():
+        reason = settled_reason(status)
+        if reason is None:
+            funded += 1
+        else:
+            print(f"Funding {queued[transaction_id]['transaction']['recipient']} failed: {reason}", file=sys.stderr)
+    return funded
+
+
+def prepare(args, client):
+    """
+    Funds the keys and signs the load
+
+    :return: <list> (kind, body) pairs, kind is 'valid' or one of INVALID_KINDS
+    """
+    rng = random.Random(args.seed)
+    keys = [new_key() for _ in range(args.keys)]
+    per_key_count = math.ceil(args.count / args.keys)
+    # One transaction more than needed, so rounding of fractional amounts never leaves a key short
+    per_key = round(args.amount * (per_key_count + 1), 8)
+    funded = fund_keys(client, args.accounts, keys, per_key, args.sign_workers, args.settle)
+    if not funded:
+        raise SystemExit(f"No account in {args.accounts} has {per_key} coins to fund a key")
+    keys = keys[:funded]
+    count = min(args.count, funded * per_key_count)
+    if count < args.count:
+        print(f"Only {funded} keys could be funded, sending {count} transactions", file=sys.stderr)
+    jobs = []
+    for number in range(count):
+        private_key, public_key = keys[number % len(keys)]
+        recipient = keys[(number + 1) % len(keys)][1]
+        jobs.append((private_key, {'sender': public_key, 'recipient': recipient, 'amount': args.amount,
+                                   'timestamp': time.time() + number * 1e-6}))
+    bodies = sign_all(jobs, args.sign_workers)
+    unfunded = new_key()
+    load = []
+    for body in bodies:
+        if args.invalid and rng.random() < args.invalid:
+            kind = rng.choice(INVALID_KINDS)
+            load.append((kind, make_invalid(kind, body, unfunded)))
+        else:
+            load.append(('valid', body))
+    return load
+
+
+class Run:
+    def __init__(self, client, load, timeout, batch=1):
+        self.client = client
+        # Lists of (kind, body) sent in one request, one transaction each without batches
+        self.load = [load[start:start + batch] for start in range(0, len(load), batch)]
+        self.batch = batch
+        self.timeout = timeout
+        # (kind, latency, status, rejection reason or None, id of a queued transaction or None)
+        self.results = []
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def send(self, chunk, scheduled=None):
+        if self.batch > 1:
+            self.send_batch(chunk, scheduled)
+            return
+        kind, body = chunk[0]
+        # In rate mode the latency counts from when the request was due, so
+        # requests queued behind a slow node are not left out
+        started = time.perf_counter() if scheduled is None else scheduled
+        try:
+            response = self.client.submit(body, self.timeout)
+            status = response.status_code
+            reason = None if 200 <= status < 300 else rejection_reason(response)
+            transaction_id = queued_id(response)
+        except requests.exceptions.RequestException as e:
+            status = None
+            reason = type(e).__name__
+            transaction_id = None
+        latency = time.perf_counter() - started
+        with self._lock:
+            self.results.append((kind, latency, status, reason, transaction_id))
+
+    def send_batch(self, chunk, scheduled=None):
+        # Every transaction of the batch gets the latency of the request
+        started = time.perf_counter() if scheduled is None else scheduled
+        try:
+            response = self.client.submit_batch([body for _, body in chunk], self.timeout)
+            status = response.status_code
+            if status == 200:
+                reasons = [None if result['status'] in ('pending', 'accepted', 'confirmed') else reason_of(result.get('reason', ''))
+                           for result in response.json()['results']]
+            else:
+                reasons = [rejection_reason(response)] * len(chunk)
+        except requests.exceptions.RequestException as e:
+            status = None
+            reasons = [type(e).__name__] * len(chunk)
+        latency = time.perf_counter() - started
+        with self._lock:
+            for (kind, _), reason in zip(chunk, reasons):
+                self.results.append((kind, latency, status, reason, None))
+
+    def settle(self, concurrency, timeout):
+        """
+        Replaces the reasons of the queued transactions with the outcome of their validation
+
+        :return: <float> Seconds until every queued transaction was validated or timeout passed
+        """
+        started = time.perf_counter()
+        statuses = settle(self.client, [result[4] for result in self.results if result[4]], concurrency, timeout)
+        self.results = [
+            (kind, latency, status, settled_reason(statuses.get(transaction_id)) if transaction_id else reason, transaction_id)
+            for kind, latency, status, reason, transaction_id in self.results
+        ]
+        return time.perf_counter() - started
+
+    def at_rate(self, rate, concurrency, deadline):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            started = time.perf_counter()
+            for number, chunk in enumerate(self.load):
+                scheduled = started + number * self.batch / rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                if time.perf_counter() > deadline:
+                    break
+                executor.submit(self.send, chunk, scheduled)
+
+    def _client_loop(self, deadline):
+        while time.perf_counter() < deadline:
+            with self._lock:
+                if self._next >= len(self.load):
+                    return
+                chunk = self.load[self._next]
+                self._next += 1
+            self.send(chunk)
+
+    def with_clients(self, concurrency, deadline):
+        threads = [threading.Thread(target=self._client_loop, args=(deadline,)) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+def latency_summary(values):
+    return {
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None
+    }
+
+
+def report(args, url, run, elapsed, settle_elapsed):
+    results = run.results
+    accepted = [latency for _, latency, _, reason, _ in results if reason is None]
+    rejections, statuses, unexpected = {}, {}, {}
+    for kind, _, status, reason, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        if reason is not None:
+            rejections[reason] = rejections.get(reason, 0) + 1
+        # A valid transaction that was rejected, or an invalid one for another reason than its own
+        if (kind == 'valid') != (reason is None) or (reason is not None and kind != reason):
+            key = f'{kind}:{reason or "accepted"}'
+            unexpected[key] = unexpected.get(key, 0) + 1
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'target': url,
+        'args': {key: value for key, value in vars(args).items() if key != 'output'},
+        'sent': len(results),
+        'queued': sum(1 for result in results if result[4]),
+        'accepted': len(accepted),
+        'rejected': len(results) - len(accepted),
+        'elapsed': elapsed,
+        'settle_elapsed': settle_elapsed,
+        'sent_per_second': len(results) / elapsed if elapsed else 0,
+        # Queued transactions count once they were validated, so the wait for the last ones is included
+        'accepted_per_second': len(accepted) / (elapsed + settle_elapsed) if elapsed else 0,
+        'latency': latency_summary([latency for _, latency, _, _, _ in results]),
+        'accepted_latency': latency_summary(accepted),
+        'rejections': rejections,
+        'statuses': statuses,
+        'unexpected': unexpected
+    }
+
+
+def print_summary(result, file=sys.stderr):
+    def ms(value):
+        return '-' if value is None else f'{value * 1000:.1f} ms'
+    latency = result['latency']
+    print(f"sent {result['sent']} in {result['elapsed']:.2f} s, validated {result['settle_elapsed']:.2f} s later,"
+          f" accepted {result['accepted']} ({result['accepted_per_second']:.1f} tx/s), rejected {result['rejected']}", file=file)
+    print(f"latency p50 {ms(latency['p50'])}  p95 {ms(latency['p95'])}  p99 {ms(latency['p99'])}  max {ms(latency['max'])}", file=file)
+    if result['rejections']:
+        print("rejections " + '  '.join(f'{reason} {count}' for reason, count in sorted(result['rejections'].items())), file=file)
+    if result['unexpected']:
+        print("unexpected " + '  '.join(f'{key} {count}' for key, count in sorted(result['unexpected'].items())), file=file)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Drive POST /transactions/new and report the throughput of a node")
+    parser.add_argument('--url', help='base URL of the node, a node is started in this process without it')
+    parser.add_argument('--port', type=int, default=5055, help='port of the node started in this process')
+    parser.add_argument('--count', type=int, default=1000, help='number of transactions to send')
+    parser.add_argument('--rate', type=float, default=None, help='transactions per second, sent by up to --concurrency requests at once')
+    parser.add_argument('--concurrency', type=int, default=16, help='clients sending back to back, or most requests in flight with --rate')
+    parser.add_argument('--duration', type=float, default=None, help='stop after this many seconds even if transactions are left')
+    parser.add_argument('--keys', type=int, default=16, help='number of funded key pairs the transactions are sent from')
+    parser.add_argument('--amount', type=float, default=0.01, help='coins per transaction')
+    parser.add_argument('--invalid', type=float, default=0, help='fraction of transactions with a bad signature, no funds or a bad sender key')
+    parser.add_argument('--accounts', default=os.path.join(SERVER_DIR, 'accounts.json'), help='accounts with coins to fund the keys from')
+    parser.add_argument('--sign-workers', type=int, default=os.cpu_count() or 1, help='processes signing the transactions')
+    parser.add_argument('--batch', type=int, default=1, help='transactions per request, sent to POST /transactions/batch when above 1')
+    parser.add_argument('--timeout', type=float, default=30, help='timeout in seconds of a request')
+    parser.add_argument('--settle', type=float, default=60, help='seconds to wait for the node to validate the queued transactions')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the invalid transaction mix')
+    parser.add_argument('--log-level', default='CRITICAL', help='log level of the node started in this process')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    return parser.parse_args(argv)
+
+
+def start_local_node(args, workdir):
+    # Only needed without --url, the node modules are not imported otherwise
+    from node_logging import setup_logging
+    from simulator import create_node, serve
+    from transport import HttpTransport
+    setup_logging(level=args.log_level)
+    node = create_node('loadgen', os.path.join(workdir, 'loadgen'), HttpTransport(), workers=None)
+    node.server = serve(node.app, args.port)
+    return node
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    node = workdir = None
+    cwd = os.getcwd()
+    try:
+        if args.url:
+            url = args.url
+        else:
+            # The node reads server/accounts.json relative to the working directory
+            os.chdir(os.path.dirname(SERVER_DIR))
+            workdir = tempfile.mkdtemp(prefix='blockchain-loadgen-')
+            node = start_local_node(args, workdir)
+            url = f'http://127.0.0.1:{args.port}'
+        client = Client(url, args.concurrency)
+        load = prepare(args, client)
+        run = Run(client, load, args.timeout, args.batch)
+        started = time.perf_counter()
+        deadline = started + args.duration if args.duration else float('inf')
+        if args.rate:
+            run.at_rate(args.rate, args.concurrency, deadline)
+        else:
+            run.with_clients(args.concurrency, deadline)
+        elapsed = time.perf_counter() - started
+        settle_elapsed = run.settle(args.concurrency, args.settle)
+        result = report(args, url, run, elapsed, settle_elapsed)
+    finally:
+        if node is not None:
+            from simulator import stop_node
+            stop_node(node)
+        os.chdir(cwd)
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_summary(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+import heapq
+import itertools
+import json
+import threading
+from collections import deque
+
+
+class Mempool:
+    def __init__(self, transaction_id, max_count=10000, max_bytes=5000000):
+        """
+        Pending transactions indexed by transaction id and by sender.
+
+        Transactions are ordered by fee, then by age. When the count or byte
+        cap is exceeded the lowest priority transactions are evicted. The
+        sender pays the fee, so a high fee cannot be claimed for free.
+
+        :param transaction_id: <callable> Returns the id of an entry, e.g. Blockchain.transaction_id
+        :param max_count: (Optional) <int> Maximum number of pending transactions
+        :param max_bytes: (Optional) <int> Maximum total size of the pending transactions, as JSON
+        """
+        self.transaction_id = transaction_id
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._entries = {}
+        self._priority = {}
+        self._senders = {}
+        # Min-heap of (fee, -arrival, id), the first live item is the next one to evict
+        self._eviction_heap = []
+        self._arrival = itertools.count()
+        self._lock = threading.RLock()
+        # Bumped on every change, the snapshot is rebuilt only after a change
+        self.version = 0
+        self._snapshot = (-1, ())
+
+    @staticmethod
+    def fee(entry):
+        return entry['transaction'].get('fee', 0)
+
+    def add(self, entry):
+        """
+        Adds a transaction, evicting lower priority transactions if the pool is full
+
+        :param entry: <dict> Transaction with its public address and digital signature
+        :return: <tuple> (added, evicted entries). added is False for duplicates and
+                 for a transaction that would itself be evicted
+        """
+        transaction_id = self.transaction_id(entry)
+        with self._lock:
+            if transaction_id in self._entries:
+                return False, []
+            fee = self.fee(entry)
+            arrival = next(self._arrival)
+            size = len(json.dumps(entry))
+            self.version += 1
+            self._entries[transaction_id] = entry
+            self._priority[transaction_id] = (fee, arrival, size)
+            self._senders.setdefault(entry['transaction']['sender'], {})[transaction_id] = None
+            self.size_bytes += size
+            heapq.heappush(self._eviction_heap, (fee, -arrival, transaction_id))
+
+            evicted = []
+            while len(self._entries) > self.max_count or self.size_bytes > self.max_bytes:
+                evicted.append(self._evict_one())
+            added = transaction_id in self._entries
+            return added, [item for item in evicted if item is not entry]
+
+    def _evict_one(self):
+        while True:
+            fee, negative_arrival, transaction_id = heapq.heappop(self._eviction_heap)
+            priority = self._priority.get(transaction_id)
+            if priority is not None and priority[1] == -negative_arrival:
+                return self.remove(transaction_id)
+
+    def remove(self, transaction_id):
+        """
+        :param transaction_id: <str> The transaction id
+        :return: <dict> The removed entry, or None if it was not pending
+        """
+        with self._lock:
+            entry = self._entries.pop(transaction_id, None)
+            if entry is None:
+                return None
+            self.version += 1
+            _, _, size = self._priority.pop(transaction_id)
+            self.size_bytes -= size
+            sender = entry['transaction']['sender']
+            pending = self._senders.get(sender)
+            if pending is not None:
+                pending.pop(transaction_id, None)
+                if not pending:
+                    del self._senders[sender]
+            # The heap item is skipped when it is popped
+            if len(self._eviction_heap) > 2 * len(self._entries) + 64:
+                self._eviction_heap = [item for item in self._eviction_heap if item[2] in self._priority]
+                heapq.heapify(self._eviction_heap)
+            return entry
+
+    def remove_confirmed(self, block):
+        """
+        Removes every transaction of a block from the pool
+
+        :param block: <dict> A block appended to the chain
+        :return: <list> The removed entries
+        """
+        removed = []
+        with self._lock:
+            for entry in block['transactions']:
+                if not entry:
+                    continue
+                removed_entry = self.remove(self.transaction_id(entry))
+                if removed_entry is not None:
+                    removed.append(removed_entry)
+        return removed
+
+    def select(self, max_bytes=None, max_count=None, balance=None):
+        """
+        Picks the transactions for the next block, highest fee first, then oldest first.
+
+        Pending credits can be spent, so with balance a transaction is only
+        picked once its sender can pay for it from the confirmed balance plus
+        the transactions already picked, which puts the parents that fund a
+        transaction before it in the block. The transactions of a sender are
+        picked in arrival order.
+
+        :param max_bytes: (Optional) <int> Maximum total size of the selection
+        :param max_count: (Optional) <int> Maximum number of transactions
+        :param balance: (Optional) <callable> Confirmed balance of an address, e.g. BalanceLedger.confirmed_balance
+        :return: <list> The selected entries, in block order
+        """
+        with self._lock:
+            if balance is None:
+                ordered = sorted(self._priority.items(), key=lambda item: (-item[1][0], item[1][1]))
+                selected = []
+                total = 0
+                for transaction_id, (_, _, size) in ordered:
+                    if max_count is not None and len(selected) >= max_count:
+                        break
+                    if max_bytes is not None and total + size > max_bytes:
+                        continue
+                    selected.append(self._entries[transaction_id])
+                    total += size
+                return selected
+
+            # The pending transactions of each sender, oldest first
+            queues = {sender: deque(pending) for sender, pending in self._senders.items()}
+            # The oldest transaction of each sender that can still be picked
+            heads = []
+            for sender, pending in queues.items():
+                fee, arrival, _ = self._priority[pending[0]]
+                heads.append((-fee, arrival, sender))
+            heapq.heapify(heads)
+            balances = {}
+            # Senders waiting for a credit to pay for their oldest transaction
+            waiting = {}
+            selected = []
+            total = 0
+            while heads:
+                if max_count is not None and len(selected) >= max_count:
+                    break
+                head = heapq.heappop(heads)
+                sender = head[2]
+                transaction_id = queues[sender][0]
+                transaction = self._entries[transaction_id]['transaction']
+                size = self._priority[transaction_id][2]
+                if max_bytes is not None and total + size > max_bytes:
+                    # Its later transactions may spend what it sends, leave them for the next block
+                    continue
+                if sender not in balances:
+                    balances[sender] = balance(sender)
+                # The sender pays the fee on top of the amount, see BalanceLedger.spend
+                spend = transaction['amount'] + transaction.get('fee', 0)
+                if balances[sender] < spend:
+                    waiting[sender] = head
+                    continue
+                selected.append(self._entries[transaction_id])
+                total += size
+                recipient = transaction['recipient']
+                balances[sender] -= spend
+                balances[recipient] = balances.get(recipient, balance(recipient)) + transaction['amount']
+                if recipient in waiting:
+                    heapq.heappush(heads, waiting.pop(recipient))
+                queues[sender].popleft()
+                if queues[sender]:
+                    fee, arrival, _ = self._priority[queues[sender][0]]
+                    heapq.heappush(heads, (-fee, arrival, sender))
+            return selected
+
+    def get(self, transaction_id):
+        return self._entries.get(transaction_id)
+
+    def by_sender(self, sender):
+        """
+        :return: <list> The pending transactions of a sender, oldest first
+        """
+        with self._lock:
+            return [self._entries[transaction_id] for transaction_id in self._senders.get(sender, {})]
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._entries = {}
+            self._priority = {}
+            self._senders = {}
+            self._eviction_heap = []
+            self.size_bytes = 0
+
+    def snapshot(self):
+        """
+        :return: <tuple> The pending transactions in arrival order, as of now
+        """
+        version, entries = self._snapshot
+        if version == self.version:
+            return entries
+        with self._lock:
+            self._snapshot = (self.version, tuple(self._entries.values()))
+            return self._snapshot[1]
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        # Arrival order
+        return iter(list(self._entries.values()))
@@ -0,0 +1,71 @@
+import hashlib
+
+# Root of a block without transactions
+EMPTY_ROOT = '0' * 64
+
+
+def _hash_pair(left, right):
+    return hashlib.sha256(left + right).digest()
+
+
+def _next_level(level):
+    if len(level) % 2:
+        level = level + [level[-1]]
+    return [_hash_pair(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+
+
+def merkle_root(leaves):
+    """
+    Computes the Merkle root over the leaves of a block, see
+    Blockchain.merkle_leaf. An odd node at any level is paired with itself,
+    so callers must reject blocks with a repeated transaction.
+
+    :param leaves: <list> Hex encoded leaf hashes in block order
+    :return: <str> Hex encoded root
+    """
+    if not leaves:
+        return EMPTY_ROOT
+    level = [bytes.fromhex(leaf) for leaf in leaves]
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0].hex()
+
+
+def merkle_proof(leaves, position):
+    """
+    Builds the inclusion proof of the transaction at position
+
+    :param leaves: <list> Hex encoded leaf hashes in block order
+    :param position: <int> Position of the transaction in the block
+    :return: <list> Sibling hashes from the leaf up, as {'hash': <str>, 'side': 'left' | 'right'}
+    """
+    level = [bytes.fromhex(leaf) for leaf in leaves]
+    proof = []
+    while len(level) > 1:
+        if len(level) % 2:
+            level = level + [level[-1]]
+        sibling = position ^ 1
+        proof.append({
+            'hash': level[sibling].hex(),
+            'side': 'left' if sibling < position else 'right'
+        })
+        level = _next_level(level)
+        position //= 2
+    return proof
+
+
+def verify_merkle_proof(leaf, proof, root):
+    """
+    :param leaf: <str> Hex encoded leaf hash of the transaction
+    :param proof: <list> The proof returned by merkle_proof
+    :param root: <str> Hex encoded Merkle root from the block header
+    :return: <bool> True if the proof links the transaction to the root
+    """
+    node = bytes.fromhex(leaf)
+    for step in proof:
+        sibling = bytes.fromhex(step['hash'])
+        if step['side'] == 'left':
+            node = _hash_pair(sibling, node)
+        else:
+            node = _hash_pair(node, sibling)
+    return node.hex() == root
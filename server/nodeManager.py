@@ -1,5 +1,9 @@
 import json
+import logging
 import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
 
 class NodeManager:
     def __init__(self, file_path='server/nodes.json'):
@@ -17,13 +21,13 @@ class NodeManager:
                 if 'nodes' in data and isinstance(data['nodes'], list):
                     return data['nodes']
                 else:
-                    print(f"Error: 'nodes' key missing or not a list in {self.file_path}")
+                    logger.error("'nodes' key missing or not a list in %s", self.file_path)
                     return []
         except FileNotFoundError:
-            print(f"Error: {self.file_path} not found. Please ensure the file exists.")
+            logger.error("%s not found. Please ensure the file exists.", self.file_path)
             return []
         except json.JSONDecodeError:
-            print(f"Error: Failed to decode JSON from {self.file_path}.")
+            logger.error("Failed to decode JSON from %s.", self.file_path)
             return []
 
     def get_random_node(self):
@@ -33,6 +37,27 @@ class NodeManager:
         if self.nodes:
             return random.choice(self.nodes)
         else:
-            print("No nodes available.")
+            logger.warning("No nodes available.")
             return None
 
+    def get_fastest_node(self, probe):
+        """
+        Probe every loaded node at once and return the first to answer, so
+        start up does not wait on a dead or slow bootstrap node. Falls back to
+        a random node when none answers.
+
+        :param probe: <callable> Called with a node, raises if the node does not answer
+        """
+        if not self.nodes:
+            return self.get_random_node()
+        executor = ThreadPoolExecutor(max_workers=len(self.nodes))
+        try:
+            futures = {executor.submit(probe, node): node for node in self.nodes}
+            for future in as_completed(futures):
+                if future.exception() is None:
+                    return futures[future]
+                logger.warning("Bootstrap node %s did not answer: %s", futures[future], future.exception())
+        finally:
+            executor.shutdown(wait=False)
+        return self.get_random_node()
+
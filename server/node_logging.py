@@ -0,0 +1,116 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+
+# Attributes every LogRecord has, anything else was passed with extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, with the fields passed with extra= next to the message
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key != 'sample':
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, every=100):
+        """
+        Lets through one in every records logged with extra={'sample': <key>},
+        counted per key, so per transaction messages stay readable under load.
+        Records without a sample key always pass.
+
+        :param every: <int> Keep 1 record out of every, 1 keeps them all
+        """
+        super().__init__()
+        self.every = max(1, every)
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'sample', None)
+        if key is None or self.every == 1:
+            return True
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        return count % self.every == 0
+
+
+def setup_logging(level=None, json_format=None, sample_every=None, stream=None):
+    """
+    Routes every log record through a queue to a background thread, so the
+    callers never wait for the write. Records below the level are dropped
+    before their message is formatted.
+
+    The defaults come from the LOG_LEVEL, LOG_FORMAT (text or json) and
+    LOG_SAMPLE_EVERY environment variables.
+
+    :param level: (Optional) <str> Logging level, INFO by default
+    :param json_format: (Optional) <bool> Write one JSON object per line
+    :param sample_every: (Optional) <int> Keep 1 in sample_every sampled records, 100 by default
+    :param stream: (Optional) The stream to write to, stderr by default
+    """
+    global _listener
+    level = (level or os.environ.get('LOG_LEVEL') or 'INFO').upper()
+    if json_format is None:
+        json_format = os.environ.get('LOG_FORMAT', 'text').lower() == 'json'
+    if sample_every is None:
+        sample_every = int(os.environ.get('LOG_SAMPLE_EVERY', 100))
+
+    stop_logging()
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    if json_format:
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    # Sampled out records are never formatted or queued
+    handler.addFilter(SamplingFilter(sample_every))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """
+    Writes out the queued records and stops the background thread
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,280 @@
+import heapq
+import threading
+from time import time
+from types import MappingProxyType
+from urllib.parse import urlparse
+
+
+class PeerStats:
+    __slots__ = ('latency', 'failures', 'quarantined_until')
+
+    def __init__(self):
+        """
+        Rolling health of a peer: an exponentially weighted moving average of
+        its latency and the number of failures in a row
+        """
+        self.latency = None
+        self.failures = 0
+        self.quarantined_until = 0
+
+
+class PeerTable:
+    def __init__(self, primary=(), ttl_seconds=600, latency_weight=0.3, quarantine_after=2,
+                 quarantine=30, max_quarantine=600, max_failures=5, on_remove=None):
+        """
+        The known nodes and their TTLs, keyed by normalized node id.
+
+        Expiry is driven by a min-heap of (expiry, node), so expiring and
+        refreshing a node is O(log n) instead of a scan of the table. Heap
+        entries of refreshed or removed nodes are skipped when they come up.
+
+        Changes go through the Blockchain writer. The latency and failure
+        stats are also recorded from the broadcast and sync threads, under
+        a lock of their own.
+
+        :param primary: (Optional) <list> Bootstrap nodes, they never expire and are never dropped
+        :param ttl_seconds: (Optional) <int> TTL given to a node we heard from or added without a TTL
+        :param latency_weight: (Optional) <float> Weight of the newest sample in the latency average
+        :param quarantine_after: (Optional) <int> Failures in a row after which a node is quarantined
+        :param quarantine: (Optional) <int> Seconds of the first quarantine, doubled with every further failure
+        :param max_quarantine: (Optional) <int> Longest quarantine in seconds
+        :param max_failures: (Optional) <int> Failures in a row after which a node is dropped
+        :param on_remove: (Optional) <callable> Called with the id of every node dropped or expired, e.g. to drop its metrics
+        """
+        self.primary = frozenset(primary)
+        self.ttl_seconds = ttl_seconds
+        self.latency_weight = latency_weight
+        self.quarantine_after = quarantine_after
+        self.quarantine = quarantine
+        self.max_quarantine = max_quarantine
+        self.max_failures = max_failures
+        self.on_remove = on_remove
+        self.nodes = set()
+        self.ttl = {}
+        self._expiry = []
+        self._ids = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._version = 0
+        self._view = None
+
+    def normalize(self, node):
+        """
+        The node id: the host name without scheme, port, path or the
+        .trycloudflare.com suffix, see Blockchain.addUrl. Worked out once per
+        spelling of a node.
+
+        :param node: <str> A node as peers send it, e.g. 'https://abc.trycloudflare.com'
+        :return: <str> The node id, or None if node is not a node
+        """
+        node_id = self._ids.get(node)
+        if node_id is not None or not isinstance(node, str):
+            return node_id
+        parsed = urlparse(node)
+        host = (parsed.netloc or parsed.path).split('/')[0].split(':')[0]
+        host = host.replace('.trycloudflare.com', '')
+        if not host:
+            return None
+        if len(self._ids) >= 10000:
+            self._ids.clear()
+        self._ids[node] = host
+        return host
+
+    @staticmethod
+    def routable(node_id):
+        """
+        :return: <bool> False for local addresses, which other nodes cannot reach
+        """
+        return not (node_id in ('localhost', '127.0.0.1') or node_id.startswith('192.168.') or node_id.startswith('10.'))
+
+    def _changed(self):
+        self._version += 1
+
+    def add(self, node):
+        """
+        Adds a node, with a fresh TTL if it has none
+
+        :param node: <str> The node
+        :return: <str> The node id, or None
+        """
+        node_id = self.normalize(node)
+        if node_id is None:
+            return None
+        if node_id not in self.nodes:
+            self.nodes.add(node_id)
+            self._changed()
+        if node_id not in self.ttl and node_id not in self.primary:
+            self.set_ttl(node_id, time() + self.ttl_seconds)
+        return node_id
+
+    def set_ttl(self, node, expiry):
+        """
+        Moves the expiry of a node forward, adding the node if it is new
+
+        :param node: <str> The node
+        :param expiry: <float> Time after which the node expires, an earlier expiry than the current one is ignored
+        :return: <str> The node id, or None
+        """
+        node_id = self.normalize(node)
+        if node_id is None or not isinstance(expiry, (int, float)) or isinstance(expiry, bool):
+            return None
+        if expiry > self.ttl.get(node_id, float('-inf')):
+            self.ttl[node_id] = expiry
+            heapq.heappush(self._expiry, (expiry, node_id))
+            if len(self._expiry) > 2 * len(self.ttl) + 64:
+                # Mostly superseded entries, rebuild from the live TTLs
+                self._expiry = [(ttl, node) for node, ttl in self.ttl.items()]
+                heapq.heapify(self._expiry)
+            self._changed()
+        if node_id not in self.nodes:
+            self.nodes.add(node_id)
+            self._changed()
+        return node_id
+
+    def touch(self, node):
+        """
+        Gives a node we just heard from a full TTL
+        """
+        return self.set_ttl(node, time() + self.ttl_seconds)
+
+    def discard(self, node):
+        """
+        Removes a node, its TTL and its stats
+        """
+        node_id = self.normalize(node)
+        removed = node_id in self.nodes
+        if removed or node_id in self.ttl:
+            self.nodes.discard(node_id)
+            self.ttl.pop(node_id, None)
+            self._changed()
+        with self._lock:
+            self._stats.pop(node_id, None)
+        if removed and self.on_remove:
+            self.on_remove(node_id)
+
+    def expire(self, now=None):
+        """
+        Removes the nodes whose TTL has passed
+
+        :param now: (Optional) <float> The current time
+        :return: <list> The removed node ids
+        """
+        now = time() if now is None else now
+        expired = []
+        heap = self._expiry
+        while heap and heap[0][0] < now:
+            expiry, node_id = heapq.heappop(heap)
+            if self.ttl.get(node_id) != expiry:
+                # Refreshed or removed since this entry was pushed
+                continue
+            del self.ttl[node_id]
+            if node_id not in self.primary:
+                self.nodes.discard(node_id)
+                if self.on_remove:
+                    self.on_remove(node_id)
+            expired.append(node_id)
+        if expired:
+            self._changed()
+        return expired
+
+    def load(self, nodes=None, ttl=None):
+        """
+        Adds the nodes and TTLs of a saved state
+        """
+        for node, expiry in (ttl or {}).items():
+            self.set_ttl(node, expiry)
+        for node in nodes or ():
+            self.add(node)
+
+    def snapshot(self):
+        """
+        :return: <tuple> (frozenset of the nodes, read-only TTL table), only copied after a change
+        """
+        if self._view is None or self._view[0] != self._version:
+            self._view = (self._version, frozenset(self.nodes), MappingProxyType(dict(self.ttl)))
+        return self._view[1], self._view[2]
+
+    def record_success(self, node, latency):
+        """
+        :param node: <str> The node
+        :param latency: <float> Seconds the node took to answer
+        """
+        node_id = self.normalize(node)
+        if node_id is None:
+            return
+        with self._lock:
+            stats = self._stats.get(node_id)
+            if stats is None:
+                stats = self._stats[node_id] = PeerStats()
+            if stats.latency is None:
+                stats.latency = latency
+            else:
+                stats.latency += self.latency_weight * (latency - stats.latency)
+            stats.failures = 0
+            stats.quarantined_until = 0
+
+    def record_failure(self, node, now=None):
+        """
+        Counts a failed request to a node, quarantining it after quarantine_after failures in a row
+
+        :return: <int> The number of failures in a row
+        """
+        node_id = self.normalize(node)
+        if node_id is None:
+            return 0
+        now = time() if now is None else now
+        with self._lock:
+            stats = self._stats.get(node_id)
+            if stats is None:
+                stats = self._stats[node_id] = PeerStats()
+            stats.failures += 1
+            if stats.failures >= self.quarantine_after:
+                backoff = self.quarantine * 2 ** (stats.failures - self.quarantine_after)
+                stats.quarantined_until = now + min(backoff, self.max_quarantine)
+            return stats.failures
+
+    def failing(self, node):
+        """
+        :return: <bool> True if the node failed max_failures times in a row and should be dropped
+        """
+        node_id = self.normalize(node)
+        with self._lock:
+            stats = self._stats.get(node_id)
+            return stats is not None and stats.failures >= self.max_failures and node_id not in self.primary
+
+    def quarantined(self, now=None):
+        """
+        :return: <int> Number of nodes currently in quarantine
+        """
+        now = time() if now is None else now
+        with self._lock:
+            return sum(1 for stats in self._stats.values() if stats.quarantined_until > now)
+
+    def select(self, nodes, limit=None, now=None):
+        """
+        The healthy nodes, fastest first. Quarantined nodes are left out until
+        their quarantine ends, then get one more try. Nodes we have no latency
+        for yet come first, so they get measured.
+
+        :param nodes: <iterable> The nodes to choose from, e.g. ChainState.nodes
+        :param limit: (Optional) <int> Return at most this many nodes
+        :param now: (Optional) <float> The current time
+        :return: <list> Node ids
+        """
+        now = time() if now is None else now
+        ranked = []
+        with self._lock:
+            for node in nodes:
+                node_id = self.normalize(node)
+                if node_id is None:
+                    continue
+                stats = self._stats.get(node_id)
+                if stats is None:
+                    ranked.append((0, 0, node_id))
+                elif stats.quarantined_until <= now:
+                    ranked.append((stats.latency or 0, stats.failures, node_id))
+        if limit is not None:
+            ranked = heapq.nsmallest(limit, ranked)
+        else:
+            ranked.sort()
+        return [node_id for _, _, node_id in ranked]
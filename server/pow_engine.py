@@ -0,0 +1,220 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+# Set in every worker process by _init_worker; shared with the parent so a
+# search can be stopped without waiting for the in-flight chunks to finish.
+_cancel_event = None
+
+# How many nonces a worker tries between two looks at the cancel flag.
+CANCEL_CHECK_INTERVAL = 4096
+
+# The last two digits of a nonce, see search_nonces
+_SUFFIXES = [b'%02d' % low for low in range(100)]
+
+
+def _init_worker(cancel_event):
+    global _cancel_event
+    _cancel_event = cancel_event
+
+
+def search_nonces(last_proof, target, start, stop, cancelled=None):
+    """
+    Nonce search kernel for Blockchain.valid_proof: the lowest proof in
+    [start, stop) whose sha256(f'{last_proof}{proof}') digest is below the
+    target, the same proof trying valid_proof on every nonce finds.
+
+    last_proof and the high digits of the nonce are hashed once per 100
+    nonces and the hash state is copied for each of them, so only the last
+    two digits are hashed per nonce. The digest is compared with the target
+    as bytes, big-endian like the integer valid_proof compares.
+
+    :param last_proof: <int> Proof of the block being extended
+    :param target: <int> The 256-bit target
+    :param start: <int> First nonce
+    :param stop: <int> End of the nonces (exclusive)
+    :param cancelled: (Optional) <callable> Checked every CANCEL_CHECK_INTERVAL nonces, stops the search when it returns True
+    :return: <int> The proof, or None
+    """
+    prefix = hashlib.sha256(str(last_proof).encode())
+    limit = target.to_bytes(32, 'big')
+    proof = start
+    # Nonces below 100 have no high digits
+    while proof < min(stop, 100):
+        guess = prefix.copy()
+        guess.update(b'%d' % proof)
+        if guess.digest() < limit:
+            return proof
+        proof += 1
+    while proof < stop:
+        if cancelled is not None and proof % CANCEL_CHECK_INTERVAL < 100 and cancelled():
+            return None
+        high, low = divmod(proof, 100)
+        high_state = prefix.copy()
+        high_state.update(b'%d' % high)
+        copy = high_state.copy
+        for suffix in _SUFFIXES[low:min(100, stop - high * 100)]:
+            guess = copy()
+            guess.update(suffix)
+            if guess.digest() < limit:
+                return high * 100 + low
+            low += 1
+        proof = high * 100 + 100
+    return None
+
+
+def _search_chunk(valid_proof, kernel, last_proof, target, start, stop):
+    """
+    Runs inside a worker process: tries every nonce in [start, stop).
+
+    :param valid_proof: <callable> Proof predicate, e.g. Blockchain.valid_proof
+    :param kernel: <callable> Nonce search equivalent to valid_proof, or None
+    :param last_proof: <int> Proof of the block being extended
+    :param target: <int> The difficulty target
+    :param start: <int> First nonce of the chunk
+    :param stop: <int> End of the chunk (exclusive)
+    :return: <int> The lowest valid proof in the chunk, or None
+    """
+    if kernel is not None:
+        return kernel(last_proof, target, start, stop, _cancel_event.is_set)
+    for proof in range(start, stop):
+        if proof % CANCEL_CHECK_INTERVAL == 0 and _cancel_event.is_set():
+            return None
+        if valid_proof(last_proof, proof, target):
+            return proof
+    return None
+
+
+class ProofOfWorkEngine:
+    def __init__(self, valid_proof, workers=None, chunk_size=50000, kernel=None):
+        """
+        Splits the nonce space into chunks and searches them on a process pool,
+        one worker per core, so mining does not hold the GIL of the API process.
+        With a single core the chunks are searched by the kernel in the calling
+        thread, a worker process would only compete with it for the core.
+
+        :param valid_proof: <callable> Picklable proof predicate (last_proof, proof, target) -> bool
+        :param workers: (Optional) <int> Number of worker processes, defaults to the number of cores
+        :param chunk_size: (Optional) <int> Number of nonces handed to a worker at a time
+        :param kernel: (Optional) <callable> Picklable nonce search equivalent to valid_proof, see search_nonces
+        """
+        self.valid_proof = valid_proof
+        self.kernel = kernel
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self._cancel_event = multiprocessing.Event()
+        # Bumped by cancel, a search stops once the generation it started
+        # from is gone, see token
+        self._generation = 0
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    initializer=_init_worker,
+                    initargs=(self._cancel_event,)
+                )
+            return self._pool
+
+    def token(self):
+        """
+        Take the token before reading the block to extend, so a cancel that
+        comes before the search starts still stops it
+
+        :return: <int> The current cancel generation
+        """
+        return self._generation
+
+    def search(self, last_proof, target, token=None):
+        """
+        Finds the lowest proof p such that valid_proof(last_proof, p, target) holds,
+        i.e. the same proof a sequential search starting at 0 returns.
+
+        :param last_proof: <int> Proof of the block being extended
+        :param target: <int> The difficulty target
+        :param token: (Optional) <int> From token, taken when the block to extend was read. The current generation by default
+        :return: <int> The proof, or None if the search was cancelled
+        """
+        if token is None:
+            token = self._generation
+        self._cancel_event.clear()
+        # A cancel after the token was taken, before or while the event was cleared
+        if self._generation != token:
+            return None
+        if self.workers == 1 and self.kernel is not None:
+            return self._search_inline(last_proof, target, token)
+        pool = self._get_pool()
+
+        in_flight = self.workers * 2
+        pending = {}
+        next_start = 0
+        best = None
+
+        def submit():
+            nonlocal next_start
+            future = pool.submit(
+                _search_chunk, self.valid_proof, self.kernel, last_proof, target,
+                next_start, next_start + self.chunk_size
+            )
+            pending[future] = next_start
+            next_start += self.chunk_size
+
+        for _ in range(in_flight):
+            submit()
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+                proof = future.result()
+                if proof is not None and (best is None or proof < best):
+                    best = proof
+
+            if self._generation != token:
+                for future in pending:
+                    future.cancel()
+                return None
+
+            if best is None:
+                while len(pending) < in_flight:
+                    submit()
+            elif all(start > best for start in pending.values()):
+                # Every chunk that could still hold a lower proof has finished
+                break
+
+        # Stop the chunks that can only produce higher proofs
+        self._cancel_event.set()
+        for future in pending:
+            future.cancel()
+        return best
+
+    def _search_inline(self, last_proof, target, token):
+        start = 0
+        cancelled = lambda: self._generation != token
+        while not cancelled():
+            proof = self.kernel(last_proof, target, start, start + self.chunk_size, cancelled)
+            if proof is not None:
+                return proof
+            start += self.chunk_size
+        return None
+
+    def cancel(self):
+        """
+        Stops the running search, if any. Called when the chain tip moves so the
+        miner does not keep extending a stale block.
+        """
+        with self._lock:
+            self._generation += 1
+        self._cancel_event.set()
+
+    def shutdown(self):
+        self.cancel()
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
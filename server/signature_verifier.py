@@ -0,0 +1,160 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from ellipticcurve import PublicKey, Signature
+from ellipticcurve.ecdsa import Ecdsa
+
+
+@lru_cache(maxsize=1024)
+def _parse_public_key(compressed_public_key):
+    return PublicKey.fromCompressed(compressed_public_key)
+
+
+def _verify_signature(message, compressed_public_key, digital_signature_base64):
+    """
+    Runs inside a worker process of the batch verifier.
+
+    :return: <bool> True if the signature is valid, False if it is not or cannot be parsed
+    """
+    try:
+        public_key = _parse_public_key(compressed_public_key)
+        signature = Signature.fromBase64(digital_signature_base64)
+        return Ecdsa.verify(message, signature, public_key)
+    except Exception:
+        return False
+
+
+class SignatureVerifier:
+    def __init__(self, max_keys=1024, max_results=10000, workers=None, batch_threshold=16):
+        """
+        Verifies ECDSA signatures with a bounded LRU of parsed public keys and of
+        verification results, and spreads large batches over a process pool.
+
+        :param max_keys: (Optional) <int> Number of parsed public keys to keep
+        :param max_results: (Optional) <int> Number of verification results to keep
+        :param workers: (Optional) <int> Worker processes for batches, defaults to the number of cores
+        :param batch_threshold: (Optional) <int> Smallest batch sent to the process pool
+        """
+        self.max_keys = max_keys
+        self.max_results = max_results
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_threshold = batch_threshold
+        self._keys = OrderedDict()
+        self._results = OrderedDict()
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def public_key(self, compressed_public_key):
+        """
+        Parses a compressed public key, reusing the parsed object when the key was seen before
+
+        :param compressed_public_key: <str> Hex encoded compressed public key
+        :return: <PublicKey> The parsed key
+        :raises ValueError: If the key is not a valid compressed public key
+        """
+        with self._lock:
+            public_key = self._keys.get(compressed_public_key)
+            if public_key is not None:
+                self._keys.move_to_end(compressed_public_key)
+                return public_key
+        try:
+            public_key = PublicKey.fromCompressed(compressed_public_key)
+        except Exception as e:
+            raise ValueError(f"Invalid compressed public key: {e}")
+        with self._lock:
+            self._keys[compressed_public_key] = public_key
+            if len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+        return public_key
+
+    @staticmethod
+    def _result_key(message, compressed_public_key, digital_signature_base64):
+        digest = hashlib.sha256(message.encode()).digest()
+        return digest, compressed_public_key, digital_signature_base64
+
+    def _cached(self, key):
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+            return result
+
+    def _store(self, key, result):
+        with self._lock:
+            self._results[key] = result
+            if len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+
+    def verify(self, message, compressed_public_key, digital_signature_base64):
+        """
+        Verifies a single signature, answering from the cache when the same
+        (message hash, key, signature) was verified before.
+
+        :param message: <str> The signed message, the sorted JSON of the transaction
+        :param compressed_public_key: <str> Hex encoded compressed public key
+        :param digital_signature_base64: <str> Base64 encoded DER signature
+        :return: <bool> True if the signature is valid
+        :raises ValueError: If the key or the signature cannot be parsed
+        """
+        key = self._result_key(message, compressed_public_key, digital_signature_base64)
+        result = self._cached(key)
+        if result is not None:
+            return result
+
+        public_key = self.public_key(compressed_public_key)
+        try:
+            signature = Signature.fromBase64(digital_signature_base64)
+        except Exception as e:
+            raise ValueError(f"Invalid digital signature: {e}")
+        result = Ecdsa.verify(message, signature, public_key)
+        self._store(key, result)
+        return result
+
+    def verify_batch(self, items):
+        """
+        Verifies many signatures at once. Cache misses are spread over a process
+        pool when there are at least batch_threshold of them.
+
+        :param items: <list> (message, compressed public key, base64 signature) tuples
+        :return: <list> One bool per item, False for unparsable keys or signatures
+        """
+        results = [None] * len(items)
+        misses = []
+        for position, item in enumerate(items):
+            result = self._cached(self._result_key(*item))
+            if result is None:
+                misses.append(position)
+            else:
+                results[position] = result
+
+        if len(misses) >= self.batch_threshold and self.workers > 1:
+            pool = self._get_pool()
+            chunksize = max(1, len(misses) // (self.workers * 4))
+            verified = pool.map(
+                _verify_signature,
+                *zip(*(items[position] for position in misses)),
+                chunksize=chunksize
+            )
+        else:
+            verified = (_verify_signature(*items[position]) for position in misses)
+
+        for position, result in zip(misses, verified):
+            self._store(self._result_key(*items[position]), result)
+            results[position] = result
+        return results
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
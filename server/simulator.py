@@ -0,0 +1,513 @@
+"""
+Cluster simulator: runs several nodes in one process and measures how blocks
+and transactions spread between them, without tunnels.
+
+Every node is a Blockchain with its own app and block log in a temporary
+directory, started from server/blockchain.json. The nodes talk through a
+LocalTransport, or over localhost ports with --ports, with the latency and
+loss of a LossyTransport. Transactions are signed up front and sent to random
+nodes at --tx-rate, and random nodes mine every --block-interval seconds on
+average, as well as when their mempool fills up like any node. Every
+--resolve-interval seconds each node runs resolve_conflicts, as if it was
+asked on /nodes/resolve, so forks are settled while the load runs.
+
+After --duration seconds the load stops, every node runs resolve_conflicts
+until they all share one tip, and the report is printed as JSON:
+
+    python server/simulator.py --nodes 8 --duration 60 --latency 0.05 --loss 0.01
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SERVER_DIR)
+
+from ellipticcurve.ecdsa import Ecdsa
+from ellipticcurve.privateKey import PrivateKey
+
+from app import create_app
+from blockchain import Blockchain
+from database import BlockchainDb
+from difficulty import TARGET_BLOCK_INTERVAL
+from node_logging import setup_logging
+from transport import HttpTransport, LocalTransport, LossyTransport
+
+logger = logging.getLogger(__name__)
+
+
+class SimulatedNode:
+    def __init__(self, name, blockchain, app, transport):
+        self.name = name
+        self.blockchain = blockchain
+        self.app = app
+        self.transport = transport
+        self.server = None
+
+
+class ChainObserver:
+    def __init__(self, nodes, interval=0.002):
+        """
+        Polls the snapshot of every node and records when each block first
+        showed up on each node. A block seen and dropped again within one
+        interval is missed.
+
+        :param nodes: <list> The SimulatedNode instances
+        :param interval: (Optional) <float> Seconds between two polls
+        """
+        self.nodes = nodes
+        self.interval = interval
+        # block hash -> node -> time the node had it first
+        self.first_seen = {}
+        # block hash -> block
+        self.blocks = {}
+        self._known = {node.name: set() for node in nodes}
+        self._versions = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.poll()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.poll()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.poll()
+
+    def poll(self):
+        now = time.time()
+        for node in self.nodes:
+            state = node.blockchain.snapshot
+            if self._versions.get(node.name) == state.version:
+                continue
+            self._versions[node.name] = state.version
+            known = self._known[node.name]
+            # New blocks are at the top, down to the first block the node had before
+            height = state.height - 1
+            while height >= 0 and state.hashes[height] not in known:
+                block_hash = state.hashes[height]
+                known.add(block_hash)
+                self.first_seen.setdefault(block_hash, {})[node.name] = now
+                self.blocks.setdefault(block_hash, state.chain[height])
+                height -= 1
+
+
+def percentile(values, p):
+    """
+    :param values: <list> The samples
+    :param p: <float> Percentile between 0 and 100
+    :return: <float> The nearest-rank percentile, or None without samples
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def summary(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None
+    }
+
+
+def create_node(name, directory, transport, workers=1, target_interval=None):
+    """
+    Creates a node with its own block log, started from server/blockchain.json.
+    It only knows the nodes it is given, never the nodes of blockchain.json.
+
+    :param name: <str> The node id
+    :param directory: <str> Directory of its block log, created here
+    :param transport: How it talks to the other nodes
+    :param workers: (Optional) <int> Worker processes for proof of work and signature batches
+    :param target_interval: (Optional) <float> Block interval the difficulty is retargeted to
+    :return: <SimulatedNode>
+    """
+    os.makedirs(directory)
+    # An empty state, so the node does not start with the nodes of blockchain.json
+    with open(os.path.join(directory, 'state.json'), 'w') as f:
+        json.dump({'current_transactions': [], 'nodes': [], 'ttl': {}}, f)
+    database = BlockchainDb(directory=directory, legacy_filename=os.path.join(SERVER_DIR, 'blockchain.json'))
+    blockchain = Blockchain(transport=transport, database=database, primary_nodes=[], workers=workers,
+                            scheduled_mining=False, target_block_interval=target_interval or TARGET_BLOCK_INTERVAL)
+    blockchain.ip_address = name
+    return SimulatedNode(name, blockchain, create_app(blockchain, name), transport)
+
+
+def start_nodes(args, workdir):
+    """
+    Creates the nodes and connects every node to every other node
+
+    :return: <list> The SimulatedNode instances
+    """
+    names = [f'sim-{number}' for number in range(args.nodes)]
+    if args.ports:
+        ports = {name: args.ports + number for number, name in enumerate(names)}
+        base = None
+    else:
+        base = LocalTransport()
+    nodes = []
+    for number, name in enumerate(names):
+        inner = HttpTransport(resolve=lambda node: f'127.0.0.1:{ports[node]}') if args.ports else base
+        transport = LossyTransport(inner, args.latency, args.jitter, args.loss,
+                                   seed=None if args.seed is None else args.seed + number)
+        node = create_node(name, os.path.join(workdir, name), transport, target_interval=args.target_interval)
+        if args.ports:
+            node.server = serve(node.app, ports[name])
+        else:
+            base.add(name, node.app)
+        nodes.append(node)
+    for node in nodes:
+        node.blockchain.add_nodes([other.name for other in nodes if other is not node])
+    return nodes
+
+
+def serve(app, port):
+    # Imported here, the in-process cluster does not need a server
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning', lifespan='off'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+def stop_node(node):
+    blockchain = node.blockchain
+    blockchain.ingest.shutdown()
+    # The miner writes to the node directory, which the caller may remove next
+    stop_mining([node])
+    blockchain.chain_validator.stop()
+    blockchain.pow_engine.shutdown()
+    blockchain.signature_verifier.shutdown()
+    blockchain.broadcaster.shutdown()
+    blockchain.gossip.shutdown()
+    blockchain.address_index.close()
+    if node.server is not None:
+        node.server.should_exit = True
+
+
+def funded_accounts(blockchain, filename):
+    with open(filename) as f:
+        accounts = [account for account in json.load(f) if account.get('publicKey') and account.get('privateKey')]
+    return accounts, [account for account in accounts if blockchain.ledger.balance(account['publicKey']) >= 1]
+
+
+def sign_transactions(blockchain, count, filename, seed=None):
+    """
+    Signs count transactions of 1 coin up front, from the accounts with
+    coins to the other accounts, so signing does not slow the load down
+
+    :return: <list> The request bodies of POST /transactions/new
+    """
+    accounts, senders = funded_accounts(blockchain, filename)
+    if not senders:
+        raise SystemExit(f"No account in {filename} has coins to send")
+    budget = {account['publicKey']: int(blockchain.ledger.balance(account['publicKey'])) for account in senders}
+    count = min(count, sum(budget.values()))
+    rng = random.Random(seed)
+    keys = {account['publicKey']: PrivateKey.fromString(account['privateKey']) for account in senders}
+    bodies = []
+    while len(bodies) < count:
+        for sender in senders:
+            public_key = sender['publicKey']
+            if len(bodies) >= count or budget[public_key] < 1:
+                continue
+            budget[public_key] -= 1
+            recipient = rng.choice([account for account in accounts if account['publicKey'] != public_key] or accounts)
+            transaction = {
+                'sender': public_key,
+                'recipient': recipient['publicKey'],
+                'amount': 1,
+                'timestamp': time.time() + len(bodies) * 1e-6
+            }
+            signature = Ecdsa.sign(json.dumps(transaction, sort_keys=True), keys[public_key]).toBase64()
+            bodies.append({'transaction': transaction, 'public_key': public_key, 'digital_signature': signature})
+    return bodies
+
+
+class Load:
+    def __init__(self, nodes, bodies, tx_rate, block_interval, resolve_interval, seed=None):
+        """
+        Sends the transactions at tx_rate to random nodes, makes random nodes
+        mine every block_interval seconds on average and every node resolve
+        conflicts every resolve_interval seconds, until stopped
+        """
+        self.nodes = nodes
+        self.bodies = bodies
+        self.tx_rate = tx_rate
+        self.block_interval = block_interval
+        self.resolve_interval = resolve_interval
+        self.random = random.Random(seed)
+        # transaction id -> time it was sent
+        self.submitted = {}
+        self.accepted = 0
+        self.rejected = {}
+        self._stop = threading.Event()
+        self._threads = []
+        self._senders = ThreadPoolExecutor(max_workers=16, thread_name_prefix='load')
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.tx_rate > 0 and self.bodies:
+            self._threads.append(threading.Thread(target=self._send_transactions, daemon=True))
+        if self.block_interval > 0:
+            self._threads.append(threading.Thread(target=self._mine, daemon=True))
+        if self.resolve_interval > 0:
+            self._threads.append(threading.Thread(target=self._resolve, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._senders.shutdown(wait=True)
+
+    def _send_transactions(self):
+        started = time.time()
+        for sent, body in enumerate(self.bodies):
+            # Paced from the start, so a slow send does not lower the rate
+            delay = started + sent / self.tx_rate - time.time()
+            if self._stop.wait(max(0, delay)):
+                return
+            self._senders.submit(self._send, self.random.choice(self.nodes), body)
+
+    def _send(self, node, body):
+        blockchain = node.blockchain
+        # Clients are not behind the simulated network, only the nodes are
+        transport = node.transport.transport
+        transaction_id = blockchain.generate_transaction_id(body['transaction'])
+        with self._lock:
+            self.submitted[transaction_id] = time.time()
+        try:
+            response = transport.post(transport.url(node.name, '/transactions/new'), json=body, timeout=10)
+            status = response.status_code
+        except Exception as e:
+            status = type(e).__name__
+        with self._lock:
+            if status in (200, 201, 202):
+                self.accepted += 1
+            else:
+                self.rejected[str(status)] = self.rejected.get(str(status), 0) + 1
+
+    def _mine(self):
+        while not self._stop.wait(self.random.expovariate(1 / self.block_interval)):
+            self.random.choice(self.nodes).blockchain.scheduled_mine()
+
+    def _resolve(self):
+        with ThreadPoolExecutor(max_workers=len(self.nodes)) as executor:
+            while not self._stop.wait(self.resolve_interval):
+                list(executor.map(lambda node: node.blockchain.resolve_conflicts(), self.nodes))
+
+
+def stop_mining(nodes):
+    for node in nodes:
+        node.blockchain.should_mine = False
+        node.blockchain.cancel_mining()
+    for node in nodes:
+        thread = node.blockchain.mining_thread
+        if thread is not None:
+            thread.join()
+
+
+def tips(nodes):
+    return {node.blockchain.snapshot.tip_hash for node in nodes}
+
+
+def converge(nodes, timeout):
+    """
+    Runs resolve_conflicts on every node at once, round after round, until
+    every node has the same tip. Branches with the same work are only
+    settled by the next block, so when a round changes nothing the first
+    node mines one.
+
+    :return: <dict> Number of distinct tips before and after, rounds, blocks mined to break ties, seconds
+    """
+    before = len(tips(nodes))
+    started = time.time()
+    rounds = tie_breaks = 0
+    with ThreadPoolExecutor(max_workers=len(nodes)) as executor:
+        while len(tips(nodes)) > 1 and time.time() - started < timeout:
+            replaced = list(executor.map(lambda node: node.blockchain.resolve_conflicts(), nodes))
+            rounds += 1
+            if not any(replaced) and len(tips(nodes)) > 1:
+                blockchain = nodes[0].blockchain
+                blockchain.should_mine = True
+                blockchain.mine_with_timer()
+                tie_breaks += 1
+    return {
+        'tips_before': before,
+        'tips_after': len(tips(nodes)),
+        'converged': len(tips(nodes)) == 1,
+        'rounds': rounds,
+        'tie_breaks': tie_breaks,
+        'seconds': time.time() - started
+    }
+
+
+def report(args, nodes, observer, load, start_height, load_stopped, run_seconds, convergence):
+    reference = nodes[0].blockchain.snapshot
+    main_chain = set(reference.hashes[start_height:])
+    mined = sum(node.blockchain.mining_duration.count(outcome='mined') for node in nodes)
+    stale = mined - len(main_chain)
+
+    # Propagation of the blocks that ended up in the chain, from the time
+    # they were made, while the load ran
+    to_all, deliveries, incomplete = [], [], 0
+    for block_hash in main_chain:
+        seen = observer.first_seen.get(block_hash, {})
+        block = observer.blocks.get(block_hash)
+        if not block:
+            continue
+        created = block['timestamp']
+        times = sorted(seen.values())
+        deliveries.extend(moment - created for moment in times[1:] if moment <= load_stopped)
+        if len(seen) == len(nodes) and times[-1] <= load_stopped:
+            to_all.append(times[-1] - created)
+        else:
+            incomplete += 1
+
+    confirmed, confirmation = 0, []
+    for height in range(start_height, reference.height):
+        block = reference.chain[height]
+        for entry in block['transactions'][1:]:
+            confirmed += 1
+            sent = load.submitted.get(nodes[0].blockchain.transaction_id(entry))
+            if sent is not None:
+                confirmation.append(block['timestamp'] - sent)
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'args': vars(args),
+        'blocks': {
+            'mined': mined,
+            'main_chain': len(main_chain),
+            'stale': stale,
+            'fork_rate': stale / mined if mined else 0
+        },
+        'propagation': {
+            'to_all_nodes': summary(to_all),
+            'per_node': summary(deliveries),
+            'not_reaching_all_nodes': incomplete
+        },
+        'convergence': convergence,
+        'transactions': {
+            'submitted': len(load.submitted),
+            'accepted': load.accepted,
+            'rejected': load.rejected,
+            'confirmed': confirmed,
+            'per_second': confirmed / run_seconds if run_seconds else 0,
+            'confirmation': summary(confirmation)
+        },
+        'network': {
+            'requests': sum(node.transport.sent for node in nodes),
+            'lost': sum(node.transport.lost for node in nodes)
+        }
+    }
+
+
+def print_summary(result, file=sys.stderr):
+    def ms(value):
+        return '-' if value is None else f'{value * 1000:.0f} ms'
+    blocks = result['blocks']
+    propagation = result['propagation']
+    convergence = result['convergence']
+    transactions = result['transactions']
+    print(f"blocks        mined {blocks['mined']}  in chain {blocks['main_chain']}  fork rate {blocks['fork_rate']:.1%}", file=file)
+    print(f"propagation   to all p50 {ms(propagation['to_all_nodes']['p50'])}  p95 {ms(propagation['to_all_nodes']['p95'])}"
+          f"  max {ms(propagation['to_all_nodes']['max'])}  per node p50 {ms(propagation['per_node']['p50'])}", file=file)
+    print(f"convergence   {convergence['tips_before']} tips -> {convergence['tips_after']} in {convergence['rounds']} rounds,"
+          f" {convergence['tie_breaks']} tie breaks, {ms(convergence['seconds'])}", file=file)
+    print(f"transactions  {transactions['confirmed']} confirmed of {transactions['submitted']} sent,"
+          f" {transactions['per_second']:.1f} tx/s, confirmation p50 {ms(transactions['confirmation']['p50'])}", file=file)
+    print(f"network       {result['network']['requests']} requests, {result['network']['lost']} lost", file=file)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate a cluster of nodes in one process")
+    parser.add_argument('--nodes', type=int, default=5, help='number of nodes')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--tx-rate', type=float, default=5, help='transactions sent per second, over all nodes')
+    parser.add_argument('--block-interval', type=float, default=2, help='mean seconds between two blocks mined on a random node, 0 to mine only on full mempools')
+    parser.add_argument('--resolve-interval', type=float, default=5, help='seconds between two resolve_conflicts runs on every node, 0 to resolve only at the end')
+    parser.add_argument('--target-interval', type=float, default=2, help='block interval the difficulty is retargeted to')
+    parser.add_argument('--latency', type=float, default=0.05, help='one way network delay in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02, help='most extra one way delay in seconds')
+    parser.add_argument('--loss', type=float, default=0, help='probability that a request is lost')
+    parser.add_argument('--ports', type=int, default=None, help='serve the nodes on localhost from this port on, instead of in process')
+    parser.add_argument('--converge-timeout', type=float, default=60, help='seconds to wait for the nodes to agree on one tip')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the load and of the network')
+    parser.add_argument('--log-level', default='WARNING', help='log level of the nodes')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(level=args.log_level)
+
+    # The nodes read server/accounts.json relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(SERVER_DIR))
+    workdir = tempfile.mkdtemp(prefix='blockchain-sim-')
+    nodes = []
+    try:
+        nodes = start_nodes(args, workdir)
+        start_height = nodes[0].blockchain.snapshot.height
+        count = int(args.tx_rate * args.duration)
+        bodies = sign_transactions(nodes[0].blockchain, count, os.path.join(SERVER_DIR, 'accounts.json'), args.seed)
+
+        observer = ChainObserver(nodes)
+        load = Load(nodes, bodies, args.tx_rate, args.block_interval, args.resolve_interval, args.seed)
+        observer.start()
+        started = time.time()
+        load.start()
+        time.sleep(args.duration)
+        load.stop()
+        load_stopped = time.time()
+        run_seconds = load_stopped - started
+        # Let the last announcements arrive before the forks are resolved
+        time.sleep(min(5, 10 * (args.latency + args.jitter) + 0.5))
+        stop_mining(nodes)
+        convergence = converge(nodes, args.converge_timeout)
+        observer.stop()
+
+        result = report(args, nodes, observer, load, start_height, load_stopped, run_seconds, convergence)
+    finally:
+        for node in nodes:
+            stop_node(node)
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_summary(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
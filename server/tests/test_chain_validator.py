@@ -0,0 +1,59 @@
+import json
+import os
+import sys
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from blockchain import Blockchain
+from database import BlockchainDb
+
+
+def boot(directory):
+    database = BlockchainDb(directory=directory, legacy_filename=os.path.join(SERVER_DIR, 'blockchain.json'))
+    return Blockchain(database=database, primary_nodes=[], workers=1, scheduled_mining=False)
+
+
+def shutdown(blockchain):
+    blockchain.ingest.shutdown()
+    blockchain.chain_validator.stop()
+    blockchain.pow_engine.shutdown()
+    blockchain.signature_verifier.shutdown()
+    blockchain.broadcaster.shutdown()
+
+
+def test_second_boot_resumes_from_checkpoint(tmp_path, monkeypatch):
+    # No accounts and no peers, the node only loads server/blockchain.json
+    monkeypatch.chdir(tmp_path)
+    directory = str(tmp_path / 'blocklog')
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'state.json'), 'w') as f:
+        json.dump({'current_transactions': [], 'nodes': [], 'ttl': {}}, f)
+
+    # Without a checkpoint the first boot validates the chain in the background
+    blockchain = boot(directory)
+    validator = blockchain.chain_validator
+    validator._thread.join(30)
+    height = len(blockchain.chain) - 1
+    tip_hash = blockchain.block_index.tip_hash
+    shutdown(blockchain)
+    assert validator.status == 'valid'
+    checkpoint = blockchain.database.load_checkpoint()
+    assert checkpoint['height'] == height
+    assert checkpoint['tip_hash'] == tip_hash
+
+    starts = []
+    validate_loaded_chain = Blockchain.validate_loaded_chain
+
+    def spy(self, start=0):
+        starts.append(start)
+        return validate_loaded_chain(self, start)
+
+    monkeypatch.setattr(Blockchain, 'validate_loaded_chain', spy)
+    blockchain = boot(directory)
+    shutdown(blockchain)
+    # Only the blocks after the checkpoint are validated, and no run is needed
+    assert starts == [height + 1]
+    assert blockchain.chain_validator.status == 'idle'
+    assert blockchain.chain_validator.checkpoint == (height, tip_hash)
+    assert len(blockchain.chain) == height + 1
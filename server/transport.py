@@ -0,0 +1,181 @@
+import json
+import random
+import threading
+from time import sleep
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def public_host(node):
+    """
+    The public host of a node: bootstrap nodes run on Render, the others
+    behind a Cloudflare tunnel
+
+    :param node: <str> The node id, e.g. 'simplicity-server1'
+    :return: <str> The host name
+    """
+    if "simplicity" in node:
+        if not node.endswith(".onrender.com"):
+            node = node + ".onrender.com"
+    else:
+        node = node + ".trycloudflare.com"
+    return node
+
+
+class HttpTransport:
+    def __init__(self, max_connections=32, resolve=None):
+        """
+        How a node talks to its peers: requests over pooled keep-alive
+        connections. The broadcaster, gossip and chain sync all send through
+        the transport of their Blockchain, so a simulated network can be put
+        in its place, see LocalTransport and LossyTransport.
+
+        :param max_connections: (Optional) <int> Pooled connections per host
+        :param resolve: (Optional) <callable> Maps a node id to host[:port], public_host by default
+        """
+        self.resolve = resolve or public_host
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, node, path):
+        """
+        :param node: <str> The node id
+        :param path: <str> The endpoint, e.g. '/nodes/inv'
+        :return: <str> The URL of the endpoint on the node
+        """
+        return f'http://{self.resolve(node)}{path}'
+
+    def get(self, url, params=None, timeout=None):
+        return self.session.get(url, params=params, timeout=timeout)
+
+    def post(self, url, json=None, data=None, headers=None, timeout=None):
+        return self.session.post(url, json=json, data=data, headers=headers, timeout=timeout)
+
+    def close(self):
+        self.session.close()
+
+
+class LocalResponse:
+    def __init__(self, response):
+        """
+        A response of an in-process app, with the requests API the callers use
+
+        :param response: The response of the test client
+        """
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = response.content
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error", response=self)
+
+
+class LocalTransport:
+    def __init__(self):
+        """
+        Delivers requests to FastAPI apps running in this process, keyed by
+        node id, so a cluster of nodes can run without tunnels or sockets.
+        Requests to unknown nodes fail like unreachable hosts.
+        """
+        self.clients = {}
+        self._lock = threading.Lock()
+
+    def add(self, node, app):
+        """
+        :param node: <str> The node id the app answers for
+        :param app: The FastAPI app of the node, see app.create_app
+        """
+        # Only the simulator needs the test client, it is not a server dependency
+        from fastapi.testclient import TestClient
+        with self._lock:
+            self.clients[node] = TestClient(app, raise_server_exceptions=False)
+
+    def remove(self, node):
+        with self._lock:
+            self.clients.pop(node, None)
+
+    def url(self, node, path):
+        return f'http://{node}{path}'
+
+    def _client(self, url):
+        parts = urlsplit(url)
+        client = self.clients.get(parts.hostname)
+        if client is None:
+            raise requests.exceptions.ConnectionError(f"No local node answers for {url}")
+        path = parts.path + (f'?{parts.query}' if parts.query else '')
+        return client, path
+
+    def get(self, url, params=None, timeout=None):
+        client, path = self._client(url)
+        return LocalResponse(client.get(path, params=params))
+
+    def post(self, url, json=None, data=None, headers=None, timeout=None):
+        client, path = self._client(url)
+        if data is not None:
+            return LocalResponse(client.post(path, content=data, headers=headers))
+        return LocalResponse(client.post(path, json=json, headers=headers))
+
+    def close(self):
+        pass
+
+
+class LossyTransport:
+    def __init__(self, transport, latency=0.0, jitter=0.0, loss=0.0, seed=None):
+        """
+        Wraps a transport with the delays and losses of a real network, for
+        the cluster simulator. Every request waits latency plus up to jitter
+        seconds on the way out and again on the way back, and a lost request
+        fails with a ConnectionError once it would have arrived.
+
+        :param transport: The transport that delivers the requests
+        :param latency: (Optional) <float> One way delay in seconds
+        :param jitter: (Optional) <float> Most extra one way delay in seconds, uniformly distributed
+        :param loss: (Optional) <float> Probability that a request is lost
+        :param seed: (Optional) <int> Seed of the delays and losses
+        """
+        self.transport = transport
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.sent = 0
+        self.lost = 0
+        self._lock = threading.Lock()
+
+    def url(self, node, path):
+        return self.transport.url(node, path)
+
+    def _delay(self):
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            sleep(delay)
+
+    def _send(self, url, send):
+        with self._lock:
+            self.sent += 1
+            lost = self.loss and self.random.random() < self.loss
+            if lost:
+                self.lost += 1
+        self._delay()
+        if lost:
+            raise requests.exceptions.ConnectionError(f"{url}: lost by the simulated network")
+        response = send()
+        self._delay()
+        return response
+
+    def get(self, url, params=None, timeout=None):
+        return self._send(url, lambda: self.transport.get(url, params=params, timeout=timeout))
+
+    def post(self, url, json=None, data=None, headers=None, timeout=None):
+        return self._send(url, lambda: self.transport.post(url, json=json, data=data, headers=headers, timeout=timeout))
+
+    def close(self):
+        self.transport.close()